@@ -60,6 +60,9 @@ man_pages = [
     ('manpages/messenger', 'messenger',
      'monitoring and log message transporter',
      [], 8),
+    ('manpages/messenger-query', 'messenger-query',
+     'message archive search tool',
+     [], 8),
     ('manpages/hailerter', 'hailerter',
      'state tracker and notification generator',
      [], 8),
@@ -0,0 +1,523 @@
+#!/usr/bin/python
+'''
+Time-indexed message archive
+----------------------------
+
+Archive is a directory with segment files, one for each hour of messages'
+time (UTC), named ``YYYYMMDD-HH.seg``. Segment is a sequence of blocks, each
+being zlib-compressed JSON lines, one message per line.
+
+Every segment has an index file next to it (``YYYYMMDD-HH.idx``) with a line
+for each block: a JSON object with keys ``offset`` and ``size`` (position of
+the block in segment file), ``count`` (number of messages), ``start`` and
+``end`` (the earliest and the latest message time), and ``bloom`` (bloom
+filter of the block's keys, see :class:`BloomFilter`).
+
+Keys of a message are ``aspect=<name>`` and ``location.<field>=<value>`` for
+each field of its location, the same as for routing rules (see
+:mod:`seismometer.output.routing`). A query for an aspect and location fields
+only decompresses blocks whose time range overlaps the query's range and
+whose bloom filter contains all the keys from the query.
+
+A block is written to the segment before its index entry, and readers ignore
+entries pointing past the end of the segment, so an archive can be queried
+while it's being written to.
+
+.. autoclass:: ArchiveWriter
+   :members:
+
+.. autoclass:: ArchiveReader
+   :members:
+
+.. autoclass:: BloomFilter
+   :members:
+
+.. autofunction:: message_keys
+
+'''
+#-----------------------------------------------------------------------------
+
+import os
+import re
+import json
+import mmap
+import zlib
+import time
+import struct
+import base64
+import hashlib
+import calendar
+import collections
+
+__all__ = [
+    'ArchiveWriter', 'ArchiveReader', 'BloomFilter', 'message_keys',
+]
+
+#-----------------------------------------------------------------------------
+
+BLOCK_SIZE = 256 * 1024
+_SEGMENT_NAME = re.compile(r'^(\d{4})(\d{2})(\d{2})-(\d{2})\.seg$')
+
+# the latest time a segment can be named after (9999-12-31 23:59:59 UTC)
+_MAX_TIME = 253402300799
+
+def segment_name(hour):
+    '''
+    :param hour: epoch time of the beginning of an hour
+    :return: base name of the segment (without extension)
+    '''
+    return time.strftime("%Y%m%d-%H", time.gmtime(hour))
+
+def message_keys(message):
+    '''
+    :param message: message
+    :type message: dict
+    :return: list of keys the message can be looked up with
+
+    Keys are ``aspect=<name>`` and ``location.<field>=<value>``.
+    '''
+    keys = []
+    event = message.get("event")
+    if isinstance(event, dict) and isinstance(event.get("name"), basestring):
+        keys.append(u"aspect=" + event["name"])
+    location = message.get("location")
+    if isinstance(location, dict):
+        for (field, value) in location.iteritems():
+            if isinstance(value, basestring):
+                keys.append(u"location.%s=%s" % (field, value))
+    return keys
+
+#-----------------------------------------------------------------------------
+# BloomFilter {{{
+
+class BloomFilter:
+    '''
+    Bloom filter with bit positions derived from MD5 of the key (double
+    hashing).
+    '''
+
+    _HASH = struct.Struct("<QQ")
+
+    def __init__(self, bits, hashes, data = None):
+        '''
+        :param bits: size of the filter (multiple of 8)
+        :param hashes: number of bits set for a key
+        :param data: content of the filter, as returned by :meth:`data()`
+        '''
+        self.bits = bits
+        self.hashes = hashes
+        if data is None:
+            self._array = bytearray(bits // 8)
+        else:
+            self._array = bytearray(data)
+
+    @staticmethod
+    def for_keys(keys, bits_per_key = 10, hashes = 7):
+        '''
+        :param keys: collection of keys to add
+        :param bits_per_key: filter size (10 bits give about 1% of false
+            positives)
+        :param hashes: number of bits set for a key
+        :rtype: :class:`BloomFilter`
+
+        Create a filter sized for the keys and add them.
+        '''
+        bits = max(64, (len(keys) * bits_per_key + 7) // 8 * 8)
+        result = BloomFilter(bits, hashes)
+        for key in keys:
+            result.add(key)
+        return result
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        (h1, h2) = BloomFilter._HASH.unpack(hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+    def add(self, key):
+        '''
+        :param key: key to add
+        :type key: string
+        '''
+        array = self._array
+        for pos in self._positions(key):
+            array[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        array = self._array
+        for pos in self._positions(key):
+            if not array[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def data(self):
+        '''
+        :return: content of the filter
+        :rtype: string
+        '''
+        return str(self._array)
+
+    def to_dict(self):
+        '''
+        :return: JSON-serializable representation of the filter
+        '''
+        return {
+            "bits": self.bits,
+            "hashes": self.hashes,
+            "data": base64.b64encode(self.data()),
+        }
+
+    @staticmethod
+    def from_dict(spec):
+        '''
+        :param spec: dictionary returned by :meth:`to_dict()`
+        :rtype: :class:`BloomFilter`
+        '''
+        return BloomFilter(spec["bits"], spec["hashes"],
+                           base64.b64decode(spec["data"]))
+
+# }}}
+#-----------------------------------------------------------------------------
+# writing {{{
+
+class _Segment:
+    # segment being written: open files and the block being collected
+    def __init__(self, base, compression):
+        self.compression = compression
+        self.data = open(base + ".seg", "ab")
+        self.index = self._open_index(base + ".idx")
+        self.lines = []
+        self.size = 0
+        self.start = None
+        self.end = None
+        self.keys = set()
+        self.created = None # when the current block got its first message
+        self.used = 0       # for closing least recently used segments
+
+    @staticmethod
+    def _open_index(path):
+        index = open(path, "ab+")
+        # entry partially written before a crash would glue to the next one
+        index.seek(0, os.SEEK_END)
+        size = index.tell()
+        if size > 0:
+            index.seek(max(0, size - 65536))
+            tail = index.read()
+            if not tail.endswith("\n"):
+                cut = tail.rfind("\n")
+                index.truncate(size - len(tail) + cut + 1)
+            index.seek(0, os.SEEK_END)
+        return index
+
+    def add(self, line, timestamp, keys, now):
+        if self.created is None:
+            self.created = now
+            self.start = self.end = timestamp
+        elif timestamp < self.start:
+            self.start = timestamp
+        elif timestamp > self.end:
+            self.end = timestamp
+        self.lines.append(line)
+        self.size += len(line)
+        self.keys.update(keys)
+        self.used = now
+
+    def seal(self):
+        if len(self.lines) == 0:
+            return
+        block = zlib.compress("".join(self.lines), self.compression)
+        self.data.seek(0, os.SEEK_END)
+        offset = self.data.tell()
+        self.data.write(block)
+        self.data.flush()
+        entry = {
+            "offset": offset,
+            "size": len(block),
+            "count": len(self.lines),
+            "start": self.start,
+            "end": self.end,
+            "bloom": BloomFilter.for_keys(self.keys).to_dict(),
+        }
+        self.index.write(json.dumps(entry) + "\n")
+        self.index.flush()
+        self.lines = []
+        self.size = 0
+        self.start = self.end = None
+        self.keys = set()
+        self.created = None
+
+    def close(self):
+        try:
+            self.seal()
+        finally:
+            self.data.close()
+            self.index.close()
+
+class ArchiveWriter:
+    '''
+    Writer adding messages to archive directory.
+
+    Messages are collected in blocks in memory, separately for each hour. A
+    block is compressed and written when it reaches :obj:`block_size` or
+    when :meth:`seal()` finds it old enough.
+    '''
+    def __init__(self, directory, block_size = BLOCK_SIZE, compression = 6,
+                 max_open = 4):
+        '''
+        :param directory: archive directory (created if it doesn't exist)
+        :param block_size: size of uncompressed block
+        :param compression: zlib compression level
+        :param max_open: maximum number of segments open at the same time
+            (messages for more hours than this cause blocks to be written
+            early)
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.block_size = block_size
+        self.compression = compression
+        self.max_open = max_open
+        self.segments = {} # hour => _Segment
+
+    def _segment(self, hour, now):
+        segment = self.segments.get(hour)
+        if segment is not None:
+            return segment
+        if len(self.segments) >= self.max_open:
+            lru = min(self.segments, key = lambda h: self.segments[h].used)
+            self.segments.pop(lru).close()
+        base = os.path.join(self.directory, segment_name(hour))
+        segment = self.segments[hour] = _Segment(base, self.compression)
+        return segment
+
+    def write(self, messages, now = None):
+        '''
+        :param messages: list of messages
+        :type messages: list of dicts
+        :throws: :exc:`IOError` or :exc:`OSError` on write errors
+
+        Add messages to archive. Messages with no valid ``time`` field
+        (including times before 1970 or after year 9999, infinities, and
+        NaNs) are stored under the current time.
+        '''
+        if now is None:
+            now = time.time()
+        dumps = json.dumps
+        for message in messages:
+            timestamp = message.get("time")
+            if not isinstance(timestamp, (int, long, float)) or \
+               isinstance(timestamp, bool) or \
+               not 0 <= timestamp <= _MAX_TIME: # also false for NaN
+                timestamp = int(now)
+            hour = int(timestamp) // 3600 * 3600
+            segment = self.segments.get(hour) or self._segment(hour, now)
+            segment.add(dumps(message) + "\n", timestamp,
+                        message_keys(message), now)
+            if segment.size >= self.block_size:
+                segment.seal()
+
+    def seal(self, max_age = 0, now = None):
+        '''
+        :param max_age: write blocks that got their first message at least
+            this many seconds ago
+        :throws: :exc:`IOError` or :exc:`OSError` on write errors
+
+        Write blocks collected so far.
+        '''
+        if now is None:
+            now = time.time()
+        for segment in self.segments.values():
+            if segment.created is not None and now - segment.created >= max_age:
+                segment.seal()
+
+    def close(self):
+        '''
+        Write all collected blocks and close segments.
+        '''
+        segments = self.segments.values()
+        self.segments = {}
+        for segment in segments:
+            segment.close()
+
+# }}}
+#-----------------------------------------------------------------------------
+# reading {{{
+
+class ArchiveReader:
+    '''
+    Reader searching for messages in archive directory.
+
+    .. attribute:: stats
+
+       counters of the blocks checked while querying (``"segments"``,
+       ``"blocks"``, ``"blocks_read"``, ``"bytes_read"``, ``"messages"``)
+    '''
+    def __init__(self, directory):
+        '''
+        :param directory: archive directory
+        '''
+        self.directory = directory
+        self.stats = collections.defaultdict(int)
+
+    def segments(self, start = None, end = None):
+        '''
+        :param start: epoch time
+        :param end: epoch time
+        :return: list of ``(hour, path)`` tuples, sorted by hour
+
+        List segments that can contain messages from the time range
+        (``None`` meaning unbounded).
+        '''
+        result = []
+        for name in os.listdir(self.directory):
+            match = _SEGMENT_NAME.match(name)
+            if match is None:
+                continue
+            hour = calendar.timegm(tuple(int(f) for f in match.groups()) +
+                                   (0, 0, 0, 0, 0))
+            if start is not None and hour + 3600 <= start:
+                continue
+            if end is not None and hour > end:
+                continue
+            result.append((hour, os.path.join(self.directory, name)))
+        result.sort()
+        return result
+
+    def query(self, start = None, end = None, aspect = None, location = None):
+        '''
+        :param start: the earliest message time (epoch; inclusive)
+        :param end: the latest message time (epoch; inclusive)
+        :param aspect: aspect name
+        :param location: location fields to match
+        :type location: dict
+        :return: iterator of JSON lines (as stored in the archive)
+
+        Search the archive for messages. Messages are returned in the order
+        of segments and the order they were written in (not necessarily
+        sorted by time).
+        '''
+        keys = []
+        # JSON fragments that need to be present in a line for it to match,
+        # to skip decoding most of the lines that don't
+        fragments = []
+        if aspect is not None:
+            keys.append(u"aspect=" + aspect)
+            fragments.append(json.dumps(aspect))
+        for (field, value) in sorted((location or {}).items()):
+            keys.append(u"location.%s=%s" % (field, value))
+            fragments.append(json.dumps(value))
+
+        for (hour, path) in self.segments(start, end):
+            self.stats["segments"] += 1
+            blocks = []
+            for entry in self._read_index(path[:-4] + ".idx"):
+                self.stats["blocks"] += 1
+                if start is not None and entry["end"] < start or \
+                   end is not None and entry["start"] > end:
+                    continue
+                if len(keys) > 0:
+                    bloom = BloomFilter.from_dict(entry["bloom"])
+                    if not all(k in bloom for k in keys):
+                        continue
+                blocks.append(entry)
+            if len(blocks) == 0:
+                continue
+            for (entry, lines) in self._read_blocks(path, blocks, fragments):
+                if len(keys) == 0 and \
+                   (start is None or entry["start"] >= start) and \
+                   (end is None or entry["end"] <= end):
+                    # all the block's messages match; no need to decode them
+                    self.stats["messages"] += len(lines)
+                    for line in lines:
+                        yield line
+                    continue
+                for line in lines:
+                    message = json.loads(line)
+                    if start is not None and message.get("time") < start or \
+                       end is not None and message.get("time") > end:
+                        continue
+                    if aspect is not None and \
+                       _message_aspect(message) != aspect:
+                        continue
+                    if location is not None and \
+                       not _location_matches(message, location):
+                        continue
+                    self.stats["messages"] += 1
+                    yield line
+
+    def _read_index(self, path):
+        try:
+            f = open(path)
+        except IOError:
+            return
+        with f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # being written right now
+                    break
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    break
+
+    def _read_blocks(self, path, blocks, fragments):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            for entry in blocks:
+                if entry["offset"] + entry["size"] > size:
+                    # index written after the segment was mapped
+                    continue
+                self.stats["blocks_read"] += 1
+                self.stats["bytes_read"] += entry["size"]
+                data = zlib.decompress(
+                    mm[entry["offset"]:entry["offset"] + entry["size"]]
+                )
+                if len(fragments) == 0:
+                    yield (entry, data.splitlines(True))
+                else:
+                    yield (entry, _lines_with(data, fragments))
+        finally:
+            mm.close()
+
+def _lines_with(data, fragments):
+    # find lines that contain all the fragments, looking for occurrences of
+    # the last (usually the most selective) one instead of checking every
+    # line
+    result = []
+    (needle, others) = (fragments[-1], fragments[:-1])
+    pos = data.find(needle)
+    while pos >= 0:
+        start = data.rfind("\n", 0, pos) + 1
+        end = data.find("\n", pos)
+        if end < 0:
+            end = len(data)
+        else:
+            end += 1
+        line = data[start:end]
+        if all(f in line for f in others):
+            result.append(line)
+        pos = data.find(needle, end)
+    return result
+
+def _message_aspect(message):
+    event = message.get("event")
+    if not isinstance(event, dict):
+        return None
+    return event.get("name")
+
+def _location_matches(message, location):
+    msg_location = message.get("location")
+    if not isinstance(msg_location, dict):
+        return False
+    for (field, value) in location.iteritems():
+        if msg_location.get(field) != value:
+            return False
+    return True
+
+# }}}
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
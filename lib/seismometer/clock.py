@@ -0,0 +1,57 @@
+#!/usr/bin/python
+'''
+Monotonic clock
+---------------
+
+Clock that is not affected by changes of system time (``CLOCK_MONOTONIC``),
+for measuring durations and scheduling timers. Wall clock can be stepped
+backwards or forwards (by NTP or by administrator), which would stall or
+fire at once everything measured against it.
+
+If the monotonic clock is not available, :func:`monotonic()` falls back to
+:func:`time.time()`.
+
+.. autofunction:: monotonic
+
+'''
+#-----------------------------------------------------------------------------
+
+import time
+import ctypes
+import ctypes.util
+
+__all__ = [
+    'monotonic',
+]
+
+#-----------------------------------------------------------------------------
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def _monotonic_clock():
+    CLOCK_MONOTONIC = 1 # Linux
+    try:
+        library = ctypes.util.find_library("rt") or ctypes.util.find_library("c")
+        clock_gettime = ctypes.CDLL(library).clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return None
+    ts = _timespec()
+    ts_ref = ctypes.byref(ts)
+    if clock_gettime(CLOCK_MONOTONIC, ts_ref) != 0:
+        return None
+    def monotonic():
+        clock_gettime(CLOCK_MONOTONIC, ts_ref)
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+_clock = _monotonic_clock() or time.time
+
+def monotonic():
+    '''
+    :return: current time of monotonic clock (in seconds)
+    '''
+    return _clock()
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
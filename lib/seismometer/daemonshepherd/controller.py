@@ -19,10 +19,11 @@ Daemon starter and data dispatcher
 
       Daemons to restart at appropriate time. :class:`RestartQueue` instance.
 
-   .. attribute:: poll
+   .. attribute:: event_loop
 
-      Poll object to check for input from command channel or daemons.
-      :class:`seismometer.poll.Poll` instance.
+      Event loop to check for input from command channel or daemons, to
+      schedule restarts, and to handle signals.
+      :class:`seismometer.eventloop.EventLoop` instance.
 
    .. attribute:: daemons
 
@@ -63,6 +64,7 @@ import json
 import os
 
 import seismometer.poll
+import seismometer.eventloop
 
 #-----------------------------------------------------------------------------
 
@@ -262,6 +264,17 @@ class RestartQueue:
         self._remove_cancelled()
         return result
 
+    def next_restart(self):
+        '''
+        :return: epoch timestamp or ``None``
+
+        Return the time of the nearest restart.
+        '''
+        self._remove_cancelled()
+        if len(self.restart_queue) == 0:
+            return None
+        return self.restart_queue[0][0]
+
     def _remove_cancelled(self):
         # remove cancelled restarts from the head of the queue
         while len(self.restart_queue) > 0 and self.restart_queue[0][1] is None:
@@ -299,7 +312,7 @@ class Controller:
         # NOTE: descriptions of attributes moved to top of the module
         self.load_config = load_config
         self.restart_queue = RestartQueue()
-        self.poll = seismometer.poll.Poll()
+        self.event_loop = seismometer.eventloop.EventLoop()
         self.daemons = {} # name => daemon.Daemon
         # daemons' metadata:
         #   "name": string
@@ -311,12 +324,16 @@ class Controller:
         self.keep_running = True
         if socket_address is not None:
             self.socket = control_socket.ControlSocket(socket_address)
-            self.poll.add(self.socket)
+            self.event_loop.add_reader(self.socket)
         else:
             self.socket = None
-        signal.signal(signal.SIGHUP, self.signal_reload)
-        signal.signal(signal.SIGINT, self.signal_shutdown)
-        signal.signal(signal.SIGTERM, self.signal_shutdown)
+        self._restart_timer = None
+        # signal handlers are called from the event loop
+        add_handler = self.event_loop.add_signal_handler
+        add_handler(signal.SIGHUP, self.signal_reload)
+        add_handler(signal.SIGINT, self.signal_shutdown)
+        add_handler(signal.SIGTERM, self.signal_shutdown)
+        add_handler(signal.SIGCHLD, self.signal_child)
         if not self.reload():
             raise Exception("configuration loading error")
 
@@ -342,7 +359,7 @@ class Controller:
         # wait for the daemon to stop
         self.waitpid(self.daemons[name])
         self.restart_queue.daemon_stopped(name)
-        self.poll.remove(self.daemons[name])
+        self.event_loop.remove_reader(self.daemons[name])
         self.daemons[name]["running"] = False
         self.daemons[name]["stopping"] = False
 
@@ -352,7 +369,7 @@ class Controller:
         else:
             self.restart_queue.daemon_died(name, exit_code, signame)
         self.waitpid(self.daemons[name])
-        self.poll.remove(self.daemons[name])
+        self.event_loop.remove_reader(self.daemons[name])
         self.daemons[name]["running"] = False
         self.daemons[name]["stopping"] = False
         if self.daemons[name].has_command("after-crash"):
@@ -382,7 +399,7 @@ class Controller:
         self.daemons[name].start()
         self.daemons[name]["running"] = True
         self.daemons[name]["stopping"] = False
-        self.poll.add(self.daemons[name])
+        self.event_loop.add_reader(self.daemons[name])
 
     # }}}
     #-------------------------------------------------------------------
@@ -422,7 +439,7 @@ class Controller:
     #-------------------------------------------------------------------
     # signal handlers {{{
 
-    def signal_shutdown(self, signum, stack_frame):
+    def signal_shutdown(self, signum, stack_frame = None):
         '''
         Signal handler that shuts down the controller.
         '''
@@ -431,7 +448,7 @@ class Controller:
         logger.info("got signal %s, shutting down", signame)
         self.keep_running = False # let the loop terminate gracefully
 
-    def signal_reload(self, signum, stack_frame):
+    def signal_reload(self, signum, stack_frame = None):
         '''
         Signal handler that reloads daemons specification file.
         '''
@@ -440,6 +457,12 @@ class Controller:
         logger.info("got signal %s, reloading config", signame)
         self.reload()
 
+    def signal_child(self, signum, stack_frame = None):
+        '''
+        Signal handler that collects statuses of dead children.
+        '''
+        self.collect_dead_children()
+
     # }}}
     #-------------------------------------------------------------------
     # collect dead children {{{
@@ -500,7 +523,7 @@ class Controller:
             self._stop_wait(name)
             del self.daemons[name]
         self.restart_queue.clear()
-        # delete self.poll entries?
+        # delete self.event_loop entries?
 
     def loop(self):
         '''
@@ -511,24 +534,39 @@ class Controller:
         ``False``, but does not stop its children. To do this use
         :meth:`shutdown()`.
         '''
+        # children could have died before SIGCHLD handler was set
+        self.collect_dead_children()
         while self.keep_running:
-            self.collect_dead_children()
-            for handle in self.poll.poll(timeout = 100):
+            self._schedule_restarts()
+            for handle in self.event_loop.run_once():
                 if isinstance(handle, control_socket.ControlSocket):
                     client = handle.accept()
-                    self.poll.add(client)
+                    self.event_loop.add_reader(client)
                 elif isinstance(handle, control_socket.ControlSocketClient):
                     command = handle.read()
                     if command is filehandle.EOF:
-                        self.poll.remove(handle)
+                        self.event_loop.remove_reader(handle)
                         handle.close()
                     else:
                         self.handle_command(command, handle)
                 else: # isinstance(handle, daemon.Daemon)
                     self.handle_daemon_output(handle)
-            # process due restarts
-            for name in self.restart_queue.get_restart_ready():
-                self._start(name)
+
+    def _schedule_restarts(self):
+        # set the timer to the nearest restart from the queue (restart queue
+        # could have changed since the timer was set)
+        next_restart = self.restart_queue.next_restart()
+        timer = self._restart_timer
+        if timer is not None and (timer.done or timer.when != next_restart):
+            timer.cancel()
+            self._restart_timer = None
+        if self._restart_timer is None and next_restart is not None:
+            self._restart_timer = \
+                self.event_loop.call_at(next_restart, self._process_restarts)
+
+    def _process_restarts(self):
+        for name in self.restart_queue.get_restart_ready():
+            self._start(name)
 
     def waitpid(self, daemon):
         '''
@@ -622,7 +660,7 @@ class Controller:
         if line is filehandle.EOF:
             # it's perfectly OK for daemon not to use its STDOUT/STDERR,
             # closing it doesn't mean that the daemon has died
-            self.poll.remove(handle)
+            self.event_loop.remove_reader(handle)
             handle.close()
 
     # }}}
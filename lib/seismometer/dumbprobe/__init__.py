@@ -47,16 +47,12 @@ option, may also be useful as a basis for custom implementation.
 .. autoclass:: Checks
    :members:
 
-.. autoclass:: RunQueue
-   :members:
-
 '''
 #-----------------------------------------------------------------------------
 
-import heapq
 import time
 import logging
-import seismometer.poll
+import seismometer.eventloop
 
 from checks import *
 from handles import *
@@ -70,81 +66,22 @@ __all__ = [
     'ShellStream',
 ]
 
-#-----------------------------------------------------------------------------
-# RunQueue {{{
-
-class RunQueue:
-    '''
-    Queue for running commands at specified times.
-    '''
-    def __init__(self, elements = []):
-        # elements = [(time, command), ...]
-        self.queue = elements[:] # XXX: shallow copy of array
-        heapq.heapify(self.queue)
-
-    def __len__(self):
-        '''
-        :rtype: integer
-
-        Return the size of the queue.
-        '''
-        return len(self.queue)
-
-    def empty(self):
-        '''
-        :rtype: Boolean
-
-        Check if the queue is empty.
-        '''
-        return len(self.queue) == 0
-
-    def add(self, time, command):
-        '''
-        :param time: Epoch timestamp to run command at
-        :param command: command to run
-
-        Add a command to run at specified time.
-
-        :obj:`command` is opaque to the queue.
-        '''
-        heapq.heappush(self.queue, (time, command))
-
-    def get(self):
-        '''
-        :rtype: tuple (time, command)
-
-        Return command that has earliest run time.
-
-        :obj:`command` is the same object as it was passed to :meth:`add()`.
-        '''
-        (time, command) = heapq.heappop(self.queue)
-        return (time, command)
-
-    def peek(self):
-        '''
-        :rtype: tuple (time, command)
-
-        Return command that has earliest run time without removing it from the
-        queue.
-
-        :obj:`command` is the same object as it was passed to :meth:`add()`.
-        '''
-        (time, command) = self.queue[0]
-        return (time, command)
-
-# }}}
 #-----------------------------------------------------------------------------
 
 class Checks:
     '''
     Container for checks to be executed.
+
+    Checks and handle reopens are scheduled as timers in
+    :class:`seismometer.eventloop.EventLoop`, and handles are added to the
+    same loop, so the container sleeps until there's something to do.
     '''
 
     def __init__(self, checks = None):
-        self.q = RunQueue()
-        self.poll = seismometer.poll.Poll()
+        self.loop = seismometer.eventloop.EventLoop()
         self.start_handles = []
         self.check_ids = {}
+        self._results = []
         if checks is not None:
             for c in checks:
                 self.add(c)
@@ -176,10 +113,9 @@ class Checks:
 
         Add an entry to the list of checks to be run periodically.
         '''
-        # XXX: since there's no `delete()' operation and the queue can only
-        # grow at this point, length of the queue before adding the check is
-        # the position of the check in the incoming list
-        self.check_ids[id(check)] = len(self.q)
+        # XXX: since there's no `delete()' operation, number of checks added
+        # so far is the position of the check in the incoming list
+        self.check_ids[id(check)] = len(self.check_ids)
         (check_id, check_name) = self.check_name(check)
 
         logger = logging.getLogger("checks_queue")
@@ -196,7 +132,7 @@ class Checks:
         else:
             logger.info("adding check #%d %s to run at @%d",
                         check_id, check_name, next_run)
-        self.q.add(next_run, check)
+        self.loop.call_at(next_run, self._run_scheduled, check)
 
     def setup_handles(self):
         '''
@@ -213,12 +149,12 @@ class Checks:
                 reopen_time = int(time.time()) + 60 # FIXME: hardcoded
                 logger.warn("handle #%d %s start failed: %s; reopening at @%d",
                             check_id, check_name, str(e), reopen_time)
-                self.q.add(reopen_time, handle)
+                self.loop.call_at(reopen_time, self.reopen_handle, handle)
                 continue
 
             logger.info("adding handle #%d %s to poll queue",
                         check_id, check_name)
-            self.poll.add(handle)
+            self.loop.add_reader(handle, self._read_handle)
         del self.start_handles[:]
 
     def run_next(self):
@@ -229,52 +165,30 @@ class Checks:
         Sleep until next check is expected to be run and run the check, or
         read messages from polled handles, if any are available.
         '''
-        result = None
-        while result is None:
-            result = self._run_next_once()
+        while len(self._results) == 0:
+            self.loop.run_once()
+        result = self._results
+        self._results = []
         return result
 
-    def _run_next_once(self):
-        '''
-        :return: list of dicts and :class:`seismometer.message.Message`
-            instances, or ``None`` if no messages were read
-
-        Sleep until next check is expected to be run and run the check, or
-        read messages from polled handles, if any are available.
-
-        Function may return ``None`` when some handles needed maintenance
-        (closing or reopening), or when a check returned ``None`` or empty
-        list of messages.
-        '''
-
-        if self.q.empty() or int(self.q.peek()[0]) > int(time.time()):
-            # not the time to fire a check, so let's poll handles
-            handles = self.poll.poll(timeout = 200)
-            result = self.read_handles(handles)
-            if len(result) == 0:
-                return None
-            return result
-
-        (next_run, check) = self.q.get() # remove the check from the queue
-
-        if isinstance(check, BaseHandle):
-            # this wasn't a check, but a handle that needs being reopened
-            self.reopen_handle(check)
-            return None
+    def _run_scheduled(self, check):
+        # timer callback: run the check and schedule its next run
 
         # XXX: `check' is a check object, possibly BaseCheck instance, but not
         # necessarily
         result = self.run_check(check)
-        self.q.add(int(check.next_run()), check)
+        self.loop.call_at(int(check.next_run()), self._run_scheduled, check)
 
-        if isinstance(result, (list, tuple)) and len(result) == 0:
-            return None
-        elif isinstance(result, tuple):
-            return list(result)
-        elif isinstance(result, list):
-            return result
+        if result is None:
+            return
+        elif isinstance(result, (list, tuple)):
+            self._results.extend(result)
         else: # dict or seismometer.message.Message
-            return [result]
+            self._results.append(result)
+
+    def _read_handle(self, handle):
+        # event loop callback for handles ready for reading
+        self._results.extend(self.read_handles([handle]))
 
     def read_handles(self, handles):
         '''
@@ -301,9 +215,9 @@ class Checks:
                 reopen_time = int(time.time()) + 60 # FIXME: hardcoded
                 logger.warn("handle #%d %s returned EOF: %s; reopening at @%d",
                             check_id, check_name, str(e), reopen_time)
-                self.poll.remove(handle)
+                self.loop.remove_reader(handle)
                 handle.close()
-                self.q.add(reopen_time, handle)
+                self.loop.call_at(reopen_time, self.reopen_handle, handle)
             except Exception, e:
                 # probably a processing error; log the message and continue
                 logger.warn("handle #%d %s raised a read exception: %s",
@@ -328,9 +242,9 @@ class Checks:
             reopen_time = int(time.time()) + 60 # FIXME: hardcoded
             logger.warn("handle #%d %s reopen failed: %s; reopening at @%d",
                         check_id, check_name, str(e), reopen_time)
-            self.q.add(reopen_time, handle)
+            self.loop.call_at(reopen_time, self.reopen_handle, handle)
             return
-        self.poll.add(handle)
+        self.loop.add_reader(handle, self._read_handle)
         logger.info("handle #%d %s reopened", check_id, check_name)
 
     def run_check(self, check):
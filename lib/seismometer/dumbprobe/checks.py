@@ -121,6 +121,10 @@ class BaseCheck(object):
         '''
         Helper to add aspect name and location to message, whatever it is.
         '''
+        if seismometer.message.is_valid(message):
+            # lazy wrapper around dict; to_dict() will still return the
+            # original dict, with the changes applied
+            message = seismometer.message.MessageView(message)
         if isinstance(message, seismometer.message.Message):
             if self.aspect is not None:
                 message.aspect = self.aspect
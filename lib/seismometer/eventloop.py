@@ -0,0 +1,384 @@
+#!/usr/bin/python
+'''
+Event loop with timers
+----------------------
+
+:class:`EventLoop` combines :class:`seismometer.poll.Poll` with a heap of
+timers and with signal handling. Poll timeout is computed from the earliest
+timer, so an idle process doesn't wake up until there's something to do.
+
+Timers are kept on monotonic clock (see :func:`seismometer.clock.monotonic()`),
+so changes of system time don't stall them or fire them all at once. A call
+scheduled for an epoch timestamp with :meth:`EventLoop.call_at()` is
+converted to a delay when it's scheduled.
+
+Signals are delivered through a pipe (the so-called self-pipe trick): signal
+handler only writes signal number to the pipe and the actual callback is
+called from the loop, outside of signal handler context. Signals handled this
+way don't interrupt system calls.
+
+Small example of use::
+
+   loop = EventLoop()
+
+   def read_input(handle):
+       line = handle.readline()
+       # ...
+
+   def flush():
+       # ...
+       loop.call_later(10, flush)
+
+   loop.add_reader(sys.stdin, read_input)
+   loop.add_signal_handler(signal.SIGTERM, lambda signum: loop.stop())
+   loop.call_later(10, flush)
+   loop.run()
+
+.. autoclass:: EventLoop
+   :members:
+
+.. autoclass:: Timer
+   :members:
+
+'''
+#-----------------------------------------------------------------------------
+
+import os
+import time
+import heapq
+import fcntl
+import errno
+import signal
+import seismometer.poll
+import seismometer.clock
+
+__all__ = [
+    'EventLoop', 'Timer',
+]
+
+#-----------------------------------------------------------------------------
+
+class Timer:
+    '''
+    Handle for a scheduled call, returned by :meth:`EventLoop.call_at()` and
+    :meth:`EventLoop.call_later()`.
+
+    .. attribute:: when
+
+       epoch timestamp at which the call is scheduled
+    '''
+    def __init__(self, loop, when, callback, args):
+        self._loop = loop
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.done = False
+
+    def cancel(self):
+        '''
+        Cancel the scheduled call. It's OK to cancel a timer that already
+        fired or was cancelled.
+        '''
+        if self.cancelled or self.done:
+            return
+        self.cancelled = True
+        self._loop._timer_cancelled()
+
+    def __repr__(self):
+        return "<Timer @%.3f %r>" % (self.when, self.callback)
+
+#-----------------------------------------------------------------------------
+
+class _SignalPipe:
+    '''
+    Reading end of self-pipe, suitable for :class:`seismometer.poll.Poll`.
+    '''
+    def __init__(self):
+        (self.read_fd, self.write_fd) = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.read_fd is not None:
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+            self.read_fd = None
+            self.write_fd = None
+
+    def notify(self, signum, stack_frame):
+        # signal handler
+        try:
+            os.write(self.write_fd, chr(signum))
+        except OSError:
+            pass # pipe full (signal will be lost) or closed
+
+    def read(self):
+        result = []
+        while True:
+            try:
+                data = os.read(self.read_fd, 256)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if data == "":
+                break
+            result.extend(ord(c) for c in data)
+        return result
+
+    def fileno(self):
+        return self.read_fd
+
+#-----------------------------------------------------------------------------
+
+class EventLoop:
+    '''
+    Event loop for file handles, timers, and signals.
+
+    .. attribute:: poll
+
+       :class:`seismometer.poll.Poll` instance with all the handles added
+       with :meth:`add_reader()`
+    '''
+    def __init__(self):
+        self.poll = seismometer.poll.Poll()
+        self._readers = {}  # id(handle) => callback or None
+        self._background = set() # id(handle) of background handles
+        self._timers = []   # heap of (monotonic deadline, seq, Timer)
+        self._timer_seq = 0
+        self._cancelled = 0 # number of cancelled timers still in the heap
+        self._signal_pipe = None
+        self._signal_handlers = {} # signum => callback
+        self._running = False
+
+    #-------------------------------------------------------
+    # file handles {{{
+
+    def add_reader(self, handle, callback = None, background = False):
+        '''
+        :param handle: file handle (anything with :meth:`fileno()` method)
+        :param callback: function to call with :obj:`handle` as an argument
+            when the handle is ready for reading
+        :param background: if ``True``, the handle is not counted by
+            :meth:`readers()` (e.g. a socket serving queries, which shouldn't
+            keep the process running when all its inputs are closed)
+
+        Watch file handle for readiness. If :obj:`callback` is ``None``,
+        ready handle is returned by :meth:`run_once()` instead.
+        '''
+        self.poll.add(handle)
+        self._readers[id(handle)] = callback
+        if background:
+            self._background.add(id(handle))
+        else:
+            self._background.discard(id(handle))
+
+    def remove_reader(self, handle):
+        '''
+        :param handle: file handle
+
+        Stop watching file handle. It's OK to remove a handle that was not
+        added.
+        '''
+        self.poll.remove(handle)
+        self._readers.pop(id(handle), None)
+        self._background.discard(id(handle))
+
+    def readers(self):
+        '''
+        :return: number of handles watched (background handles excluded)
+        '''
+        return len(self._readers) - len(self._background)
+
+    # }}}
+    #-------------------------------------------------------
+    # timers {{{
+
+    def call_at(self, when, callback, *args):
+        '''
+        :param when: epoch timestamp
+        :param callback: function to call
+        :param args: positional arguments for :obj:`callback`
+        :rtype: :class:`Timer`
+
+        Schedule a call at specified time.
+        '''
+        return self._schedule(when, when - time.time(), callback, args)
+
+    def call_later(self, delay, callback, *args):
+        '''
+        :param delay: number of seconds (may be a float)
+        :param callback: function to call
+        :param args: positional arguments for :obj:`callback`
+        :rtype: :class:`Timer`
+
+        Schedule a call after specified delay.
+        '''
+        return self._schedule(time.time() + delay, delay, callback, args)
+
+    def _schedule(self, when, delay, callback, args):
+        timer = Timer(self, when, callback, args)
+        self._timer_seq += 1
+        deadline = seismometer.clock.monotonic() + delay
+        heapq.heappush(self._timers, (deadline, self._timer_seq, timer))
+        return timer
+
+    def next_timer(self):
+        '''
+        :return: epoch timestamp or ``None``
+
+        Return time of the earliest active timer.
+        '''
+        if self._next_deadline() is None:
+            return None
+        return self._timers[0][2].when
+
+    def _next_deadline(self):
+        # monotonic time of the earliest active timer
+        while len(self._timers) > 0 and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+            self._cancelled -= 1
+        if len(self._timers) == 0:
+            return None
+        return self._timers[0][0]
+
+    def _timer_cancelled(self):
+        self._cancelled += 1
+        # don't let cancelled timers pile up in the heap
+        if self._cancelled > 64 and self._cancelled > len(self._timers) / 2:
+            self._timers = [t for t in self._timers if not t[2].cancelled]
+            heapq.heapify(self._timers)
+            self._cancelled = 0
+
+    def _run_timers(self):
+        # only run timers that were due before this function started, so
+        # a timer re-adding itself with zero delay doesn't block the loop
+        now = seismometer.clock.monotonic()
+        due = []
+        while len(self._timers) > 0 and self._timers[0][0] <= now:
+            (deadline, seq, timer) = heapq.heappop(self._timers)
+            if timer.cancelled:
+                self._cancelled -= 1
+            else:
+                due.append(timer)
+        for timer in due:
+            if timer.cancelled: # cancelled by an earlier timer
+                self._cancelled -= 1
+                continue
+            timer.done = True
+            timer.callback(*timer.args)
+
+    # }}}
+    #-------------------------------------------------------
+    # signals {{{
+
+    def add_signal_handler(self, signum, callback):
+        '''
+        :param signum: signal number
+        :param callback: function to call with signal number as an argument
+
+        Set a handler for a signal. The handler will be called from the loop,
+        not from the signal handler context.
+        '''
+        if self._signal_pipe is None:
+            self._signal_pipe = _SignalPipe()
+            self.poll.add(self._signal_pipe)
+        self._signal_handlers[signum] = callback
+        signal.signal(signum, self._signal_pipe.notify)
+        # restart system calls interrupted by this signal
+        signal.siginterrupt(signum, False)
+
+    def remove_signal_handler(self, signum):
+        '''
+        :param signum: signal number
+
+        Remove handler for a signal, restoring the default action.
+        '''
+        if signum in self._signal_handlers:
+            del self._signal_handlers[signum]
+            signal.signal(signum, signal.SIG_DFL)
+
+    def _run_signals(self):
+        for signum in self._signal_pipe.read():
+            callback = self._signal_handlers.get(signum)
+            if callback is not None:
+                callback(signum)
+
+    # }}}
+    #-------------------------------------------------------
+    # running the loop {{{
+
+    def poll_timeout(self, timeout = None):
+        '''
+        :param timeout: upper limit for the timeout (seconds); ``None`` means
+            no limit
+        :return: timeout in milliseconds for :meth:`seismometer.poll.Poll.poll`
+            (``-1`` means infinity)
+
+        Compute poll timeout from the earliest timer.
+        '''
+        deadline = self._next_deadline()
+        if deadline is not None:
+            delay = deadline - seismometer.clock.monotonic()
+            if timeout is not None:
+                delay = min(delay, timeout)
+        elif timeout is not None:
+            delay = timeout
+        else:
+            return -1
+        if delay <= 0:
+            return 0
+        # round up, so the loop doesn't wake up just before the timer is due
+        return int(delay * 1000) + 1
+
+    def run_once(self, timeout = None):
+        '''
+        :param timeout: maximum time to wait (seconds); ``None`` means waiting
+            until a timer is due or a handle is ready
+        :return: list of ready handles that were added without callback
+
+        Wait for handles and timers and run the callbacks that are due.
+        '''
+        unhandled = []
+        for handle in self.poll.poll(self.poll_timeout(timeout)):
+            if handle is self._signal_pipe:
+                self._run_signals()
+                continue
+            if id(handle) not in self._readers:
+                continue # removed by a callback called earlier
+            callback = self._readers[id(handle)]
+            if callback is None:
+                unhandled.append(handle)
+            else:
+                callback(handle)
+        self._run_timers()
+        return unhandled
+
+    def run(self):
+        '''
+        Run the loop until :meth:`stop()` is called.
+        '''
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        '''
+        Stop the loop started with :meth:`run()`.
+        '''
+        self._running = False
+
+    # }}}
+    #-------------------------------------------------------
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
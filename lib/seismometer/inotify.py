@@ -0,0 +1,169 @@
+#!/usr/bin/python
+'''
+Minimal inotify interface
+-------------------------
+
+Wrapper for Linux :manpage:`inotify(7)`, called through :mod:`ctypes`, for
+watching directories for changes of files. On systems without inotify,
+:func:`available()` returns ``False`` and :class:`Inotify` can't be created.
+
+.. autofunction:: available
+
+.. autoclass:: Inotify
+   :members:
+
+'''
+#-----------------------------------------------------------------------------
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+__all__ = [
+    'Inotify', 'available',
+]
+
+#-----------------------------------------------------------------------------
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC  = 0o2000000
+
+# events reported for files in a watched directory that may need reading
+DIRECTORY_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | \
+                   IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | \
+                   IN_MOVE_SELF
+
+_EVENT = struct.Struct("iIII") # wd, mask, cookie, name length
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = \
+            [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+_libc = _load_libc()
+
+def available():
+    '''
+    Check if inotify can be used on this system.
+    '''
+    return _libc is not None
+
+#-----------------------------------------------------------------------------
+
+class Inotify:
+    '''
+    Inotify descriptor with a set of watched directories.
+
+    The descriptor is non-blocking and can be added to
+    :class:`seismometer.poll.Poll`.
+    '''
+    def __init__(self):
+        '''
+        :throws: :exc:`OSError`
+        '''
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.watches = {} # wd => directory
+        self._wds = {}    # directory => wd
+
+    def __del__(self):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        '''
+        Close the descriptor.
+        '''
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def watch(self, directory, mask = DIRECTORY_EVENTS):
+        '''
+        :param directory: directory to watch
+        :param mask: events to report
+        :throws: :exc:`OSError`
+
+        Start watching a directory. Watching the same directory again is
+        a no-op.
+        '''
+        directory = os.path.abspath(directory)
+        if directory in self._wds:
+            return
+        wd = _libc.inotify_add_watch(self.fd, directory, mask | IN_ONLYDIR)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), directory)
+        self.watches[wd] = directory
+        self._wds[directory] = wd
+
+    def unwatch(self, directory):
+        '''
+        :param directory: directory to stop watching
+
+        Stop watching a directory.
+        '''
+        wd = self._wds.pop(os.path.abspath(directory), None)
+        if wd is not None:
+            del self.watches[wd]
+            _libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        '''
+        :return: list of ``(directory, name, mask)`` tuples; *directory* is
+            ``None`` for :const:`IN_Q_OVERFLOW`, *name* is ``None`` for
+            events of the directory itself
+
+        Read events that are ready. Returns an empty list if there are none.
+        '''
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            (wd, mask, cookie, length) = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos + length].rstrip("\0") or None
+            pos += length
+            if mask & IN_IGNORED:
+                # watch removed (directory deleted or unwatched)
+                directory = self.watches.pop(wd, None)
+                if directory is not None:
+                    self._wds.pop(directory, None)
+                continue
+            events.append((self.watches.get(wd), name, mask))
+        return events
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -15,16 +15,16 @@ Reading from a bunch of input sockets
 '''
 #-----------------------------------------------------------------------------
 
-import seismometer.poll
-import Queue
+import seismometer.eventloop
+import collections
 import json
 
 from _connection_socket import ConnectionSocket
 
-import inet, stdin, unix
+import inet, stdin, unix, carbon, shm, file
 __all__ = [
     'EOF', 'Reader', 'JSONReader',
-    'inet', 'stdin', 'unix',
+    'inet', 'stdin', 'unix', 'carbon', 'shm', 'file',
 ]
 
 #-----------------------------------------------------------------------------
@@ -40,16 +40,61 @@ class EOF(Exception):
 class ReadQueue:
     '''
     Read a line from any polled socket.
-    '''
-    def __init__(self):
-        self.poll = seismometer.poll.Poll()
-        self.queue = Queue.Queue()
 
-    def add(self, sock):
+    .. attribute:: loop
+
+       :class:`seismometer.eventloop.EventLoop` instance the sockets are
+       added to
+
+    .. attribute:: sampled
+
+       list of ``(index, ingress, source)`` tuples for entries returned by
+       the last :meth:`readlines()` call that were selected for tracing;
+       *ingress* is the time the entry was read from its socket and
+       *source* is the name of the socket (see :meth:`add()`)
+    '''
+    def __init__(self, loop = None, quota = None, tracer = None):
+        '''
+        :param loop: event loop to use; new one is created if ``None``
+        :param quota: maximum number of lines taken from a single socket in
+            one round (``None`` means no limit)
+        :param tracer: :class:`seismometer.messenger.tracing.Tracer` to
+            select entries for tracing with
+
+        Lines read over :obj:`quota` are kept aside and queued in the
+        following rounds, round-robin with other sockets. The socket is not
+        read from until all of its lines are queued, so a flooding client
+        gets slowed down by TCP flow control instead of starving the others.
         '''
+        if loop is None:
+            loop = seismometer.eventloop.EventLoop()
+        self.loop = loop
+        self.quota = quota
+        self.queue = collections.deque()
+        # [sock, host, lines, position, ingress] of sockets that exceeded the
+        # quota
+        self.backlog = []
+        self.names = {} # sock => name
+        # tracing: numbers of entries that went through the queue, and
+        # (enqueued count, ingress, source) marks for each chunk of entries
+        self.tracer = tracer
+        self.enqueued = 0
+        self.dequeued = 0
+        self.marks = collections.deque()
+        self.sampled = []
+
+    def add(self, sock, name = None):
+        '''
+        :param name: name of the socket for tracing (connections accepted by
+            the socket get the same name)
+
         Add new socket to poll list.
         '''
-        self.poll.add(sock)
+        if name is not None:
+            self.names[sock] = name
+        if hasattr(sock, "attach"):
+            sock.attach(self.loop)
+        self.loop.add_reader(sock, self._ready)
 
     def remove(self, sock):
         '''
@@ -58,43 +103,156 @@ class ReadQueue:
         Raises :class:`EOF` when there is no more sockets to read from after
         this function finishes.
         '''
-        self.poll.remove(sock)
-        if self.poll.empty():
+        self.loop.remove_reader(sock)
+        self.names.pop(sock, None)
+        if self.loop.readers() == 0 and len(self.backlog) == 0:
             raise EOF()
 
+    def _ready(self, sock):
+        if isinstance(sock, ConnectionSocket):
+            # connection attempts, add clients to poll and skip reading
+            client = sock.accept()
+            while client is not None:
+                self.add(client, self.names.get(sock))
+                client = sock.accept()
+            return
+
+        (host, line) = sock.readline()
+        if self.tracer is not None:
+            ingress = self.tracer.clock()
+        else:
+            ingress = None
+        if line is None:
+            # EOF, remove the socket from poll
+            self.remove(sock)
+        elif line == '':
+            # no data read, but not EOF yet (maybe partial line)
+            pass
+        elif isinstance(line, list):
+            # messages already decoded by the socket (binary wire format) or
+            # batches of samples (Carbon pickle)
+            self._enqueue(sock, host, line, ingress)
+        else:
+            # some data (maybe multiline)
+            self._enqueue(sock, host, [l.strip() for l in line.split('\n')],
+                          ingress)
+
+    def _enqueue(self, sock, host, lines, ingress = None):
+        if self.quota is None or len(lines) <= self.quota:
+            for l in lines:
+                self.queue.append((host, l))
+            self._mark(sock, len(lines), ingress)
+            return
+        for l in lines[:self.quota]:
+            self.queue.append((host, l))
+        self._mark(sock, self.quota, ingress)
+        # stop reading the socket until the rest is queued
+        self.loop.remove_reader(sock)
+        self.backlog.append([sock, host, lines, self.quota, ingress])
+
+    def _mark(self, sock, count, ingress):
+        self.enqueued += count
+        if ingress is not None:
+            self.marks.append((self.enqueued, ingress, self.names.get(sock)))
+
+    def _take(self, count):
+        # account for entries just taken from the queue and select the ones
+        # to trace
+        start = self.dequeued
+        self.dequeued += count
+        if self.tracer is None:
+            return
+        marks = self.marks
+        sampled = []
+        for i in self.tracer.sample(count):
+            while len(marks) > 0 and marks[0][0] <= start + i:
+                marks.popleft()
+            if len(marks) == 0:
+                break
+            (end, ingress, name) = marks[0]
+            sampled.append((i, ingress, name))
+        while len(marks) > 0 and marks[0][0] <= self.dequeued:
+            marks.popleft()
+        self.sampled = sampled
+
+    def _run_backlog(self):
+        # one round of queueing lines kept aside
+        backlog = []
+        for entry in self.backlog:
+            (sock, host, lines, pos, ingress) = entry
+            end = pos + self.quota
+            for l in lines[pos:end]:
+                self.queue.append((host, l))
+            self._mark(sock, len(lines[pos:end]), ingress)
+            if end < len(lines):
+                entry[3] = end
+                backlog.append(entry)
+            else:
+                self.loop.add_reader(sock, self._ready)
+        self.backlog = backlog
+
     def readline(self):
         '''
-        :return: originating host and line received
-        :rtype: tuple (string, string)
+        :return: originating host and line received (or message, if the
+            socket decodes messages itself, or batch of samples)
+        :rtype: tuple (string, string), (string, dict), or (string,
+            :class:`carbon.Samples`)
 
-        Read single line from all the sockets from poll list.
+        Read single line from all the sockets from poll list. Timers and
+        signal handlers of the event loop are run while waiting.
 
         Raises :class:`EOF` when there is no more sockets to read from.
         '''
-        # XXX: in any given poll there could be just TCP connection attempts and
-        # closed sockets with no incoming data
-        while self.queue.empty():
-            for sock in self.poll.poll(-1): # wait for any input
-                if isinstance(sock, ConnectionSocket):
-                    # connection attempt, add client to poll and skip reading
-                    client = sock.accept()
-                    self.add(client)
-                    continue
-
-                (host, line) = sock.readline()
-                if line is None:
-                    # EOF, remove the socket from poll
-                    self.remove(sock)
-                elif line == '':
-                    # no data read, but not EOF yet (maybe partial line)
-                    pass
-                else:
-                    # some data (maybe multiline)
-                    for l in line.split('\n'):
-                        self.queue.put((host, l.strip()))
-
+        self._wait()
         # loop ended, so there must be anything in the queue
-        return self.queue.get()
+        self._take(1)
+        return self.queue.popleft()
+
+    def _wait(self):
+        # XXX: in any given poll there could be just TCP connection attempts,
+        # closed sockets with no incoming data, or just timers
+        while len(self.queue) == 0:
+            if len(self.backlog) > 0:
+                # give other sockets their turn, but don't wait for them
+                self.loop.run_once(0)
+                self._run_backlog()
+            else:
+                self.loop.run_once()
+
+    def readlines(self, max = 1024):
+        '''
+        :param max: maximum number of lines to return
+        :return: list of tuples (host, line) (or (host, message))
+
+        Read all the lines that are available at the moment, waiting for at
+        least one. See :meth:`readline()`.
+        '''
+        self._wait()
+        queue = self.queue
+        if len(queue) <= max:
+            result = list(queue)
+            queue.clear()
+        else:
+            result = [queue.popleft() for i in xrange(max)]
+        self._take(len(result))
+        return result
+
+    def read_pending(self):
+        '''
+        :return: list of tuples (host, line) (or (host, message))
+
+        Return all the lines already read from the sockets, including the
+        ones kept aside over the quota, without waiting for more.
+        '''
+        for (sock, host, lines, pos, ingress) in self.backlog:
+            for l in lines[pos:]:
+                self.queue.append((host, l))
+            self.loop.add_reader(sock, self._ready)
+        self.backlog = []
+        result = list(self.queue)
+        self.queue.clear()
+        self._take(len(result))
+        return result
 
 #-----------------------------------------------------------------------------
 
@@ -104,15 +262,40 @@ class Reader(object):
 
     This is a base class for different line-based protocols. See
     :class:`JSONReader` for an example implementation.
-    '''
-    def __init__(self):
-        self.poll = ReadQueue()
 
-    def add(self, sock):
+    .. attribute:: loop
+
+       :class:`seismometer.eventloop.EventLoop` instance the reader runs
+       while waiting for input
+
+    .. attribute:: traces
+
+       list of ``(index, trace)`` tuples for messages returned by the last
+       :meth:`read_batch()` call that are traced (see
+       :mod:`seismometer.messenger.tracing`)
+    '''
+    def __init__(self, loop = None, quota = None, tracer = None):
         '''
+        :param loop: event loop to use; new one is created if ``None``
+        :param quota: maximum number of lines taken from a single socket in
+            one round of reading (``None`` means no limit)
+        :param tracer: :class:`seismometer.messenger.tracing.Tracer` to
+            record timings of reading and parsing in
+        '''
+        self.poll = ReadQueue(loop, quota, tracer)
+        self.loop = self.poll.loop
+        self.tracer = tracer
+        self.traces = []
+        # messages parsed from a single line, to be returned by read()
+        self._pending = collections.deque()
+
+    def add(self, sock, name = None):
+        '''
+        :param name: name of the socket, for tracing
+
         Add a socket to poll list.
         '''
-        self.poll.add(sock)
+        self.poll.add(sock, name)
 
     def read(self):
         '''
@@ -123,14 +306,102 @@ class Reader(object):
         Raises :class:`EOF` when there is no more sockets to read from.
         '''
         # try reading and parsing until a good message is produced
-        while True:
+        while len(self._pending) == 0:
             (host, line) = self.poll.readline()
-            message = self.parse_line(host, line)
-
-            if message is not None:
+            message = self._parse(host, line)
+            if isinstance(message, list):
+                self._pending.extend(message)
+            elif message is not None:
                 return message
-
             # else (message is None): try reading next message
+        return self._pending.popleft()
+
+    def read_batch(self, max = 1024):
+        '''
+        :param max: maximum number of lines to read
+        :rtype: list of dicts
+
+        Read all the messages available at the moment from polled sockets,
+        waiting for at least one.
+
+        Raises :class:`EOF` when there is no more sockets to read from.
+        '''
+        messages = list(self._pending)
+        self._pending.clear()
+        self.traces = []
+        while len(messages) == 0:
+            entries = self.poll.readlines(max)
+            if self.tracer is not None and len(self.poll.sampled) > 0:
+                self._parse_traced(entries, messages)
+                continue
+            for (host, line) in entries:
+                message = self._parse(host, line)
+                if isinstance(message, list):
+                    messages.extend(message)
+                elif message is not None:
+                    messages.append(message)
+        return messages
+
+    def read_pending(self):
+        '''
+        :rtype: list of dicts
+
+        Parse all the lines already read from the sockets (see
+        :meth:`ReadQueue.read_pending()`), without waiting for more (e.g.
+        before shutdown).
+        '''
+        messages = list(self._pending)
+        self._pending.clear()
+        self.traces = []
+        for (host, line) in self.poll.read_pending():
+            message = self._parse(host, line)
+            if isinstance(message, list):
+                messages.extend(message)
+            elif message is not None:
+                messages.append(message)
+        return messages
+
+    def _parse_traced(self, entries, messages):
+        # the same as the loop in read_batch(), but recording timings of the
+        # entries selected for tracing
+        sampled = dict(
+            (i, (ingress, source))
+            for (i, ingress, source) in self.poll.sampled
+        )
+        tracer = self.tracer
+        for (i, (host, line)) in enumerate(entries):
+            if i not in sampled:
+                message = self._parse(host, line)
+                if isinstance(message, list):
+                    messages.extend(message)
+                elif message is not None:
+                    messages.append(message)
+                continue
+
+            (ingress, source) = sampled[i]
+            tracer.record("read", "source", source, tracer.clock() - ingress)
+            (message, parse_time, match_time) = self.trace_parse(host, line)
+            tracer.record("parse", "source", source, parse_time)
+            if match_time is not None:
+                tracer.record("match", "source", source, match_time)
+            if isinstance(message, list):
+                if len(message) > 0:
+                    # the first message of the line represents it
+                    trace = tracer.trace(source, ingress)
+                    self.traces.append((len(messages), trace))
+                messages.extend(message)
+            elif message is not None:
+                self.traces.append((len(messages),
+                                    tracer.trace(source, ingress)))
+                messages.append(message)
+
+    def _parse(self, host, line):
+        if isinstance(line, dict):
+            # already decoded
+            return line
+        if isinstance(line, carbon.Samples):
+            return self.parse_samples(host, line)
+        return self.parse_line(host, line)
 
     def parse_line(self, host, line):
         '''
@@ -138,12 +409,46 @@ class Reader(object):
         :param line: serialized message sent from the host
 
         Parse line to a usable message. Method should return ``None`` if
-        nothing could be parsed.
+        nothing could be parsed, or a list if the line carried several
+        messages.
 
         Method to be implemented in subclass.
         '''
         raise NotImplementedError("parse_line() not implemented")
 
+    def parse_samples(self, host, samples):
+        '''
+        :param host: name of the host that sent the samples
+        :param samples: list of ``(path, (timestamp, value))`` tuples
+        :type samples: :class:`carbon.Samples`
+        :return: list of messages
+
+        Convert a batch of samples received from Carbon pickle socket to
+        messages. Invalid samples should be skipped.
+
+        Method to be implemented in subclass.
+        '''
+        raise NotImplementedError("parse_samples() not implemented")
+
+    def trace_parse(self, host, line):
+        '''
+        :param host: name of the host that sent the message
+        :param line: serialized message (or anything :meth:`read_batch()`
+            could get from a socket)
+        :return: tuple ``(message, parse_time, match_time)``
+
+        Parse a line (see :meth:`parse_line()`), measuring how long it took.
+        *match_time* is the time spent on matching tags (not included in
+        *parse_time*), or ``None`` if no tags were matched.
+
+        Subclasses may override this method to report the parts of parsing
+        separately.
+        '''
+        clock = self.tracer.clock
+        start = clock()
+        message = self._parse(host, line)
+        return (message, clock() - start, None)
+
 class JSONReader(Reader):
     '''
     Network reader, expecting JSON object per line.
@@ -16,10 +16,20 @@ class ConnectionSocket:
     '''
     def accept(self):
         '''
-        Return a connection suitable for ``poll()``.
+        Return a connection suitable for ``poll()``, or ``None`` if there are
+        no more connections waiting.
         '''
         raise NotImplementedError()
 
+    def attach(self, loop):
+        '''
+        :param loop: :class:`seismometer.eventloop.EventLoop` instance
+
+        Notify the socket about the event loop it's polled in (e.g. to
+        schedule timers). Default implementation does nothing.
+        '''
+        pass
+
     def fileno(self):
         '''
         Return a file descriptor.
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+'''
+Carbon pickle protocol
+----------------------
+
+Listening socket compatible with Carbon's pickle receiver (the protocol used
+between ``carbon-relay`` and ``carbon-cache``, and by many collectors for
+bulk sending). The stream is a sequence of frames, each being 4-byte
+big-endian length followed by a pickled list of ``(path, (timestamp,
+value))`` tuples.
+
+Pickles are loaded with globals disabled, so a frame can only contain plain
+data (lists, tuples, strings, numbers); anything else is a protocol error and
+the connection is dropped.
+
+Connections don't split frames into lines. Instead, each frame is returned
+as a single :class:`Samples` instance, so the reader converts the whole
+batch to messages at once (see
+:meth:`seismometer.input.Reader.parse_samples()`).
+
+.. autoclass:: CarbonPickle
+   :members:
+
+.. autoclass:: CarbonConnection
+   :members:
+
+.. autoclass:: Samples
+   :members:
+
+.. autofunction:: safe_loads
+
+'''
+#-----------------------------------------------------------------------------
+
+import struct
+import cPickle
+import cStringIO
+import inet
+
+#-----------------------------------------------------------------------------
+
+MAX_FRAME = 1024 * 1024
+
+def safe_loads(data):
+    '''
+    :param data: pickled data
+    :throws: :exc:`cPickle.UnpicklingError` (among others) on invalid pickle
+        or when the pickle refers to any class or function
+
+    Load pickled data that contains only builtin types.
+    '''
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.find_global = None
+    return unpickler.load()
+
+#-----------------------------------------------------------------------------
+
+class Samples(list):
+    '''
+    Batch of samples decoded from a single frame, as sent by Carbon client:
+    list of ``(path, (timestamp, value))`` tuples. Elements are not
+    validated.
+    '''
+    pass
+
+class Decoder:
+    '''
+    Splitter of Carbon pickle stream into frames.
+    '''
+    def __init__(self, max_frame = MAX_FRAME):
+        '''
+        :param max_frame: maximum allowed frame size
+        '''
+        self.max_frame = max_frame
+        self._chunks = []
+        self._size = 0
+        self._needed = 4 # length of the next frame (with its header)
+
+    def feed(self, data):
+        '''
+        :param data: data read from the stream
+        :return: list of :class:`Samples`
+        :throws: :exc:`ValueError` on protocol error
+
+        Decode all the frames that are complete after adding data.
+        '''
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size < self._needed:
+            return []
+
+        buf = ''.join(self._chunks)
+        result = []
+        pos = 0
+        while len(buf) - pos >= 4:
+            (length,) = struct.unpack(">L", buf[pos:pos + 4])
+            if length > self.max_frame:
+                raise ValueError("frame too large")
+            if len(buf) - pos - 4 < length:
+                break
+            try:
+                samples = safe_loads(buf[pos + 4:pos + 4 + length])
+            except Exception:
+                # pickle errors may be of any type
+                raise ValueError("invalid pickle")
+            if not isinstance(samples, list):
+                raise ValueError("frame is not a list")
+            result.append(Samples(samples))
+            pos += 4 + length
+
+        if pos < len(buf):
+            self._chunks = [buf[pos:]]
+        else:
+            self._chunks = []
+        self._size = len(buf) - pos
+        if self._size >= 4:
+            (length,) = struct.unpack(">L", buf[pos:pos + 4])
+            self._needed = 4 + length
+        else:
+            self._needed = 4
+        return result
+
+#-----------------------------------------------------------------------------
+
+class CarbonPickle(inet.TCP):
+    '''
+    Listening TCP socket for Carbon pickle protocol. Not intended for reading
+    itself, instead returns connection objects (:class:`CarbonConnection`
+    instances).
+
+    Connections are handled the same way as by
+    :class:`seismometer.input.inet.TCP` (connection limit, idle timeout).
+    '''
+    def __init__(self, host, port, max_connections = None,
+                 idle_timeout = None, read_size = 65536,
+                 max_frame = MAX_FRAME):
+        '''
+        :param host: bind address
+        :type host: string or ``None``
+        :param port: bind address
+        :type port: integer
+        :param max_connections: see :class:`seismometer.input.inet.TCP`
+        :param idle_timeout: see :class:`seismometer.input.inet.TCP`
+        :param read_size: maximum number of bytes read from a connection at
+            once
+        :param max_frame: maximum allowed size of a frame; client that sends
+            a larger one gets disconnected
+        '''
+        inet.TCP.__init__(
+            self, host, port,
+            max_connections = max_connections,
+            idle_timeout = idle_timeout,
+            read_size = read_size,
+        )
+        self.max_frame = max_frame
+
+    def _new_connection(self, client, host, port):
+        return CarbonConnection(client, host, port = port,
+                                read_size = self.read_size, server = self,
+                                max_frame = self.max_frame)
+
+class CarbonConnection(inet.TCPConnection):
+    '''
+    Carbon pickle connection reader.
+
+    Instances of this class are created by :class:`CarbonPickle`.
+    '''
+    def __init__(self, conn, host, port = None, read_size = 65536,
+                 server = None, max_frame = MAX_FRAME):
+        '''
+        :param conn: connection descriptor
+        :type conn: socket.socket()
+        :param host: remote end address
+        :type host: string
+        :param port: remote end port
+        :param read_size: maximum number of bytes read at once
+        :param server: :class:`CarbonPickle` instance that accepted the
+            connection
+        :param max_frame: maximum allowed size of a frame
+        '''
+        inet.TCPConnection.__init__(self, conn, host, port = port,
+                                    read_size = read_size, server = server)
+        self._head = None # no wire format negotiation
+        self._frames = Decoder(max_frame)
+
+    def readline(self):
+        '''
+        :return: ``(host, list)`` or ``(host, '')``
+
+        Read complete frames from the connection. Returned list contains
+        :class:`Samples` instance for each frame.
+        '''
+        data = self._recv()
+        if data is None:
+            return (None, None)
+        try:
+            batches = self._frames.feed(data)
+        except ValueError:
+            # protocol error; drop the connection
+            self._drop()
+            return (None, None)
+        if len(batches) == 0:
+            return (self.host, '')
+        for samples in batches:
+            self.lines += len(samples)
+        return (self.host, batches)
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
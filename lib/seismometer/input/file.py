@@ -0,0 +1,450 @@
+#!/usr/bin/python
+'''
+Following files
+---------------
+
+:class:`File` reads lines appended to files, like :command:`tail -F`. Files
+are followed across rotation (the old file is read to its end before the new
+one is opened) and truncation. Changes are noticed with inotify
+(:mod:`seismometer.inotify`), or, where it's not available, by checking the
+files periodically.
+
+All the files matched by a :class:`File` instance are handled with a single
+descriptor in the poll: a pipe that is written to when any of the files has
+new data.
+
+Position in each file can be saved in a :class:`Checkpoint`, so reading
+resumes where it stopped after restart, even if the file was rotated in the
+meantime.
+
+.. autoclass:: File
+   :members:
+
+.. autoclass:: Checkpoint
+   :members:
+
+'''
+#-----------------------------------------------------------------------------
+
+import os
+import glob
+import time
+import json
+import errno
+import fcntl
+import fnmatch
+import logging
+import seismometer.inotify
+import inet
+
+#-----------------------------------------------------------------------------
+
+class Checkpoint:
+    '''
+    Positions in followed files (device, inode, and offset of the first
+    unread line), saved to a JSON file.
+
+    The file is replaced atomically (written to a temporary file and renamed),
+    at most every :obj:`interval` seconds.
+    '''
+    def __init__(self, path, interval = 5):
+        '''
+        :param path: checkpoint file
+        :param interval: minimum interval (in seconds) between saving the
+            checkpoint
+        :throws: :exc:`IOError` or :exc:`ValueError` when the file exists, but
+            can't be read
+        '''
+        self.path = os.path.abspath(path)
+        self.interval = interval
+        self.positions = {} # path => (device, inode, offset)
+        self._changed = False
+        self._last_save = 0
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            data = {}
+        for (name, position) in data.get("files", {}).iteritems():
+            self.positions[name] = tuple(position)
+
+    def get(self, path):
+        '''
+        :return: ``(device, inode, offset)`` or ``None``
+        '''
+        return self.positions.get(path)
+
+    def update(self, path, device, inode, offset):
+        '''
+        Record position in a file.
+        '''
+        position = (device, inode, offset)
+        if self.positions.get(path) != position:
+            self.positions[path] = position
+            self._changed = True
+
+    def remove(self, path):
+        '''
+        Forget position in a file.
+        '''
+        if self.positions.pop(path, None) is not None:
+            self._changed = True
+
+    def save(self, force = False):
+        '''
+        :param force: save the checkpoint even if :obj:`interval` hasn't
+            passed since the last save
+
+        Save the checkpoint if anything changed.
+        '''
+        now = time.time()
+        if not self._changed or not force and \
+           now - self._last_save < self.interval:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"files": self.positions}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self._changed = False
+        self._last_save = now
+
+#-----------------------------------------------------------------------------
+
+class _TailedFile:
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.device = None
+        self.inode = None
+        self.offset = 0
+        self.buffer = inet.LineBuffer()
+
+    def open(self, path, offset):
+        # throws OSError
+        fd = os.open(path, os.O_RDONLY)
+        stat = os.fstat(fd)
+        if offset > stat.st_size:
+            offset = 0 # truncated
+        os.lseek(fd, offset, os.SEEK_SET)
+        self.close()
+        self.fd = fd
+        self.device = stat.st_dev
+        self.inode = stat.st_ino
+        self.offset = offset
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def position(self):
+        # offset of the first line not returned yet
+        return self.offset - self.buffer.pending()
+
+class File:
+    '''
+    Socket-like class for following files matching a pattern.
+
+    Files that exist when the instance is created are read from their end
+    (unless :obj:`from_start` is set or the checkpoint has a position for
+    them); files that appear later are read from the beginning. The pattern
+    is checked for new files every :obj:`poll_interval` seconds and, with
+    inotify, whenever a file is created in a watched directory.
+
+    Readiness and rotation checks are scheduled in an event loop (see
+    :meth:`attach()`).
+    '''
+    def __init__(self, pattern, checkpoint = None, from_start = False,
+                 read_size = 1024 * 1024, poll_interval = 1.0,
+                 use_inotify = True):
+        '''
+        :param pattern: path to file or glob pattern
+        :param checkpoint: :class:`Checkpoint` to store positions in
+        :param from_start: read existing files from the beginning
+        :param read_size: maximum number of bytes read from a single file at
+            once
+        :param poll_interval: interval (in seconds) of checking files for new
+            data and the pattern for new files
+        :param use_inotify: use inotify if it's available
+        '''
+        self.pattern = os.path.abspath(pattern)
+        self.checkpoint = checkpoint
+        self.read_size = read_size
+        self.poll_interval = poll_interval
+        self.files = {}     # path => _TailedFile
+        self._ready = set() # _TailedFile
+        self._finished = [] # last lines of files that were closed
+        self._loop = None
+        (self._wake_r, self._wake_w) = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self.inotify = None
+        if use_inotify and seismometer.inotify.available():
+            try:
+                self.inotify = seismometer.inotify.Inotify()
+            except OSError, e:
+                self.get_logger().warn("inotify unavailable (%s);"
+                                       " polling files instead", e.strerror)
+        self._scan(existing = not from_start)
+
+    def get_logger(self):
+        return logging.getLogger("input.file")
+
+    def fileno(self):
+        return self._wake_r
+
+    def attach(self, loop):
+        '''
+        :param loop: :class:`seismometer.eventloop.EventLoop` instance
+
+        Schedule checking the files in the event loop.
+        '''
+        self._loop = loop
+        if self.inotify is not None:
+            loop.add_reader(self.inotify, self._inotify_events)
+        loop.call_later(self.poll_interval, self._timer)
+        if len(self._ready) > 0:
+            self._wake()
+
+    def close(self):
+        '''
+        Close all the files and save the checkpoint.
+        '''
+        if self._loop is not None and self.inotify is not None:
+            self._loop.remove_reader(self.inotify)
+        for f in self.files.values():
+            self._save_position(f)
+            f.close()
+        self.files.clear()
+        self._ready.clear()
+        if self.inotify is not None:
+            self.inotify.close()
+        if self.checkpoint is not None:
+            self._save_checkpoint(force = True)
+
+    #-------------------------------------------------------------------
+    # noticing changes {{{
+
+    def _timer(self):
+        self._scan()
+        if self.checkpoint is not None:
+            self._save_checkpoint()
+        self._loop.call_later(self.poll_interval, self._timer)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, "x")
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _scan(self, existing = False):
+        # find new files and check the known ones for new data
+        if self.inotify is not None:
+            self._watch_directories()
+        paths = set(glob.glob(self.pattern))
+        for path in paths:
+            if path not in self.files:
+                self._add_file(path, existing)
+        for f in self.files.values():
+            if f.fd is None or self._changed(f):
+                self._ready.add(f)
+        if len(self._ready) > 0 and self._loop is not None:
+            self._wake()
+
+    def _watch_directories(self):
+        directory = os.path.dirname(self.pattern)
+        if glob.has_magic(directory):
+            directories = glob.glob(directory)
+        else:
+            directories = [directory]
+        for d in directories:
+            try:
+                self.inotify.watch(d)
+            except OSError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    self.get_logger().warn("can't watch %s: %s", d,
+                                           e.strerror)
+
+    def _inotify_events(self, handle):
+        scan = False
+        for (directory, name, mask) in self.inotify.read():
+            if directory is None or name is None:
+                # queue overflow or directory itself deleted/moved
+                scan = True
+                continue
+            path = os.path.join(directory, name)
+            f = self.files.get(path)
+            if f is not None:
+                self._ready.add(f)
+            elif fnmatch.fnmatchcase(path, self.pattern):
+                scan = True
+        if scan:
+            self._scan()
+        elif len(self._ready) > 0:
+            self._wake()
+
+    def _changed(self, f):
+        try:
+            stat = os.stat(f.path)
+        except OSError:
+            # file removed; read the rest and close it
+            return True
+        return stat.st_ino != f.inode or stat.st_dev != f.device or \
+               stat.st_size != f.offset
+
+    # }}}
+    #-------------------------------------------------------------------
+    # opening files {{{
+
+    def _add_file(self, path, existing):
+        f = _TailedFile(path)
+        position = None
+        if self.checkpoint is not None:
+            position = self.checkpoint.get(path)
+        try:
+            stat = os.stat(path)
+            if position is not None and \
+               (position[0], position[1]) == (stat.st_dev, stat.st_ino):
+                f.open(path, position[2])
+            elif position is not None:
+                # file was rotated while we weren't running; finish the old
+                # one first, if it can be found
+                rotated = self._find_rotated(path, position[0], position[1])
+                if rotated is not None:
+                    self.get_logger().info("%s was rotated to %s; reading"
+                                           " the rest of it first",
+                                           path, rotated)
+                    f.open(rotated, position[2])
+                else:
+                    f.open(path, 0)
+            elif existing:
+                f.open(path, stat.st_size)
+            else:
+                f.open(path, 0)
+        except OSError, e:
+            self.get_logger().warn("can't open %s: %s", path, e.strerror)
+            return
+        self.get_logger().info("following %s from offset %d", path, f.offset)
+        self.files[path] = f
+        self._ready.add(f)
+
+    @staticmethod
+    def _find_rotated(path, device, inode):
+        # look for the file in the names typical for rotated files:
+        # <path>.1, <path>-20160301, <path>.20160301-120000, ...
+        for candidate in glob.glob(path + ".*") + glob.glob(path + "-*"):
+            try:
+                stat = os.stat(candidate)
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) == (device, inode):
+                return candidate
+        return None
+
+    def _reopen(self, f):
+        # called after the open file was read to its end
+        try:
+            stat = os.stat(f.path)
+        except OSError:
+            # file removed; forget about it until it appears again
+            self.get_logger().info("%s removed", f.path)
+            self._finish(f)
+            del self.files[f.path]
+            if self.checkpoint is not None:
+                self.checkpoint.remove(f.path)
+            return False
+        if (stat.st_dev, stat.st_ino) != (f.device, f.inode):
+            self.get_logger().info("%s rotated; reopening", f.path)
+            self._finish(f)
+            try:
+                f.open(f.path, 0)
+            except OSError, e:
+                self.get_logger().warn("can't open %s: %s", f.path,
+                                       e.strerror)
+                del self.files[f.path]
+                return False
+            return True
+        if stat.st_size < f.offset:
+            self.get_logger().info("%s truncated; reading from start",
+                                   f.path)
+            f.buffer = inet.LineBuffer()
+            os.lseek(f.fd, 0, os.SEEK_SET)
+            f.offset = 0
+            return True
+        return False
+
+    def _finish(self, f):
+        # unterminated last line of the file is a line, too
+        if f.buffer.pending() > 0:
+            f.buffer.add("\n")
+            self._finished.append(f.buffer.get_lines())
+        f.close()
+
+    # }}}
+    #-------------------------------------------------------------------
+    # checkpoint {{{
+
+    def _save_position(self, f):
+        if self.checkpoint is not None and f.fd is not None:
+            self.checkpoint.update(f.path, f.device, f.inode, f.position())
+
+    def _save_checkpoint(self, force = False):
+        try:
+            self.checkpoint.save(force)
+        except (IOError, OSError), e:
+            self.get_logger().warn("can't save checkpoint %s: %s",
+                                   self.checkpoint.path, e)
+
+    # }}}
+    #-------------------------------------------------------------------
+
+    def readline(self):
+        '''
+        :return: ``(None, string)``
+
+        Read complete lines from files that have new data.
+        '''
+        try:
+            os.read(self._wake_r, 4096)
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        self._finished = []
+        result = []
+        ready = list(self._ready)
+        self._ready.clear()
+        for f in ready:
+            if self.files.get(f.path) is not f:
+                continue # removed in the meantime
+            if f.fd is None:
+                continue
+            data = os.read(f.fd, self.read_size)
+            if data == '':
+                if self._reopen(f):
+                    self._ready.add(f) # read the new file
+                if len(self._finished) > 0:
+                    result.extend(self._finished)
+                    self._finished = []
+                continue
+            f.offset += len(data)
+            f.buffer.add(data)
+            if f.buffer.has_lines():
+                result.append(f.buffer.get_lines())
+            if len(data) == self.read_size:
+                self._ready.add(f) # there's probably more
+            self._save_position(f)
+        if len(self._ready) > 0:
+            # come back after other sockets get their turn
+            self._wake()
+        return (None, "\n".join(result))
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -17,9 +17,12 @@ Network sockets: TCP and UDP
 
 import sys
 import os
+import time
+import errno
 import socket
 import seismometer.poll
 import seismometer.message
+import seismometer.wire
 import Queue
 import json
 
@@ -42,6 +45,10 @@ class LineBuffer:
     def has_lines(self):
         return len(self._buffer) > 0 and '\n' in self._buffer[-1]
 
+    def pending(self):
+        # size of the unfinished line
+        return sum(len(c) for c in self._buffer)
+
     def get_lines(self):
         # return all the lines up until last NL; stuff after last NL is an
         # unfinished line, so it forms 
@@ -59,30 +66,124 @@ class TCP(ConnectionSocket):
     Listening TCP socket. Not intended for reading itself, instead returns
     connection objects.
     '''
-    def __init__(self, host, port):
+    def __init__(self, host, port, max_connections = None,
+                 idle_timeout = None, read_size = 16384):
         '''
         :param host: bind address
         :type host: string or ``None``
         :param port: bind address
         :type port: integer
+        :param max_connections: maximum number of clients connected at the
+            same time; connections over the limit are closed right after
+            accepting (``None`` means no limit)
+        :param idle_timeout: number of seconds after which a connection with
+            no incoming data is closed (``None`` means never)
+        :param read_size: maximum number of bytes read from a connection at
+            once
         '''
-        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         if host is not None:
-            self.conn.bind((host, port))
+            conn.bind((host, port))
         else:
-            self.conn.bind(('', port))
+            conn.bind(('', port))
+        self._listen(conn, max_connections, idle_timeout, read_size)
+
+    def _listen(self, conn, max_connections, idle_timeout, read_size):
+        # common part of setting up a listening socket, for this class and
+        # its subclasses for other address families
+        self.conn = conn
         self.conn.listen(256)
+        self.conn.setblocking(False)
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.read_size = read_size
+        self.connections = {} # id(conn) => TCPConnection
+        self.accepted = 0
+        self.rejected = 0
+        self.reaped = 0
+        self._loop = None
+        self._reap_timer = None
+
+    def attach(self, loop):
+        self._loop = loop
+        if self.idle_timeout is not None and self._reap_timer is None:
+            self._reap_timer = loop.call_later(self._reap_interval(),
+                                               self._reap)
 
     def accept(self):
         '''
-        :rtype: :class:`TCPConnection`
+        :rtype: :class:`TCPConnection` or ``None``
 
-        Accept a connection.
+        Accept a connection. ``None`` is returned when there are no more
+        connections waiting.
         '''
-        (client, (host, port)) = self.conn.accept()
+        while True:
+            try:
+                (client, address) = self.conn.accept()
+            except socket.error, e:
+                if e.errno in (errno.EINTR, errno.ECONNABORTED):
+                    continue
+                # EAGAIN, but also EMFILE and similar, which can't be
+                # helped here
+                return None
+            if self.max_connections is not None and \
+               len(self.connections) >= self.max_connections:
+                self.rejected += 1
+                client.close()
+                continue
+            client.setblocking(True)
+            (host, port) = self._setup_client(client, address)
+            self.accepted += 1
+            conn = self._new_connection(client, host, port)
+            self.connections[id(conn)] = conn
+            return conn
+
+    def _setup_client(self, client, address):
+        # returns (host, port) of the client
         client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        return TCPConnection(client, host)
+        return address
+
+    def _new_connection(self, client, host, port):
+        # connection object for a socket that reads other protocols
+        return TCPConnection(client, host, port = port,
+                             read_size = self.read_size, server = self)
+
+    def _forget(self, conn):
+        self.connections.pop(id(conn), None)
+
+    def _reap_interval(self):
+        # check often enough not to keep idle connections much longer than
+        # the timeout
+        return max(self.idle_timeout / 4.0, 0.1)
+
+    def _reap(self):
+        deadline = time.time() - self.idle_timeout
+        for conn in self.connections.values():
+            if conn.last_active < deadline:
+                self.reaped += 1
+                # poll reports EOF on the connection and it gets removed the
+                # usual way
+                conn.shutdown()
+                self._forget(conn)
+        self._reap_timer = self._loop.call_later(self._reap_interval(),
+                                                 self._reap)
+
+    def stats(self):
+        '''
+        :return: dictionary with counters
+
+        Return counters of the socket and its connections. Keys are
+        ``"accepted"``, ``"rejected"`` (over :obj:`max_connections`),
+        ``"reaped"`` (idle), and ``"connections"``, which is a list of
+        dictionaries returned by :meth:`TCPConnection.stats()`.
+        '''
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "reaped": self.reaped,
+            "connections": [c.stats() for c in self.connections.values()],
+        }
 
     def fileno(self):
         return self.conn.fileno()
@@ -92,18 +193,36 @@ class TCPConnection:
     TCP connection reader.
 
     Instances of this class are created by :class:`TCP`.
+
+    If the connection starts with a hello line of binary wire format (see
+    :mod:`seismometer.wire`), the format is negotiated with the sender and
+    the rest of the stream is decoded to messages directly.
     '''
-    def __init__(self, conn, host):
+    def __init__(self, conn, host, port = None, read_size = 16384,
+                 server = None):
         '''
         :param conn: connection descriptor
         :type conn: socket.socket()
         :param host: remote end address
         :type host: string
+        :param port: remote end port
+        :param read_size: maximum number of bytes read at once
+        :param server: :class:`TCP` instance that accepted the connection
         '''
         self.conn = conn
         # TODO: resolve hostname (some cache maybe?)
         self.host = host
+        self.port = port
+        self.read_size = read_size
+        self._server = server
         self._buffer = LineBuffer()
+        self.connected = self.last_active = time.time()
+        self.bytes = 0
+        self.lines = 0
+        # beginning of the stream, until it's known whether it's a hello
+        # line or not (None afterwards)
+        self._head = ""
+        self._decoder = None
 
     def __del__(self):
         self.close()
@@ -112,20 +231,69 @@ class TCPConnection:
         '''
         Close TCP connection.
         '''
+        if self._server is not None:
+            self._server._forget(self)
+            self._server = None
         if self.conn is not None:
             self.conn.close()
             self.conn = None
 
+    def shutdown(self):
+        '''
+        Shut the connection down without closing the descriptor. Reading
+        from the connection returns EOF afterwards.
+        '''
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass # already disconnected
+
+    def stats(self):
+        '''
+        :return: dictionary with counters
+
+        Return counters of the connection: ``"host"``, ``"port"``,
+        ``"bytes"`` and ``"lines"`` (or messages) received, ``"connected"``
+        and ``"last_active"`` timestamps.
+        '''
+        return {
+            "host": self.host,
+            "port": self.port,
+            "bytes": self.bytes,
+            "lines": self.lines,
+            "connected": self.connected,
+            "last_active": self.last_active,
+        }
+
     def readline(self):
         '''
-        :return: ``(host, string)``
+        :return: ``(host, string)`` or ``(host, list)``
 
-        Read complete line (or lines) from the connection.
+        Read complete line (or lines) from the connection. For connections
+        that use binary wire format, list of decoded messages is returned
+        instead.
         '''
-        line = self.conn.recv(16384)
-        if line == '':
+        line = self._recv()
+        if line is None:
             return (None, None)
 
+        try:
+            if self._head is not None:
+                line = self._read_hello(line)
+            if self._decoder is not None:
+                messages = self._decoder.feed(line)
+                self.lines += len(messages)
+                return (self.host, messages)
+        except (ValueError, socket.error):
+            # protocol error or the sender went away before getting the
+            # reply; drop the connection
+            self._drop()
+            return (None, None)
+
+        if line == '':
+            return (self.host, '')
+
+        self.lines += line.count('\n')
         self._buffer.add(line)
         if self._buffer.has_lines():
             return (self.host, self._buffer.get_lines())
@@ -133,6 +301,52 @@ class TCPConnection:
             # tell the caller it's not EOF, but nothing interesting was read
             return (self.host, '')
 
+    def _recv(self):
+        # returns data read or None on EOF
+        try:
+            data = self.conn.recv(self.read_size)
+        except socket.error:
+            data = '' # e.g. connection reset by peer
+        if data == '':
+            self._drop()
+            return None
+        self.bytes += len(data)
+        self.last_active = time.time()
+        return data
+
+    def _drop(self):
+        # the connection is going to be removed from poll by the caller
+        if self._server is not None:
+            self._server._forget(self)
+
+    def _read_hello(self, data):
+        # returns data to be processed further, possibly empty if the stream
+        # beginning is still not known to be (or not to be) a hello line
+        head = self._head + data
+        prefix = seismometer.wire.HELLO_PREFIX
+        if len(head) < len(prefix) and prefix.startswith(head):
+            self._head = head
+            return ''
+        if not head.startswith(prefix):
+            self._head = None
+            return head
+        if '\n' not in head:
+            if len(head) > 256: # not a hello line, after all
+                self._head = None
+                return head
+            self._head = head
+            return ''
+
+        self._head = None
+        (hello, rest) = head.split('\n', 1)
+        (reply, self._decoder) = seismometer.wire.accept_hello(hello)
+        if reply is None:
+            # only starts like a hello line (e.g. "#seismometer-wirex"), so
+            # it's ordinary text input
+            return head
+        self.conn.sendall(reply)
+        return rest
+
     def fileno(self):
         '''
         Return file descriptor for ``poll()``
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+'''
+Shared memory ring reader
+-------------------------
+
+.. autoclass:: SHM
+   :members:
+
+'''
+#-----------------------------------------------------------------------------
+
+import seismometer.ring
+
+#-----------------------------------------------------------------------------
+
+class SHM:
+    '''
+    Receiving end of a shared memory ring buffer (see
+    :mod:`seismometer.ring`). The ring file is created if it doesn't exist.
+
+    Poll reports the socket readable when the producer wakes it up. Messages
+    are returned already decoded.
+    '''
+    def __init__(self, path, size = seismometer.ring.DEFAULT_SIZE,
+                 read_size = 1024 * 1024):
+        '''
+        :param path: path to the ring file
+        :param size: size of the ring (for a newly created file)
+        :param read_size: maximum number of bytes of records read at once
+        '''
+        self.ring = seismometer.ring.Ring(path, seismometer.ring.CONSUMER,
+                                          size = size)
+        self.read_size = read_size
+        self.invalid = 0
+        self._loop = None
+
+    def attach(self, loop):
+        '''
+        :param loop: :class:`seismometer.eventloop.EventLoop` instance
+
+        Schedule periodic check of the ring, in case a wakeup was missed.
+        '''
+        self._loop = loop
+        loop.call_later(1, self._check)
+
+    def _check(self):
+        if self.ring.pending() > 0:
+            self.ring.wake()
+        self._loop.call_later(1, self._check)
+
+    def readline(self):
+        '''
+        :return: ``(None, list)`` or ``(None, '')``
+
+        Read messages from the ring.
+        '''
+        try:
+            payloads = self.ring.read(self.read_size)
+        except ValueError:
+            # the ring was emptied
+            self.invalid += 1
+            payloads = []
+        if not self.ring.wait():
+            # more records (left over or just written); come back for them
+            # after other sockets get their turn
+            self.ring.wake()
+
+        messages = []
+        for payload in payloads:
+            try:
+                messages.append(seismometer.ring.decode(payload))
+            except ValueError:
+                self.invalid += 1
+        if len(messages) == 0:
+            return (None, '')
+        return (None, messages)
+
+    def fileno(self):
+        return self.ring.wakeup_fd
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
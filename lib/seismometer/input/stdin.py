@@ -10,22 +10,47 @@ STDIN input reader
 #-----------------------------------------------------------------------------
 
 import sys
+import os
+import inet
 
 #-----------------------------------------------------------------------------
 
 class STDIN:
     '''
     Socket-like class for reading from standard input.
+
+    Input is read in large chunks with :func:`os.read()` instead of
+    ``sys.stdin.readline()``, which is very slow for long lines (e.g. JSON
+    arrays with batches of messages) and hides buffered data from
+    ``poll()``.
     '''
-    def __init__(self):
-        pass # nothing to do here
+    def __init__(self, read_size = 65536):
+        '''
+        :param read_size: maximum number of bytes read at once
+        '''
+        self.read_size = read_size
+        self._buffer = inet.LineBuffer()
+        self._eof = False
 
     def readline(self):
-        line = sys.stdin.readline()
-        if line == '':
+        '''
+        :return: ``(None, string)``
+
+        Read complete line (or lines) from standard input.
+        '''
+        if self._eof:
             return (None, None)
+        data = os.read(sys.stdin.fileno(), self.read_size)
+        if data == '':
+            # return the unterminated last line (if any) before EOF
+            self._eof = True
+            self._buffer.add('\n')
+            return (None, self._buffer.get_lines())
+        self._buffer.add(data)
+        if self._buffer.has_lines():
+            return (None, self._buffer.get_lines())
         else:
-            return (None, line.strip())
+            return (None, '')
 
     def fileno(self):
         return sys.stdin.fileno()
@@ -6,11 +6,15 @@ UNIX domain sockets
 .. autoclass:: UNIX
    :members:
 
+.. autoclass:: UNIXStream
+   :members:
+
 '''
 #-----------------------------------------------------------------------------
 
 import os
 import socket
+import inet
 
 #-----------------------------------------------------------------------------
 
@@ -41,5 +45,44 @@ class UNIX:
     def fileno(self):
         return self.conn.fileno()
 
+#-----------------------------------------------------------------------------
+
+class UNIXStream(inet.TCP):
+    '''
+    Listening UNIX stream socket. Not intended for reading itself, instead
+    returns connection objects (:class:`seismometer.input.inet.TCPConnection`
+    instances).
+
+    Connections are handled the same way as by
+    :class:`seismometer.input.inet.TCP`, including connection limit, idle
+    timeout, and binary wire format.
+    '''
+    def __init__(self, path, max_connections = None, idle_timeout = None,
+                 read_size = 16384):
+        '''
+        :param path: socket address
+        :type path: string
+        :param max_connections: maximum number of clients connected at the
+            same time (``None`` means no limit)
+        :param idle_timeout: number of seconds after which a connection with
+            no incoming data is closed (``None`` means never)
+        :param read_size: maximum number of bytes read from a connection at
+            once
+        '''
+        self.path = None
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.bind(path)
+        self.path = os.path.abspath(path)
+        self._listen(conn, max_connections, idle_timeout, read_size)
+
+    def __del__(self):
+        self.conn.close()
+        if self.path is not None:
+            os.unlink(self.path)
+
+    def _setup_client(self, client, address):
+        # there's no remote address for messages
+        return (None, None)
+
 #-----------------------------------------------------------------------------
 # vim:ft=python:foldmethod=marker
@@ -18,6 +18,15 @@ Message class
    :members:
    :member-order: groupwise
 
+.. autoclass:: MessageView
+   :members:
+
+Batches of messages
+-------------------
+
+.. autoclass:: MessageBatch
+   :members:
+
 Auxiliary classes
 -----------------
 
@@ -34,10 +43,20 @@ These classes represent specific data inside of :class:`Message`.
 #-----------------------------------------------------------------------------
 
 from time import time as now
+import json
+import gc
+import functools
+from json.encoder import encode_basestring_ascii as _json_string
+
+try:
+    import numpy
+except ImportError:
+    # MessageBatch is not available
+    numpy = None
 
 __all__ = [
     "SCHEMA_VERSION",
-    "Message", "Value", "Location",
+    "Message", "MessageView", "MessageBatch", "Value", "Location",
     "is_valid", "is_metric", "is_state",
 ]
 
@@ -53,6 +72,69 @@ supports  `message schema v3 <http://seismometer.net/message-schema/v3>`_.
 # null
 _NOTHING = "NOT_SPECIFIED"
 
+# JSON encoding for Message.to_json()
+# NOTE: json module falls back to pure Python encoder when sort_keys is set,
+# so the dictionaries are assembled by hand and only scalars are encoded by
+# the json module (C implementation)
+
+_json_sorted = json.JSONEncoder(sort_keys = True).encode
+
+def _json_float(number):
+    if number != number:
+        return "NaN"
+    if number == float("inf"):
+        return "Infinity"
+    if number == -float("inf"):
+        return "-Infinity"
+    return repr(number)
+
+_JSON_SCALARS = {
+    str: _json_string,
+    unicode: _json_string,
+    int: str,
+    long: str,
+    float: _json_float,
+    bool: lambda b: "true" if b else "false",
+    type(None): lambda n: "null",
+}
+
+def _json(obj):
+    '''
+    Encode an object to JSON, the same way as ``json.dumps(obj, sort_keys =
+    True)`` does.
+    '''
+    encode = _JSON_SCALARS.get(type(obj))
+    if encode is None:
+        return _json_sorted(obj)
+    return encode(obj)
+
+def _json_thresholds(thresholds):
+    return "[%s]" % (", ".join([
+        '{"name": %s, "severity": %s, "value": %s}' % (
+            _json(n), _json(s), _json(v)
+        )
+        for (n, (v, s)) in thresholds.iteritems()
+    ]),)
+
+# pickling support for classes with __slots__ (pickle protocols 0 and 1
+# refuse them without __getstate__())
+
+def _slots_getstate(self):
+    state = {}
+    for cls in type(self).__mro__:
+        for name in cls.__dict__.get("__slots__", ()):
+            # slot descriptor, so unset slots don't fall back to
+            # __getattr__() (MessageView loads fields this way)
+            try:
+                state[name] = cls.__dict__[name].__get__(self, cls)
+            except AttributeError:
+                pass
+    return state
+
+def _slots_setstate(self, state):
+    for (name, value) in state.iteritems():
+        object.__setattr__(self, name, value)
+
 #-----------------------------------------------------------------------------
 
 class Value(object):
@@ -66,6 +148,16 @@ class Value(object):
     numerics, other :class:`Value` instances and with ``None``. ``None`` is
     always smaller than any numeric.
     '''
+    __slots__ = (
+        '_name', '_value', '_unit', '_type',
+        # threshold dicts are created on first threshold set
+        '_threshold_low', '_threshold_high',
+        # cached JSON, reset on any change
+        '_json',
+    )
+    __getstate__ = _slots_getstate
+    __setstate__ = _slots_setstate
+
     def __init__(self, value, name = None, unit = None, type = None):
         '''
         :param value: value
@@ -79,21 +171,53 @@ class Value(object):
         self.value = value
         self.unit = unit
         self.type = type
-        self._threshold_low = {}
-        self._threshold_high = {}
+        self._threshold_low = None
+        self._threshold_high = None
+        self._json = None
+
+    @classmethod
+    def _from_trusted_dict(cls, name, value):
+        # constructor for value dict from an already validated message
+        result = cls.__new__(cls)
+        result._name = name
+        result._value = value["value"]
+        result._unit = value.get("unit")
+        result._type = value.get("type")
+        if "threshold_low" in value:
+            result._threshold_low = dict([
+                (thr["name"], (thr["value"], thr["severity"]))
+                for thr in value["threshold_low"]
+            ])
+        else:
+            result._threshold_low = None
+        if "threshold_high" in value:
+            result._threshold_high = dict([
+                (thr["name"], (thr["value"], thr["severity"]))
+                for thr in value["threshold_high"]
+            ])
+        else:
+            result._threshold_high = None
+        result._json = None
+        return result
 
     def copy(self):
         '''
         Deep copy of the instance.
         '''
-        result = Value(
-            self.name,
-            self.value,
-            self.unit,
-            self.type,
-        )
-        result._threshold_low  = self._threshold_low.copy()
-        result._threshold_high = self._threshold_high.copy()
+        result = Value.__new__(Value)
+        result._name  = self._name
+        result._value = self._value
+        result._unit  = self._unit
+        result._type  = self._type
+        if self._threshold_low is not None:
+            result._threshold_low = self._threshold_low.copy()
+        else:
+            result._threshold_low = None
+        if self._threshold_high is not None:
+            result._threshold_high = self._threshold_high.copy()
+        else:
+            result._threshold_high = None
+        result._json = self._json
         return result
 
     def __repr__(self):
@@ -110,18 +234,46 @@ class Value(object):
             result["unit"] = self.unit
         if self.type is not None:
             result["type"] = self.type
-        if len(self._threshold_low) > 0:
+        if self._threshold_low:
             result["threshold_low"] = [
                 {"name": n, "value": v, "severity": s}
                 for (n, (v, s)) in self._threshold_low.iteritems()
             ]
-        if len(self._threshold_high) > 0:
+        if self._threshold_high:
             result["threshold_high"] = [
                 {"name": n, "value": v, "severity": s}
                 for (n, (v, s)) in self._threshold_high.iteritems()
             ]
         return result
 
+    def to_json(self):
+        '''
+        JSON representing the value, equal to ``json.dumps(value.to_dict(),
+        sort_keys = True)``.
+
+        The result is cached until the value is modified.
+        '''
+        if self._json is None:
+            # keys in sorted order
+            result = []
+            if self._threshold_high:
+                result.append(
+                    '"threshold_high": ' +
+                    _json_thresholds(self._threshold_high)
+                )
+            if self._threshold_low:
+                result.append(
+                    '"threshold_low": ' +
+                    _json_thresholds(self._threshold_low)
+                )
+            if self._type is not None:
+                result.append('"type": ' + _json(self._type))
+            if self._unit is not None:
+                result.append('"unit": ' + _json(self._unit))
+            result.append('"value": ' + _json(self._value))
+            self._json = "{%s}" % (", ".join(result),)
+        return self._json
+
     #-----------------------------------------------------------------
 
     @property
@@ -146,6 +298,7 @@ class Value(object):
 
     @value.setter
     def value(self, value):
+        self._json = None
         if value is None:
             self._value = None
         elif isinstance(value, (int, long, float)):
@@ -254,7 +407,10 @@ class Value(object):
             raise ValueError(
                 "invalid severity of threshold %s: %s" % (name, severity)
             )
+        if self._threshold_high is None:
+            self._threshold_high = {}
         self._threshold_high[name] = (value, severity)
+        self._json = None
         return self
 
     def set_below(self, value, name, severity = 'error'):
@@ -275,14 +431,17 @@ class Value(object):
             raise ValueError(
                 "invalid severity of threshold %s: %s" % (name, severity)
             )
+        if self._threshold_low is None:
+            self._threshold_low = {}
         self._threshold_low[name] = (value, severity)
+        self._json = None
         return self
 
     def has_thresholds(self):
         '''
         Check if the value has any thresholds.
         '''
-        return (len(self._threshold_high) + len(self._threshold_low) > 0)
+        return bool(self._threshold_high) or bool(self._threshold_low)
 
     def thresholds(self):
         '''
@@ -293,11 +452,13 @@ class Value(object):
         high for a given name is defined, the other is reported as ``None``.
         '''
         result = []
-        for thr in set(self._threshold_high).union(self._threshold_low):
+        threshold_high = self._threshold_high or {}
+        threshold_low = self._threshold_low or {}
+        for thr in set(threshold_high).union(threshold_low):
             # just the numbers, not severities
-            thr_hi = self._threshold_high.get(thr)
+            thr_hi = threshold_high.get(thr)
             if thr_hi is not None: thr_hi = thr_hi[0]
-            thr_lo = self._threshold_low.get(thr)
+            thr_lo = threshold_low.get(thr)
             if thr_lo is not None: thr_lo = thr_lo[0]
             result.append((thr, thr_lo, thr_hi))
         return result
@@ -309,7 +470,7 @@ class Value(object):
 
         Check which high threshold is exceded (value > threshold).
         '''
-        if self._value is None:
+        if self._value is None or not self._threshold_high:
             return None
 
         above_name = None
@@ -335,7 +496,7 @@ class Value(object):
 
         Check which low threshold is exceded (value < threshold).
         '''
-        if self._value is None:
+        if self._value is None or not self._threshold_low:
             return None
 
         below_name = None
@@ -363,9 +524,12 @@ class Value(object):
 
         Remove threshold (high, low, or both).
         '''
-        if which in ('both', 'above', 'high') and name in self._threshold_high:
+        self._json = None
+        if which in ('both', 'above', 'high') and \
+           self._threshold_high is not None and name in self._threshold_high:
             del self._threshold_high[name]
-        if which in ('both', 'below', 'low') and name in self._threshold_low:
+        if which in ('both', 'below', 'low') and \
+           self._threshold_low is not None and name in self._threshold_low:
             del self._threshold_low[name]
 
     #-----------------------------------------------------------------
@@ -380,10 +544,12 @@ class Value(object):
     @unit.setter
     def unit(self, unit):
         self._unit = unit
+        self._json = None
 
     @unit.deleter
     def unit(self):
         self._unit = None
+        self._json = None
 
     #-----------------------------------------------------------------
 
@@ -402,10 +568,12 @@ class Value(object):
                 "invalid change type for value %s: %s" % (self._name, type)
             )
         self._type = type
+        self._json = None
 
     @type.deleter
     def type(self):
         self._type = None
+        self._json = None
 
     #-----------------------------------------------------------------
 
@@ -416,12 +584,38 @@ class Location(object):
     Dictionary-like object that checks if elements have valid names/types for
     location.
     '''
+    __slots__ = ('_location', '_json')
+    __getstate__ = _slots_getstate
+    __setstate__ = _slots_setstate
+
     def __init__(self, location):
-        self._location = {}
-        if location is not None:
-            # shallow copy that triggers all the checks
-            for l in location:
-                self[l] = location[l]
+        self._json = None
+        if location is None:
+            self._location = {}
+            return
+        if isinstance(location, Location):
+            # already checked
+            self._location = location._location.copy()
+            self._json = location._json
+            return
+        for value in location.values():
+            if not isinstance(value, (str, unicode)):
+                raise ValueError("location must be a string")
+        self._location = dict(location)
+
+    @classmethod
+    def from_validated(cls, location):
+        '''
+        :param location: dictionary with location
+        :type location: dict(str => str)
+
+        Create an instance from a dictionary that is known to be a valid
+        location (e.g. was already checked once), skipping the checks.
+        '''
+        result = cls.__new__(cls)
+        result._location = location.copy()
+        result._json = None
+        return result
 
     def get(self, name, default = None):
         '''
@@ -447,6 +641,7 @@ class Location(object):
         if not isinstance(value, (str, unicode)):
             raise ValueError("location must be a string")
         self._location[name] = value
+        self._json = None
 
     def __delitem__(self, name):
         '''
@@ -454,6 +649,7 @@ class Location(object):
         '''
         if name in self._location:
             del self._location[name]
+            self._json = None
 
     def __contains__(self, name):
         '''
@@ -509,6 +705,19 @@ class Location(object):
         '''
         return self._location.copy()
 
+    def to_json(self):
+        '''
+        Convert the instance to JSON (with sorted keys).
+
+        The result is cached until the location is modified.
+        '''
+        if self._json is None:
+            self._json = "{%s}" % (", ".join([
+                _json(name) + ": " + _json(value)
+                for (name, value) in sorted(self._location.iteritems())
+            ]),)
+        return self._json
+
     def __repr__(self):
         if len(self._location) == 0:
             return "<Location {}>"
@@ -533,6 +742,14 @@ class Message(object):
 
     # TODO: remember other data carried by the message
 
+    __slots__ = (
+        '_v', '_time', '_interval', '_aspect', '_location',
+        '_state', '_severity', '_comment', '_threshold_kept',
+        '_vset',
+    )
+    __getstate__ = _slots_getstate
+    __setstate__ = _slots_setstate
+
     def __init__(self, message = None,
                  time = None, interval = None, aspect = None, location = None,
                  state = None, severity = None, comment = None,
@@ -627,21 +844,61 @@ class Message(object):
         if "threshold_kept" in event:
             self.threshold_kept = event["threshold_kept"]
         if "vset" in event:
-            for (name,value) in event["vset"].iteritems():
-                self[name] = Value(
-                    name = name,
-                    value = value["value"],
-                    unit = value.get("unit"),
-                    type = value.get("type"),
+            self._vset = Message._read_vset(event["vset"])
+
+    @staticmethod
+    def _read_vset(vset):
+        '''
+        Convert value set from an incoming message to a dictionary of
+        :class:`Value` instances.
+        '''
+        result = {}
+        for (name,value) in vset.iteritems():
+            result[name] = Value(
+                name = name,
+                value = value["value"],
+                unit = value.get("unit"),
+                type = value.get("type"),
+            )
+            for thr in value.get("threshold_high", ()):
+                result[name].set_above(
+                    thr["value"], thr["name"], thr["severity"]
                 )
-                for thr in value.get("threshold_high", ()):
-                    self[name].set_above(
-                        thr["value"], thr["name"], thr["severity"]
-                    )
-                for thr in value.get("threshold_low", ()):
-                    self[name].set_below(
-                        thr["value"], thr["name"], thr["severity"]
-                    )
+            for thr in value.get("threshold_low", ()):
+                result[name].set_below(
+                    thr["value"], thr["name"], thr["severity"]
+                )
+        return result
+
+    @classmethod
+    def from_trusted_dict(cls, message):
+        '''
+        :param message: message dictionary, conforming to schema
+
+        Create representation of a message that is known to be valid (e.g.
+        it was already checked once), skipping all the checks. Invalid
+        message results in undefined behaviour.
+        '''
+        event = message["event"]
+        self = cls.__new__(cls)
+        self._v = SCHEMA_VERSION
+        self._time = int(message["time"])
+        self._interval = event.get("interval")
+        self._aspect = event["name"]
+        self._location = Location.from_validated(message["location"])
+        if "state" in event:
+            self._state = event["state"]["value"]
+            self._severity = event["state"].get("severity")
+        else:
+            self._state = None
+            self._severity = None
+        self._comment = event.get("comment")
+        self._threshold_kept = event.get("threshold_kept")
+        self._vset = {}
+        if "vset" in event:
+            for (name, value) in event["vset"].iteritems():
+                self._vset[name] = Value._from_trusted_dict(name, value)
+        return self
 
     #-----------------------------------------------------------------
     # property accessors
@@ -911,14 +1168,22 @@ class Message(object):
         '''
         Return a deep copy of the message instance.
         '''
-        result = Message(
-            time = self.time, interval = self.interval,
-            aspect = self.aspect, location = self._location._location,
-            state = self.state, severity = self.severity,
-            comment = self.comment
-        )
-        for val in self:
-            result[val] = self[val].copy()
+        # all the fields were already checked, so there's no need to go
+        # through the setters
+        result = Message.__new__(Message)
+        result._v = self._v
+        result._time = self._time
+        result._interval = self._interval
+        result._aspect = self._aspect
+        result._location = Location(self._location)
+        result._state = self._state
+        result._severity = self._severity
+        result._comment = self._comment
+        result._threshold_kept = self._threshold_kept
+        result._vset = dict([
+            (name, value.copy())
+            for (name, value) in self._vset.iteritems()
+        ])
         return result
 
     def to_dict(self):
@@ -959,10 +1224,710 @@ class Message(object):
 
         return message
 
+    def to_json(self):
+        '''
+        Create JSON representing the message, equal to
+        ``json.dumps(message.to_dict(), sort_keys = True)``.
+
+        Location and values cache their JSON, so converting a message again
+        (e.g. for another output) only encodes the parts that were modified
+        in the meantime.
+        '''
+        # keys in sorted order
+        event = []
+        if self.comment is not None:
+            event.append('"comment": ' + _json(self.comment))
+        if self.interval is not None:
+            event.append('"interval": ' + _json(self.interval))
+        event.append('"name": ' + _json(self.aspect))
+        if self.state is not None:
+            if self.severity is not None:
+                event.append('"state": {"severity": %s, "value": %s}' % (
+                    _json(self.severity), _json(self.state)
+                ))
+            else:
+                event.append('"state": {"value": %s}' % (_json(self.state),))
+        if self.threshold_kept is not None:
+            event.append('"threshold_kept": ' + _json(self.threshold_kept))
+        if len(self) > 0:
+            vset = self._vset
+            event.append('"vset": {%s}' % (", ".join([
+                _json(name) + ": " + vset[name].to_json()
+                for name in sorted(vset)
+            ]),))
+
+        return '{"event": {%s}, "location": %s, "time": %s, "v": %s}' % (
+            ", ".join(event),
+            self.location.to_json(),
+            _json(self.time),
+            _json(self.v),
+        )
+
     #-----------------------------------------------------------------
 
 #-----------------------------------------------------------------------------
 
+class MessageView(Message):
+    '''
+    Lazy representation of an incoming message, wrapping the message
+    dictionary without copying it.
+
+    Fields are read from the dictionary and checked only on their first
+    access, and :class:`Value` instances are created only when the value set
+    is accessed. This makes the view cheap for consumers that look only at
+    a few fields, e.g. at aspect name, location, and state.
+
+    As long as nothing was modified, :meth:`to_dict()` returns the wrapped
+    dictionary itself. Setting :attr:`aspect` and modifying fields of
+    :attr:`location` is written through to the wrapped dictionary. Any other
+    modification, as well as accessing the value set (since :class:`Value`
+    instances are mutable), makes :meth:`to_dict()` build a new dictionary,
+    just as :class:`Message` does.
+
+    The view owns the wrapped dictionary, so it shouldn't be modified
+    directly after the view was created.
+
+    Errors in the message that are not detected by the constructor are
+    reported with :exc:`ValueError` on the first access to the invalid
+    field.
+    '''
+
+    __slots__ = ('_message', '_dirty')
+
+    def __init__(self, message):
+        '''
+        :param message: message dictionary to wrap
+        '''
+        if not isinstance(message, dict) or \
+           not isinstance(message.get("event"), dict) or "v" not in message:
+            raise ValueError("not a seismometer.message")
+        if message["v"] != 3:
+            raise ValueError("wrong schema version: %s" % (message["v"],))
+        object.__setattr__(self, "_message", message)
+        object.__setattr__(self, "_dirty", False)
+        object.__setattr__(self, "_v", SCHEMA_VERSION)
+
+    #-----------------------------------------------------------------
+    # lazy loading of fields
+
+    # NOTE: fields not loaded yet are unset slots, so reading them falls
+    # back to __getattr__()
+
+    def __getattr__(self, name):
+        loader = MessageView._LOADERS.get(name)
+        if loader is None:
+            raise AttributeError(name)
+        try:
+            loader(self, self._message["event"])
+        except (KeyError, TypeError):
+            raise ValueError("message doesn't conform to schema")
+        return object.__getattribute__(self, name)
+
+    def __setattr__(self, name, value):
+        # underscore fields are only set by property setters, which were
+        # already called at this point
+        if not name.startswith("_"):
+            self._time # load the header, so it doesn't overwrite the change
+            if name != "aspect":
+                object.__setattr__(self, "_dirty", True)
+            elif not self._dirty:
+                self._message["event"]["name"] = value
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        self._time # load the header, so it doesn't overwrite the change
+        object.__setattr__(self, "_dirty", True)
+        object.__delattr__(self, name)
+
+    def _load_header(self, event):
+        # all the scalar fields are loaded at once
+        if "state" in event:
+            state = event["state"]["value"]
+            severity = event["state"].get("severity")
+            if severity not in ('expected', 'warning', 'error', None):
+                raise ValueError("invalid severity: %s" % (severity,))
+        else:
+            state = None
+            severity = None
+        setattr = object.__setattr__
+        setattr(self, "_time", int(self._message["time"]))
+        setattr(self, "_interval", event.get("interval"))
+        setattr(self, "_aspect", event["name"])
+        setattr(self, "_state", state)
+        setattr(self, "_severity", severity)
+        setattr(self, "_comment", event.get("comment"))
+        setattr(self, "_threshold_kept", event.get("threshold_kept"))
+
+    def _load_location(self, event):
+        location = self._message.setdefault("location", {})
+        for value in location.itervalues():
+            if not isinstance(value, (str, unicode)):
+                raise ValueError("location must be a string")
+        # no copy, so changes to location land in the wrapped dictionary
+        result = Location.__new__(Location)
+        result._location = location
+        result._json = None
+        object.__setattr__(self, "_location", result)
+
+    def _load_vset(self, event):
+        if "vset" in event:
+            vset = Message._read_vset(event["vset"])
+        else:
+            vset = {}
+        object.__setattr__(self, "_vset", vset)
+        # values can be modified in place, so the wrapped dictionary can't be
+        # trusted anymore
+        object.__setattr__(self, "_dirty", True)
+
+    _LOADERS = {
+        "_time": _load_header,
+        "_interval": _load_header,
+        "_aspect": _load_header,
+        "_state": _load_header,
+        "_severity": _load_header,
+        "_comment": _load_header,
+        "_threshold_kept": _load_header,
+        "_location": _load_location,
+        "_vset": _load_vset,
+    }
+
+    #-----------------------------------------------------------------
+
+    def to_dict(self):
+        '''
+        Create a dictionary representing the message.
+
+        If the message was not modified, the wrapped dictionary is returned
+        (not a copy).
+        '''
+        if not self._dirty:
+            return self._message
+        return super(MessageView, self).to_dict()
+
+    def to_json(self):
+        '''
+        Create JSON representing the message.
+
+        If the message was not modified, the wrapped dictionary is encoded
+        directly, with keys in no particular order. Otherwise the result is
+        the same as for :meth:`Message.to_json()`.
+        '''
+        if not self._dirty:
+            return json.dumps(self._message)
+        return super(MessageView, self).to_json()
+
+    #-----------------------------------------------------------------
+
+#-----------------------------------------------------------------------------
+
+def _without_gc(function):
+    # building lots of long-lived containers makes the cyclic garbage
+    # collector scan the whole heap over and over again; MessageBatch doesn't
+    # create reference cycles, so collection can wait
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if enabled:
+                gc.enable()
+    return wrapper
+
+class MessageBatch(object):
+    '''
+    Columnar representation of many messages, for bulk processing (rollups,
+    threshold evaluation, backfills). Requires :mod:`numpy`.
+
+    Each field of the messages is stored as an array with one element per
+    message. Aspect names and locations are interned, so the arrays only
+    carry integer IDs. Values are stored as ``float64`` arrays, one per value
+    name, with NaN for ``None`` or for a value missing from a message.
+
+    Note that integer values are converted back to integers on export, but
+    integers that can't be represented exactly as ``float64`` (larger than
+    2\ :sup:`53`) lose precision.
+
+    .. attribute:: time
+
+       epoch timestamps (``int64``)
+
+    .. attribute:: interval
+
+       intervals (``float64``, NaN for ``None``)
+
+    .. attribute:: aspect
+
+       aspect name IDs (``int32``), indices in :attr:`aspects`
+
+    .. attribute:: aspects
+
+       list of aspect names
+
+    .. attribute:: location
+
+       location IDs (``int32``), indices in :attr:`locations`
+
+    .. attribute:: locations
+
+       list of location dictionaries
+
+    .. attribute:: values
+
+       dictionary mapping value name to an array of values (``float64``)
+
+    .. attribute:: present
+
+       dictionary mapping value name to a boolean array telling which
+       messages carry the value (possibly ``None``)
+
+    .. attribute:: thresholds
+
+       dictionary mapping ``(value_name, "high" | "low", threshold_name)`` to
+       a tuple ``(values, severities)``, where ``values`` is an array of
+       threshold values (``float64``, NaN where the threshold is not set) and
+       ``severities`` is an array of indices in :const:`SEVERITIES` (``int8``,
+       ``0`` where the threshold is not set)
+    '''
+
+    SEVERITIES = (None, "warning", "error")
+    '''
+    Threshold severities, indexed by codes used in :attr:`thresholds`.
+    '''
+
+    STATE_SEVERITIES = (None, "expected", "warning", "error")
+    '''
+    State severities, indexed by codes used in :attr:`severity`.
+    '''
+
+    @_without_gc
+    def __init__(self, messages = ()):
+        '''
+        :param messages: list of messages (dictionaries or :class:`Message`
+            instances)
+        :throws: :exc:`ImportError` when :mod:`numpy` is not available,
+            :exc:`ValueError` when a message doesn't conform to schema
+        '''
+        if numpy is None:
+            raise ImportError("MessageBatch requires numpy module")
+
+        self.aspects = []
+        self.locations = []
+        self._aspect_ids = {}
+        self._location_ids = {} # sorted tuple of items => ID
+        # states, units, and types of values
+        self._strings = []
+        self._string_ids = {}
+
+        # column data, converted to arrays at the end
+        time = []
+        interval = []
+        aspect = []
+        location = []
+        state = []
+        severity = []
+        comment = []
+        threshold_kept = []
+        vset = {} # name => ([index], [value dict])
+
+        severity_codes = dict([
+            (sev, code) for (code, sev) in enumerate(self.STATE_SEVERITIES)
+        ])
+        nan = float("nan")
+
+        for (i, message) in enumerate(messages):
+            if isinstance(message, Message):
+                message = message.to_dict()
+            if not is_valid(message):
+                raise ValueError("message doesn't conform to schema")
+            event = message["event"]
+            try:
+                time.append(message["time"])
+                interval.append(event.get("interval", nan))
+                aspect.append(self._intern_aspect(event["name"]))
+                location.append(
+                    self._intern_location(message.get("location", {}))
+                )
+                if "state" in event:
+                    state.append(self._intern(event["state"]["value"]))
+                    severity.append(
+                        severity_codes[event["state"].get("severity")]
+                    )
+                else:
+                    state.append(-1)
+                    severity.append(0)
+                comment.append(event.get("comment"))
+                threshold_kept.append(event.get("threshold_kept"))
+
+                # values are only collected here and converted to columns
+                # later, one value name at a time
+                for (name, value) in event.get("vset", {}).iteritems():
+                    column = vset.get(name)
+                    if column is None:
+                        column = vset[name] = ([], [])
+                    column[0].append(i)
+                    column[1].append(value)
+            except (KeyError, TypeError):
+                raise ValueError("message doesn't conform to schema")
+
+        size = len(time)
+        self.time = numpy.array(time, dtype = numpy.int64)
+        self.interval = numpy.array(interval, dtype = numpy.float64)
+        self.aspect = numpy.array(aspect, dtype = numpy.int32)
+        self.location = numpy.array(location, dtype = numpy.int32)
+        self.state = numpy.array(state, dtype = numpy.int32)
+        self.severity = numpy.array(severity, dtype = numpy.int8)
+        self.comment = _object_array(comment)
+        self.threshold_kept = _object_array(threshold_kept)
+
+        self.values = {}
+        self.present = {}
+        self._ints = {}
+        self._units = {}
+        self._types = {}
+        self.thresholds = {}
+        for (name, (idx, value_dicts)) in vset.iteritems():
+            try:
+                self._add_values(size, name, idx, value_dicts)
+            except (KeyError, TypeError):
+                raise ValueError("message doesn't conform to schema")
+
+    def _add_values(self, size, name, idx, value_dicts):
+        # convert values of a single name to columns
+        values = [v["value"] for v in value_dicts]
+        types = map(type, values)
+        if not _VALUE_TYPES.issuperset(types):
+            raise ValueError("invalid type of value %s" % (name,))
+        nan = float("nan")
+
+        column = self.values[name] = numpy.full(size, nan)
+        column[idx] = [nan if v is None else v for v in values]
+        column = self.present[name] = numpy.zeros(size, dtype = bool)
+        column[idx] = True
+        column = self._ints[name] = numpy.zeros(size, dtype = bool)
+        column[idx] = [t is int or t is long for t in types]
+        for (field, columns) in (("unit", self._units), ("type", self._types)):
+            strings = [v.get(field) for v in value_dicts]
+            ids = dict([(s, self._intern(s)) for s in set(strings)])
+            column = columns[name] = numpy.full(size, -1, dtype = numpy.int32)
+            column[idx] = [ids[s] for s in strings]
+
+        codes = dict([
+            (sev, code) for (code, sev) in enumerate(self.SEVERITIES)
+        ])
+        for which in ("high", "low"):
+            field = "threshold_" + which
+            flat = [
+                (thr["name"], i, thr["value"], codes[thr["severity"]])
+                for (i, value) in zip(idx, value_dicts) if field in value
+                for thr in value[field]
+            ]
+            if len(flat) == 0:
+                continue
+            # typically there are just a few threshold names, so filtering
+            # the list for each of them is fast enough
+            for thr_name in set([thr[0] for thr in flat]):
+                (_, thr_idx, thr_values, sevs) = zip(*[
+                    thr for thr in flat if thr[0] == thr_name
+                ])
+                values = numpy.full(size, nan)
+                values[list(thr_idx)] = thr_values
+                severities = numpy.zeros(size, dtype = numpy.int8)
+                severities[list(thr_idx)] = sevs
+                self.thresholds[(name, which, thr_name)] = (values, severities)
+
+    #-----------------------------------------------------------------
+    # interning {{{
+
+    def _intern(self, string):
+        if string is None:
+            return -1
+        result = self._string_ids.get(string)
+        if result is None:
+            result = self._string_ids[string] = len(self._strings)
+            self._strings.append(string)
+        return result
+
+    def _intern_aspect(self, aspect):
+        result = self._aspect_ids.get(aspect)
+        if result is None:
+            result = self._aspect_ids[aspect] = len(self.aspects)
+            self.aspects.append(aspect)
+        return result
+
+    def _intern_location(self, location):
+        key = tuple(sorted(location.iteritems()))
+        result = self._location_ids.get(key)
+        if result is None:
+            for value in location.itervalues():
+                if not isinstance(value, (str, unicode)):
+                    raise ValueError("location must be a string")
+            result = self._location_ids[key] = len(self.locations)
+            self.locations.append(dict(location))
+        return result
+
+    # }}}
+    #-----------------------------------------------------------------
+    # export {{{
+
+    def __len__(self):
+        '''
+        Return number of messages in the batch.
+        '''
+        return len(self.time)
+
+    @_without_gc
+    def to_dicts(self):
+        '''
+        :return: list of message dictionaries
+
+        Convert the batch back to messages.
+        '''
+        strings = self._strings
+        result = []
+        columns = zip(
+            self.time.tolist(), self.interval.tolist(),
+            self.aspect.tolist(), self.location.tolist(),
+            self.state.tolist(), self.severity.tolist(),
+            self.comment.tolist(), self.threshold_kept.tolist(),
+        )
+        for (time, interval, aspect, location, state, severity, comment,
+             threshold_kept) in columns:
+            event = { "name": self.aspects[aspect] }
+            if state >= 0:
+                event["state"] = { "value": strings[state] }
+                if severity > 0:
+                    event["state"]["severity"] = \
+                        self.STATE_SEVERITIES[severity]
+            if comment is not None:
+                event["comment"] = comment
+            if interval == interval: # not NaN
+                event["interval"] = _as_number(interval)
+            if threshold_kept is not None:
+                event["threshold_kept"] = threshold_kept
+            result.append({
+                "v": SCHEMA_VERSION,
+                "time": time,
+                "location": self.locations[location].copy(),
+                "event": event,
+            })
+
+        for name in self.values:
+            idx = numpy.flatnonzero(self.present[name]).tolist()
+            values = self.values[name][idx].tolist()
+            is_int = self._ints[name][idx].tolist()
+            units = self._units[name][idx].tolist()
+            types = self._types[name][idx].tolist()
+            for (i, value, vint, unit, type) in \
+                zip(idx, values, is_int, units, types):
+                if value != value: # NaN
+                    value = None
+                elif vint:
+                    value = int(value)
+                value = { "value": value }
+                if unit >= 0:
+                    value["unit"] = strings[unit]
+                if type >= 0:
+                    value["type"] = strings[type]
+                result[i]["event"].setdefault("vset", {})[name] = value
+
+        for ((name, which, thr_name), (values, sevs)) in \
+            self.thresholds.iteritems():
+            idx = numpy.flatnonzero(sevs).tolist()
+            for (i, value, sev) in \
+                zip(idx, values[idx].tolist(), sevs[idx].tolist()):
+                threshold = {
+                    "name": thr_name,
+                    "value": _as_number(value),
+                    "severity": self.SEVERITIES[sev],
+                }
+                result[i]["event"]["vset"][name] \
+                    .setdefault("threshold_" + which, []).append(threshold)
+
+        return result
+
+    # }}}
+    #-----------------------------------------------------------------
+    # selecting messages {{{
+
+    def filter(self, selector):
+        '''
+        :param selector: boolean array (mask) or array of indices
+        :rtype: :class:`MessageBatch`
+
+        Create a new batch with the selected messages. Interned aspects and
+        locations are shared with the original batch.
+        '''
+        result = MessageBatch.__new__(MessageBatch)
+        result.aspects = self.aspects
+        result.locations = self.locations
+        result._aspect_ids = self._aspect_ids
+        result._location_ids = self._location_ids
+        result._strings = self._strings
+        result._string_ids = self._string_ids
+        for column in ("time", "interval", "aspect", "location", "state",
+                       "severity", "comment", "threshold_kept"):
+            setattr(result, column, getattr(self, column)[selector])
+        for column in ("values", "present", "_ints", "_units", "_types"):
+            setattr(result, column, dict([
+                (name, array[selector])
+                for (name, array) in getattr(self, column).iteritems()
+            ]))
+        result.thresholds = dict([
+            (key, (values[selector], sevs[selector]))
+            for (key, (values, sevs)) in self.thresholds.iteritems()
+        ])
+        return result
+
+    def matching(self, aspect = None, location = None):
+        '''
+        :param aspect: aspect name
+        :param location: location fields that need to match
+        :type location: dict(str => str)
+        :return: boolean array
+
+        Select messages with specified aspect name and location. Location of
+        a message may contain more fields than specified.
+        '''
+        result = numpy.ones(len(self), dtype = bool)
+        if aspect is not None:
+            if aspect not in self._aspect_ids:
+                return numpy.zeros(len(self), dtype = bool)
+            result &= (self.aspect == self._aspect_ids[aspect])
+        if location:
+            location_ids = [
+                i for (i, loc) in enumerate(self.locations)
+                if all(loc.get(k) == v for (k, v) in location.iteritems())
+            ]
+            result &= numpy.in1d(self.location, location_ids)
+        return result
+
+    def group_by(self, by = ("aspect", "location")):
+        '''
+        :param by: ``"aspect"``, ``"location"``, or both
+        :type by: tuple of strings
+        :return: dictionary mapping group key to array of message indices
+
+        Group messages by aspect name and/or location. Group key is a tuple
+        with aspect name and/or location as a sorted tuple of ``(key,
+        value)`` pairs.
+        '''
+        if len(by) == 0 or not set(by).issubset(("aspect", "location")):
+            raise ValueError("invalid grouping: %s" % (by,))
+        if len(self) == 0:
+            return {}
+        key = numpy.zeros(len(self), dtype = numpy.int64)
+        if "aspect" in by:
+            key += self.aspect
+        if "location" in by:
+            key *= len(self.locations)
+            key += self.location
+        (keys, inverse) = numpy.unique(key, return_inverse = True)
+        order = numpy.argsort(inverse, kind = "mergesort")
+        bounds = numpy.searchsorted(inverse[order], numpy.arange(len(keys)))
+        groups = numpy.split(order, bounds[1:])
+
+        result = {}
+        for (i, group) in enumerate(groups):
+            first = group[0]
+            name = []
+            for field in by:
+                if field == "aspect":
+                    name.append(self.aspects[self.aspect[first]])
+                else:
+                    location = self.locations[self.location[first]]
+                    name.append(tuple(sorted(location.iteritems())))
+            result[tuple(name)] = group
+        return result
+
+    # }}}
+    #-----------------------------------------------------------------
+    # thresholds {{{
+
+    def exceeds(self, name = None):
+        '''
+        :param name: value name; ``None`` means any value
+        :return: boolean array
+
+        Check which messages carry a value that exceeds any of its thresholds.
+        '''
+        result = numpy.zeros(len(self), dtype = bool)
+        for ((value_name, which, thr_name), (thresholds, sevs)) in \
+            self.thresholds.iteritems():
+            if name is not None and value_name != name:
+                continue
+            values = self.values[value_name]
+            # comparisons with NaN are false, so unset thresholds and None
+            # values don't count
+            with numpy.errstate(invalid = "ignore"):
+                if which == "high":
+                    result |= (values > thresholds)
+                else:
+                    result |= (values < thresholds)
+        return result
+
+    def exceeded(self, name):
+        '''
+        :param name: value name
+        :return: list of ``(threshold_name, severity)`` tuples or ``None``
+            values
+
+        Check which threshold is exceeded by the value in each message, the
+        same way as :meth:`Value.exceeds()` does.
+        '''
+        size = len(self)
+        result = [None] * size
+        values = self.values.get(name)
+        if values is None:
+            return result
+        for which in ("low", "high"): # high thresholds take precedence
+            best = numpy.full(size, numpy.nan)
+            best_key = numpy.full(size, -1, dtype = numpy.int32)
+            keys = [
+                key for key in self.thresholds
+                if key[0] == name and key[1] == which
+            ]
+            with numpy.errstate(invalid = "ignore"):
+                for (k, key) in enumerate(keys):
+                    thresholds = self.thresholds[key][0]
+                    # the highest of exceeded high thresholds, the lowest of
+                    # exceeded low thresholds
+                    if which == "high":
+                        hit = (values > thresholds) & \
+                              ~(thresholds <= best)
+                    else:
+                        hit = (values < thresholds) & \
+                              ~(thresholds >= best)
+                    best[hit] = thresholds[hit]
+                    best_key[hit] = k
+            for i in numpy.flatnonzero(best_key >= 0).tolist():
+                key = keys[best_key[i]]
+                severity = self.thresholds[key][1][i]
+                result[i] = (key[2], self.SEVERITIES[severity])
+        return result
+
+    # }}}
+    #-----------------------------------------------------------------
+
+_VALUE_TYPES = set([int, long, float, bool, type(None)])
+
+def _as_number(number):
+    # float that carries an integer is converted to int
+    if isinstance(number, float) and number.is_integer():
+        return int(number)
+    return number
+
+def _object_array(items):
+    # numpy.array() would make a 2D array from a list of lists
+    result = numpy.empty(len(items), dtype = object)
+    for (i, item) in enumerate(items):
+        if item is not None:
+            result[i] = item
+    return result
+
+#-----------------------------------------------------------------------------
+
 def is_valid(message):
     '''
     :param message: object to check
@@ -4,6 +4,11 @@
 
 from input import MessengerReader
 from tags import TagMatcher
+from throttle import FlowLimiter
+from dedup import Deduplicator
+from enrich import Enricher
+from pipeline import Pipeline, Stage
+from tracing import Tracer
 
 #-----------------------------------------------------------------------------
 # vim:ft=python:foldmethod=marker
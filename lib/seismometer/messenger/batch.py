@@ -0,0 +1,233 @@
+#!/usr/bin/python
+'''
+Offline conversion of files
+---------------------------
+
+Converting archives of Graphite plaintext (or any other format accepted by
+:class:`seismometer.messenger.MessengerReader`) doesn't need any of the
+networking machinery. Files are memory-mapped and split into chunks ending
+at line boundaries, and the chunks are parsed in a pool of worker processes,
+each with its own :class:`seismometer.messenger.TagMatcher`.
+
+Results are returned in the order of the input, chunk by chunk. Only
+a limited number of chunks is being converted or waiting to be collected at
+any time, so memory usage doesn't depend on the size of the input.
+
+.. autoclass:: BatchConverter
+   :members:
+
+.. autoclass:: Chunk
+   :members:
+
+.. autofunction:: split_file
+
+'''
+#-----------------------------------------------------------------------------
+
+import os
+import gc
+import mmap
+import json
+import marshal
+import collections
+import multiprocessing
+from input import MessengerReader
+from tags import TagMatcher
+
+__all__ = [
+    'BatchConverter', 'Chunk', 'split_file',
+]
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+#-----------------------------------------------------------------------------
+
+def split_file(path, chunk_size = CHUNK_SIZE):
+    '''
+    :param path: file to split
+    :param chunk_size: approximate size of a chunk (chunks are extended to
+        the end of the line)
+    :return: list of ``(path, start, end)`` tuples
+
+    Split a file into line-aligned chunks.
+    '''
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            # empty files can't be mapped
+            return []
+        mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+        result = []
+        start = 0
+        while start < size:
+            if start + chunk_size >= size:
+                end = size
+            else:
+                newline = mm.find("\n", start + chunk_size - 1)
+                end = size if newline < 0 else newline + 1
+            result.append((path, start, end))
+            start = end
+        return result
+    finally:
+        mm.close()
+
+#-----------------------------------------------------------------------------
+
+class Chunk:
+    '''
+    Result of converting a single chunk of a file.
+
+    .. attribute:: path
+
+       file the chunk comes from
+
+    .. attribute:: lines
+
+       number of non-empty lines in the chunk
+
+    .. attribute:: invalid
+
+       number of lines that couldn't be parsed
+
+    .. attribute:: messages
+
+       number of messages produced
+
+    .. attribute:: data
+
+       JSON lines of the messages (if converter encodes messages) or list of
+       message dictionaries
+    '''
+    def __init__(self, path, lines, invalid, messages, data):
+        self.path = path
+        self.lines = lines
+        self.invalid = invalid
+        self.messages = messages
+        self.data = data
+
+# reader used by a worker process, created by _init_worker()
+_reader = None
+
+def _init_worker(tag_file):
+    global _reader
+    _reader = MessengerReader(TagMatcher(tag_file))
+    # parsing doesn't create reference cycles, and a chunk produces lots of
+    # objects that would make cyclic GC run over and over
+    gc.disable()
+
+def _convert_chunk((path, start, end, encode)):
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+        lines = mm[start:end].split("\n")
+    finally:
+        mm.close()
+
+    parse_line = _reader.parse_line
+    dumps = json.dumps
+    result = []
+    count = 0
+    invalid = 0
+    for line in lines:
+        if line == "":
+            continue
+        count += 1
+        try:
+            message = parse_line(None, line)
+        except ValueError:
+            # a single bad line shouldn't abort converting the whole file
+            message = None
+        if message is None:
+            invalid += 1
+        elif isinstance(message, list):
+            if encode:
+                result.extend([dumps(m) + "\n" for m in message])
+            else:
+                result.extend(message)
+        elif encode:
+            result.append(dumps(message) + "\n")
+        else:
+            result.append(message)
+
+    if encode:
+        return Chunk(path, count, invalid, len(result), "".join(result))
+    # pickling that many dicts on the way to the parent process would take
+    # longer than parsing them
+    return Chunk(path, count, invalid, len(result), marshal.dumps(result))
+
+def _load_messages(data):
+    # the same problem with cyclic GC as in worker processes
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return marshal.loads(data)
+    finally:
+        if enabled:
+            gc.enable()
+
+#-----------------------------------------------------------------------------
+
+class BatchConverter:
+    '''
+    Converter of files to Seismometer messages, working in a pool of
+    processes.
+    '''
+    def __init__(self, tag_file = None, processes = None,
+                 chunk_size = CHUNK_SIZE, encode = True):
+        '''
+        :param tag_file: tag patterns file for
+            :class:`seismometer.messenger.TagMatcher`
+        :param processes: number of worker processes (defaults to number of
+            CPUs)
+        :param chunk_size: approximate size of a chunk of a file processed
+            at once
+        :param encode: if ``True``, converted messages are returned as JSON
+            lines (encoded in workers), otherwise as dictionaries
+        '''
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.encode = encode
+        # chunks being converted or waiting to be collected
+        self.window = 2 * processes
+        self.pool = multiprocessing.Pool(processes, _init_worker, (tag_file,))
+
+    def close(self):
+        '''
+        Stop worker processes.
+        '''
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def convert(self, paths):
+        '''
+        :param paths: list of files to convert
+        :return: iterator of :class:`Chunk` objects, in the order of files
+            and of chunks in each file
+        :throws: :exc:`IOError` or :exc:`OSError` when a file can't be read
+
+        Convert files to messages.
+        '''
+        pending = collections.deque()
+        for path in paths:
+            for (path, start, end) in split_file(path, self.chunk_size):
+                if len(pending) >= self.window:
+                    yield self._collect(pending.popleft())
+                pending.append(self.pool.apply_async(
+                    _convert_chunk, ((path, start, end, self.encode),)
+                ))
+        while len(pending) > 0:
+            yield self._collect(pending.popleft())
+
+    def _collect(self, result):
+        chunk = result.get()
+        if not self.encode:
+            chunk.data = _load_messages(chunk.data)
+        return chunk
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -0,0 +1,519 @@
+#!/usr/bin/python
+'''
+Cache of the latest message of each flow (aspect name and location), with
+a query interface on a UNIX socket.
+
+Query protocol
+--------------
+
+Client connects to the socket and sends a query as a single line of JSON
+object. Server responds with matching messages, one JSON per line, followed
+by a line ``{"end": true, "count": N}`` (or ``{"error": "..."}`` if the query
+was invalid). Several queries can be sent over a single connection; they are
+answered in order.
+
+Query object may contain following keys:
+
+* ``"aspect"`` -- aspect name equal to this one
+* ``"prefix"`` -- aspect name starting with this string
+* ``"location"`` -- object with location fields the message's location needs
+  to contain (message can have more fields)
+* ``"exact"`` -- if ``true``, message's location needs to be equal to
+  ``"location"`` (requires ``"aspect"``)
+* ``"limit"`` -- maximum number of messages to return
+
+Aspect name, prefix, and location fields and values are strings, and limit
+is a non-negative integer; queries with values of other types are invalid.
+
+Query with no conditions returns all the cached messages. Example::
+
+   {"aspect": "cpu.user", "location": {"host": "web1"}, "exact": true}
+   {"prefix": "disk.", "location": {"host": "db2"}}
+   {"location": {"datacenter": "dc1"}, "limit": 100}
+
+Large answers are sent in parts between reading messages, so a query doesn't
+stop *messenger* from forwarding messages.
+
+.. autoclass:: LastValueCache
+   :members:
+
+.. autoclass:: CacheServer
+   :members:
+
+.. autofunction:: query
+
+'''
+#-----------------------------------------------------------------------------
+
+import os
+import time
+import json
+import errno
+import socket
+import marshal
+import itertools
+import seismometer.message
+from seismometer.output.routing import message_aspect, message_location
+
+#-----------------------------------------------------------------------------
+
+class LastValueCache:
+    '''
+    Bounded cache of the latest message of each flow.
+
+    Messages are kept in two generations of at most :obj:`max_flows` / 2
+    entries each, like in :class:`seismometer.messenger.throttle.FlowLimiter`.
+    When the current generation fills up (or, with :obj:`ttl`, gets older
+    than :obj:`ttl`), the older one is discarded, so flows that haven't sent
+    anything recently are forgotten. Messages older than :obj:`ttl` are not
+    returned by queries.
+
+    Flows are indexed by aspect name and by each location field. Discarded
+    flows are removed from indexes (and freed) a few at a time when new flows
+    are added, so the cost of adding a message doesn't depend on the size of
+    the cache.
+
+    Messages are stored serialized with :mod:`marshal`, which takes several
+    times less memory than dictionaries and leaves the cached messages out of
+    garbage collector's scans.
+
+    The cache is an output for :class:`seismometer.output.Writer`.
+    '''
+
+    # discarded flows removed per new flow; with more than one, the older
+    # generation is removed before the current one fills
+    REMOVE_STEP = 2
+
+    def __init__(self, max_flows = 1000000, ttl = None):
+        '''
+        :param max_flows: maximum number of flows to keep
+        :param ttl: time (in seconds) after which a message is considered
+            stale (``None`` means never)
+        '''
+        self.max_flows = max_flows
+        self.ttl = ttl
+        self._current = {}  # flow => (marshalled message, receive_time)
+        self._previous = {} # older generation
+        self._generation_start = time.time()
+        self._by_aspect = {}    # aspect => set(flow)
+        self._by_location = {}  # (field, value) => set(flow)
+        self._discarded = {}    # generation being removed
+
+    def __len__(self):
+        '''
+        Return (approximate) number of cached flows.
+        '''
+        return len(self._current) + len(self._previous)
+
+    #-------------------------------------------------------------------
+    # updates {{{
+
+    def update(self, message, now = None):
+        '''
+        :param message: message dictionary or
+            :class:`seismometer.message.Message`
+        :param now: receive time of the message (defaults to current time)
+
+        Record the message as the latest one of its flow. Messages without
+        aspect name, with unhashable location values, or with values that
+        can't be serialized are ignored.
+        '''
+        if isinstance(message, seismometer.message.Message):
+            message = message.to_dict()
+        aspect = message_aspect(message)
+        if aspect is None:
+            return
+        if now is None:
+            now = time.time()
+        try:
+            flow = (aspect, tuple(sorted(message_location(message).iteritems())))
+            hash(flow)
+            entry = (marshal.dumps(message), now)
+        except (TypeError, ValueError):
+            return
+
+        if flow in self._current:
+            self._current[flow] = entry
+            return
+
+        if len(self._current) >= self.max_flows / 2 or \
+           self.ttl is not None and \
+           now - self._generation_start >= self.ttl:
+            self._rotate(now)
+
+        if self._previous.pop(flow, None) is None:
+            # new flow
+            self._index(flow)
+            for i in xrange(min(self.REMOVE_STEP, len(self._discarded))):
+                self._drop_index(self._discarded.popitem()[0])
+        self._current[flow] = entry
+
+    def _rotate(self, now):
+        # finish removing the generation discarded previously (only left
+        # when rotations were caused by TTL)
+        while len(self._discarded) > 0:
+            self._drop_index(self._discarded.popitem()[0])
+        self._discarded = self._previous
+        self._previous = self._current
+        self._current = {}
+        self._generation_start = now
+
+    def _index(self, flow):
+        (aspect, location) = flow
+        flows = self._by_aspect.get(aspect)
+        if flows is None:
+            flows = self._by_aspect[aspect] = set()
+        flows.add(flow)
+        for pair in location:
+            flows = self._by_location.get(pair)
+            if flows is None:
+                flows = self._by_location[pair] = set()
+            flows.add(flow)
+
+    def _drop_index(self, flow):
+        if flow in self._current or flow in self._previous:
+            # the flow came back after its generation was discarded
+            return
+        (aspect, location) = flow
+        flows = self._by_aspect[aspect]
+        flows.discard(flow)
+        if len(flows) == 0:
+            del self._by_aspect[aspect]
+        for pair in location:
+            flows = self._by_location[pair]
+            flows.discard(flow)
+            if len(flows) == 0:
+                del self._by_location[pair]
+
+    # }}}
+    #-------------------------------------------------------------------
+    # queries {{{
+
+    def _entry(self, flow, now):
+        entry = self._current.get(flow)
+        if entry is None:
+            entry = self._previous.get(flow)
+            if entry is None:
+                return None
+        if self.ttl is not None and now - entry[1] > self.ttl:
+            return None
+        return entry
+
+    def get(self, aspect, location):
+        '''
+        :param aspect: aspect name
+        :param location: location dictionary
+        :return: message dictionary or ``None``
+
+        Get the latest message of a flow.
+        '''
+        try:
+            flow = (aspect, tuple(sorted(location.iteritems())))
+            entry = self._entry(flow, time.time())
+        except (AttributeError, TypeError):
+            return None
+        if entry is None:
+            return None
+        return marshal.loads(entry[0])
+
+    def query(self, aspect = None, prefix = None, location = None,
+              exact = False):
+        '''
+        :param aspect: aspect name
+        :param prefix: prefix of aspect name
+        :param location: dictionary of location fields the message needs to
+            have
+        :param exact: whether message's location needs to be equal to
+            :obj:`location`
+        :return: iterator of message dictionaries
+        :throws: :exc:`ValueError` on invalid query
+
+        Find the latest messages of flows matching all the conditions given.
+        Flows to check are taken from the smallest index matching the query.
+
+        The iterator doesn't break when messages are added to the cache while
+        it's used; flows added in the meantime are not returned.
+        '''
+        if aspect is not None and not isinstance(aspect, (str, unicode)):
+            raise ValueError("aspect name is not a string")
+        if prefix is not None and not isinstance(prefix, (str, unicode)):
+            raise ValueError("prefix is not a string")
+        if location is not None and \
+           (not isinstance(location, dict) or
+            not all(isinstance(k, (str, unicode)) and
+                    isinstance(v, (str, unicode))
+                    for (k, v) in location.iteritems())):
+            raise ValueError("location is not an object with strings")
+        if exact:
+            if aspect is None:
+                raise ValueError("exact query needs an aspect name")
+            message = self.get(aspect, location or {})
+            return iter([message] if message is not None else [])
+
+        fields = set((location or {}).iteritems())
+        candidates = [self._by_location.get(f, ()) for f in fields]
+        if aspect is not None:
+            candidates.append(self._by_aspect.get(aspect, ()))
+        if prefix is not None:
+            aspects = [
+                flows for (name, flows) in self._by_aspect.iteritems()
+                if name.startswith(prefix)
+            ]
+            candidates.append(_Union(aspects))
+
+        if len(candidates) > 0:
+            flows = list(min(candidates, key = len))
+        else:
+            flows = self._current.keys() + self._previous.keys()
+        return self._matching(flows, aspect, prefix, fields)
+
+    def _matching(self, flows, aspect, prefix, fields):
+        now = time.time()
+        for flow in flows:
+            if aspect is not None and flow[0] != aspect:
+                continue
+            if prefix is not None and not flow[0].startswith(prefix):
+                continue
+            if fields and not fields.issubset(flow[1]):
+                continue
+            entry = self._entry(flow, now)
+            if entry is not None:
+                yield marshal.loads(entry[0])
+
+    # }}}
+    #-------------------------------------------------------------------
+    # output interface {{{
+
+    def send(self, message):
+        self.update(message)
+
+    def send_batch(self, messages):
+        now = time.time()
+        for message in messages:
+            self.update(message, now)
+
+    def flush(self):
+        return False
+
+    # }}}
+    #-------------------------------------------------------------------
+
+class _Union:
+    '''
+    Sum of several sets, for picking the smallest one of query candidates.
+    '''
+    def __init__(self, sets):
+        self.sets = sets
+
+    def __len__(self):
+        return sum(len(s) for s in self.sets)
+
+    def __iter__(self):
+        return itertools.chain(*self.sets)
+
+#-----------------------------------------------------------------------------
+
+class CacheServer:
+    '''
+    UNIX stream socket answering queries to :class:`LastValueCache` (see
+    `Query protocol`_).
+    '''
+    def __init__(self, cache, path, chunk_size = 1000):
+        '''
+        :param cache: :class:`LastValueCache` instance
+        :param path: socket address
+        :param chunk_size: number of messages sent to a client at once before
+            other events are handled
+        '''
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.path = None
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.path = os.path.abspath(path)
+        self.socket.listen(16)
+        self.socket.setblocking(False)
+        self.clients = set()
+        self._loop = None
+
+    def __del__(self):
+        self.close()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def attach(self, loop):
+        '''
+        :param loop: :class:`seismometer.eventloop.EventLoop` instance
+
+        Start accepting queries in the event loop.
+        '''
+        self._loop = loop
+        loop.add_reader(self, self._accept, background = True)
+
+    def close(self):
+        '''
+        Close the socket and all the client connections.
+        '''
+        for client in list(self.clients):
+            self._disconnect(client)
+        if self.path is not None:
+            self.socket.close()
+            os.unlink(self.path)
+            self.path = None
+
+    def _accept(self, handle):
+        try:
+            (conn, addr) = self.socket.accept()
+        except socket.error:
+            return
+        conn.setblocking(False)
+        client = _CacheClient(conn)
+        self.clients.add(client)
+        self._loop.add_reader(client, self._read, background = True)
+
+    def _disconnect(self, client):
+        self._loop.remove_reader(client)
+        self.clients.discard(client)
+        client.close()
+
+    def _read(self, client):
+        try:
+            data = client.conn.recv(4096)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ""
+        if data == "":
+            # client may only have closed its side of the connection; answer
+            # its queries first
+            self._loop.remove_reader(client)
+            client.eof = True
+            if client.buffer.strip() != "":
+                client.requests.append(client.buffer)
+            client.buffer = ""
+        client.buffer += data
+        while "\n" in client.buffer:
+            (line, client.buffer) = client.buffer.split("\n", 1)
+            if line.strip() != "":
+                client.requests.append(line)
+        if not client.busy:
+            self._pump(client)
+
+    def _start_query(self, client, line):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("query is not an object")
+            limit = request.get("limit")
+            if limit is not None and \
+               (not isinstance(limit, (int, long)) or
+                isinstance(limit, bool) or limit < 0):
+                raise ValueError("limit is not a non-negative integer")
+            results = self.cache.query(
+                aspect = request.get("aspect"),
+                prefix = request.get("prefix"),
+                location = request.get("location"),
+                exact = bool(request.get("exact")),
+            )
+        except (ValueError, TypeError), e:
+            client.output.append(json.dumps({"error": str(e)}) + "\n")
+            return
+        if limit is not None:
+            results = itertools.islice(results, limit)
+        client.results = results
+        client.count = 0
+
+    def _pump(self, client):
+        client.busy = False
+        if client.conn is None:
+            return # disconnected in the meantime
+        # fill output with the next chunk of results
+        while len(client.output) == 0:
+            if client.results is None:
+                if len(client.requests) == 0:
+                    # all answered
+                    if client.eof:
+                        self._disconnect(client)
+                    return
+                self._start_query(client, client.requests.pop(0))
+                continue
+            chunk = [
+                json.dumps(m) + "\n"
+                for m in itertools.islice(client.results, self.chunk_size)
+            ]
+            client.count += len(chunk)
+            if len(chunk) < self.chunk_size:
+                chunk.append(json.dumps({"end": True, "count": client.count}) +
+                             "\n")
+                client.results = None
+            client.output = chunk
+        data = "".join(client.output)
+        try:
+            sent = client.conn.send(data)
+        except socket.error, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self._disconnect(client)
+                return
+            sent = 0
+        if sent < len(data):
+            client.output = [data[sent:]]
+            # client doesn't keep up; try again a little later
+            client.busy = True
+            self._loop.call_later(0.01, self._pump, client)
+            return
+        client.output = []
+        if client.results is not None or len(client.requests) > 0:
+            # more to send, as soon as pending input is handled
+            client.busy = True
+            self._loop.call_later(0, self._pump, client)
+        elif client.eof:
+            self._disconnect(client)
+
+class _CacheClient:
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = ""
+        self.requests = []  # lines with queries to answer
+        self.results = None # iterator of the query being answered
+        self.count = 0
+        self.output = []
+        self.busy = False   # whether sending the rest is scheduled
+        self.eof = False
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+#-----------------------------------------------------------------------------
+
+def query(path, **request):
+    '''
+    :param path: address of :class:`CacheServer` socket
+    :param request: query (see `Query protocol`_)
+    :return: iterator of message dictionaries
+    :throws: :exc:`ValueError` when the query was rejected,
+        :exc:`socket.error`
+
+    Query a cache of a running *messenger*.
+    '''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        conn.sendall(json.dumps(request) + "\n")
+        for line in conn.makefile():
+            reply = json.loads(line)
+            if "error" in reply:
+                raise ValueError(reply["error"])
+            if reply.get("end"):
+                return
+            yield reply
+    finally:
+        conn.close()
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -0,0 +1,291 @@
+#!/usr/bin/python
+'''
+Suppressing duplicate messages, e.g. ones received from two redundant relays.
+
+Message is identified by a 64-bit fingerprint of its aspect name, location,
+time, values, and state. Fingerprints seen recently are kept in a chain of
+Bloom filters, each covering a part of the deduplication window; the oldest
+filter is discarded when a new one is started. A filter is started early
+when the current one holds as many fingerprints as it was sized for, so
+memory use stays fixed and false positive rate stays within the limit even
+if more messages arrive than expected (the window becomes shorter then).
+
+Bloom filters are blocked: bits of a fingerprint are set in two 64-bit
+words, so checking a fingerprint against a filter takes two lookups. Such
+filter needs 20% to 50% more memory than the classic one for the same false
+positive rate (more for lower rates); filters are sized with this taken
+into account.
+
+.. autoclass:: Deduplicator
+   :members:
+
+.. autofunction:: fingerprint
+
+'''
+#-----------------------------------------------------------------------------
+
+import time
+import math
+import array
+import random
+import logging
+import seismometer.rate_limit
+
+#-----------------------------------------------------------------------------
+
+_MASK64 = 0xffffffffffffffff
+
+def fingerprint(message):
+    '''
+    :param message: message dictionary
+    :return: 64-bit integer or ``None`` if the message can't be fingerprinted
+        (e.g. its location contains lists)
+
+    Compute fingerprint of a message. Equal messages have equal fingerprints
+    within a process, but not necessarily across different processes.
+    '''
+    event = message.get("event")
+    if not isinstance(event, dict):
+        return None
+    # list.sort() and no helper functions: this is called for every message
+    vset = event.get("vset")
+    if isinstance(vset, dict):
+        values = [
+            (name, value.get("value") if isinstance(value, dict) else value)
+            for (name, value) in vset.iteritems()
+        ]
+        values.sort()
+        values = tuple(values)
+    else:
+        values = None
+    state = event.get("state")
+    if isinstance(state, dict):
+        state = (state.get("value"), state.get("severity"))
+    location = message.get("location")
+    if isinstance(location, dict):
+        location = location.items()
+        location.sort()
+        location = tuple(location)
+    try:
+        h = hash((
+            event.get("name"), location, message.get("time"), values, state,
+        )) & _MASK64
+    except TypeError:
+        # unhashable values
+        return None
+    # tuple hash is weak in low bits; mix it (MurmurHash3 finalizer)
+    h = ((h ^ (h >> 33)) * 0xff51afd7ed558ccd) & _MASK64
+    h = ((h ^ (h >> 33)) * 0xc4ceb9fe1a85ec53) & _MASK64
+    return h ^ (h >> 33)
+
+#-----------------------------------------------------------------------------
+
+def _blocked_error_rate(bits_per_item, hashes):
+    # false positive rate of a Bloom filter with items setting `hashes' bits
+    # in each of two independent 64-bit words; number of items hitting
+    # a word follows Poisson distribution
+    load = 2 * 64.0 / bits_per_item
+    term = math.exp(-load)
+    total = 0.0
+    for items in xrange(1, int(load + 10 * math.sqrt(load) + 20)):
+        term *= load / items
+        total += term * (1 - (63.0 / 64) ** (hashes * items)) ** hashes
+    return total ** 2
+
+def _filter_size(error_rate):
+    # (bits per item, bits per word) with the least memory for the error rate
+    best = None
+    for hashes in xrange(1, 17):
+        (low, high) = (1.0, 1024.0)
+        if _blocked_error_rate(high, hashes) > error_rate:
+            continue
+        while high - low > 0.05:
+            middle = (low + high) / 2
+            if _blocked_error_rate(middle, hashes) <= error_rate:
+                high = middle
+            else:
+                low = middle
+        if best is None or high < best[0]:
+            best = (high, hashes)
+    return best
+
+class Deduplicator:
+    '''
+    Stage for :class:`seismometer.messenger.pipeline.Pipeline` that drops
+    messages already seen within a time window.
+
+    The window is split into :obj:`generations` parts, each with its own
+    Bloom filter sized for :obj:`rate` messages per second. Fingerprints are
+    kept for at least :obj:`window` seconds, and at most one part longer.
+    Time is the time messages arrived, not the time they carry.
+
+    False positive rate (chance that a message seen for the first time is
+    dropped) is split evenly among the filters. It's the probability for
+    full filters; it's lower while they fill up.
+    '''
+    # number of bits of fingerprint used for picking a word's mask
+    MASK_BITS = 16
+
+    def __init__(self, window = 60, rate = 100000, error_rate = 0.001,
+                 generations = 4):
+        '''
+        :param window: time (seconds) to remember messages for
+        :param rate: expected number of unique messages per second
+        :param error_rate: acceptable false positive rate
+        :param generations: number of parts the window is split into
+        :throws: :exc:`ValueError` when :obj:`error_rate` is too small
+        '''
+        self.window = window
+        self.rate = rate
+        self.error_rate = error_rate
+        self.generations = generations
+        self.span = float(window) / generations
+        self.capacity = max(int(rate * self.span), 1)
+
+        size = _filter_size(error_rate / (generations + 1))
+        if size is None:
+            raise ValueError("error rate too small: %g" % (error_rate,))
+        (bits_per_item, self.hashes) = size
+        self.words = max(int(math.ceil(bits_per_item * self.capacity / 64)), 2)
+
+        rng = random.Random(self.hashes)
+        self._masks = array.array('L')
+        for i in xrange(1 << self.MASK_BITS):
+            mask = 0
+            for bit in rng.sample(xrange(64), self.hashes):
+                mask |= 1 << bit
+            self._masks.append(mask)
+
+        # newest first
+        self._filters = [self._new_filter()]
+        self._count = 0 # fingerprints in the newest filter
+        self._rotate_at = time.time() + self.span
+        self.estimated_error_rate = 0.0
+        self.duplicates = 0
+        self.dropped = seismometer.rate_limit.RateLimit(
+            duplicates = 0,
+            early_rotations = 0,
+        )
+
+    def _new_filter(self):
+        return array.array('L', [0]) * self.words
+
+    def memory(self):
+        '''
+        :return: number of bytes taken by the filters once the whole window
+            is covered
+        '''
+        return self.words * 8 * (self.generations + 1)
+
+    def stats(self):
+        '''
+        :return: dictionary with keys ``"window"``, ``"capacity"`` (number of
+            fingerprints per filter), ``"filters"``, ``"memory"``,
+            ``"error_rate"`` (configured), ``"estimated_error_rate"`` (of the
+            last full filter), and ``"duplicates"`` (dropped so far)
+        '''
+        return {
+            "window": self.window,
+            "capacity": self.capacity,
+            "filters": len(self._filters),
+            "memory": self.memory(),
+            "error_rate": self.error_rate,
+            "estimated_error_rate": self.estimated_error_rate,
+            "duplicates": self.duplicates,
+        }
+
+    def _rotate(self, now):
+        self.estimated_error_rate = self._estimate_error_rate(self._filters[0])
+        # skip the parts of window with no messages at all (early rotation
+        # happens before the current part ends)
+        expired = max(int((now - self._rotate_at) / self.span) + 1, 1)
+        expired = min(expired, self.generations + 1)
+        for i in xrange(expired):
+            self._filters.insert(0, self._new_filter())
+        del self._filters[self.generations + 1:]
+        self._count = 0
+        self._rotate_at = now + self.span
+
+    def _estimate_error_rate(self, words, samples = 4096):
+        # chance that all the bits of a mask are set, averaged over a sample
+        # of blocks, for each of the filters in the window
+        rng = random.Random(0)
+        total = 0.0
+        for i in xrange(samples):
+            ones = bin(words[rng.randrange(len(words))]).count("1")
+            total += (ones / 64.0) ** self.hashes
+        return min((total / samples) ** 2 * (self.generations + 1), 1.0)
+
+    def process(self, messages):
+        '''
+        :param messages: list of message dictionaries
+        :return: list of messages not seen before
+
+        Drop messages that were already seen within the window.
+        '''
+        now = time.time()
+        if now >= self._rotate_at:
+            self._rotate(now)
+
+        masks = self._masks
+        bits = self.MASK_BITS
+        index_mask = (1 << bits) - 1
+        filters = self._filters
+        current = filters[0]
+        words = self.words
+        count = self._count
+        result = []
+        duplicates = 0
+        for message in messages:
+            h = fingerprint(message)
+            if h is None:
+                result.append(message)
+                continue
+            block1 = (h >> 32) % words
+            block2 = (((h * 0x9e3779b97f4a7c15) & _MASK64) >> 32) % words
+            mask1 = masks[h & index_mask]
+            mask2 = masks[(h >> bits) & index_mask]
+            for f in filters:
+                if f[block1] & mask1 == mask1 and f[block2] & mask2 == mask2:
+                    duplicates += 1
+                    break
+            else:
+                current[block1] |= mask1
+                current[block2] |= mask2
+                result.append(message)
+                count += 1
+                if count >= self.capacity:
+                    # more messages than the filter was sized for
+                    self.dropped.early_rotations += 1
+                    self._rotate(now)
+                    filters = self._filters
+                    current = filters[0]
+                    count = 0
+        self._count = count
+
+        if duplicates > 0:
+            self.duplicates += duplicates
+            self.dropped.duplicates += duplicates
+        self._report()
+        return result
+
+    def _report(self):
+        if self.dropped.duplicates == 0 and self.dropped.early_rotations == 0:
+            return
+        if not self.dropped.should_fire():
+            return
+        logger = logging.getLogger("dedup")
+        if self.dropped.duplicates > 0:
+            logger.info("dropped %d duplicate messages (estimated false"
+                        " positive rate: %.2g)", self.dropped.duplicates,
+                        self.estimated_error_rate)
+        if self.dropped.early_rotations > 0:
+            logger.warn("message rate over %d/s, deduplication window"
+                        " shortened %d times", self.rate,
+                        self.dropped.early_rotations)
+        self.dropped.duplicates = 0
+        self.dropped.early_rotations = 0
+        self.dropped.fired()
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -0,0 +1,467 @@
+#!/usr/bin/python
+'''
+Adding location fields to messages from an inventory of hosts (or other
+entities), e.g. datacenter, rack, and team for each host name.
+
+Inventory file is either a CSV file with a header row, or a JSON file with
+a list of objects or an object mapping keys to objects, e.g.:
+
+.. code-block:: none
+
+   host,datacenter,rack,team
+   web01,dc1,r12,frontend
+   db01,dc2,r03,storage
+
+.. code-block:: json
+
+   {"web01": {"datacenter": "dc1", "rack": "r12", "team": "frontend"}}
+
+Inventory is kept as a sorted table of keys packed in a single memory-mapped
+string, with an array of offsets and an array of row numbers. Rows (sets of fields to
+add) are stored once for all the keys that share them, which, with many
+hosts in few racks, takes a fraction of memory of a dictionary. Results of
+lookups are cached, so a message with a key seen recently costs a single
+dictionary lookup.
+
+.. autoclass:: Inventory
+   :members:
+
+.. autoclass:: Enricher
+   :members:
+
+'''
+#-----------------------------------------------------------------------------
+
+import os
+import csv
+import json
+import mmap
+import array
+import struct
+import signal
+import marshal
+import logging
+import tempfile
+from pipeline import Stage
+
+__all__ = [
+    'Inventory', 'Enricher',
+]
+
+#-----------------------------------------------------------------------------
+
+def _text(value):
+    # location values are strings; keys are compared as UTF-8
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value == int(value):
+        value = int(value)
+    return str(value)
+
+class Inventory:
+    '''
+    Read-only mapping of keys to location fields, loaded from a file.
+
+    The file is parsed and the table is built in a child process, which
+    writes it to a temporary file, so memory taken by parsing doesn't stay
+    in the (long-running) parent. The parent maps the keys with
+    :func:`mmap.mmap()` and reads offsets, row numbers, and rows.
+
+    Inventory loaded in background is not usable until
+    :meth:`read_result()` returns ``True``. Until then, :meth:`fileno()`
+    returns the descriptor of the child's result pipe, suitable for
+    :class:`seismometer.eventloop.EventLoop`.
+    '''
+    # keys, length of all keys, rows, length of string table
+    _HEADER = struct.Struct("<QQQQ")
+
+    def __init__(self, path, key = "host", fields = None,
+                 background = False):
+        '''
+        :param path: CSV or JSON file to load (JSON if the name ends with
+            ``.json``)
+        :param key: name of the field (column) with keys
+        :param fields: list of fields to take from the file (defaults to all
+            fields except the key)
+        :param background: don't wait for the child process to build the
+            table (see :meth:`read_result()`)
+        :throws: :exc:`ValueError` (also when the file can't be read),
+            :exc:`IOError`, :exc:`OSError` (no temporary file or process)
+        '''
+        self.path = path
+        self.key = key
+        self.fields = fields
+        self._table = tempfile.TemporaryFile()
+        try:
+            self._start_child(self._table)
+        except (IOError, OSError):
+            self._table.close()
+            raise
+        if not background:
+            while not self.read_result():
+                pass
+
+    def _start_child(self, table):
+        (read_end, write_end) = os.pipe()
+        try:
+            pid = os.fork()
+        except OSError:
+            os.close(read_end)
+            os.close(write_end)
+            raise
+        if pid == 0:
+            # child process: don't touch anything inherited from the parent
+            os.close(read_end)
+            code = 1
+            try:
+                for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+                    signal.signal(signum, signal.SIG_DFL)
+                try:
+                    self._build(table)
+                    code = 0
+                except Exception, e:
+                    os.write(write_end, "%s: %s" % (e.__class__.__name__, e))
+            finally:
+                os._exit(code)
+        os.close(write_end)
+        self._pipe = read_end
+        self._pid = pid
+        self._error = []
+
+    def fileno(self):
+        '''
+        :return: descriptor of the result pipe of the child process building
+            the table
+        '''
+        return self._pipe
+
+    def read_result(self):
+        '''
+        :return: ``True`` if the inventory is loaded, ``False`` if the child
+            process is still building the table
+        :throws: :exc:`ValueError`, :exc:`IOError`, :exc:`OSError`
+
+        Read from the child process that builds the table, and load the
+        table when the child is done. Blocks unless :meth:`fileno()` is
+        ready for reading.
+        '''
+        chunk = os.read(self._pipe, 4096)
+        if chunk != "":
+            self._error.append(chunk)
+            return False
+        # the pipe gets closed when the child exits
+        os.close(self._pipe)
+        self._pipe = None
+        (_, status) = os.waitpid(self._pid, 0)
+        self._pid = None
+        try:
+            if status != 0:
+                raise ValueError("%s: %s" % (
+                    self.path, "".join(self._error) or "loading failed"
+                ))
+            self._map(self._table)
+        finally:
+            self._table.close()
+            self._table = None
+        return True
+
+    def _build(self, table):
+        if self.path.endswith(".json"):
+            entries = self._read_json(self.path)
+        else:
+            entries = self._read_csv(self.path)
+
+        rows = {} # row => row number
+        index = {} # key => row number
+        for (entry_key, entry) in entries:
+            row = tuple(sorted([
+                (_text(f), _text(v))
+                for (f, v) in entry.iteritems()
+                if f != self.key and v is not None and v != "" and \
+                   (self.fields is None or f in self.fields)
+            ]))
+            row_id = rows.get(row)
+            if row_id is None:
+                row_id = rows[row] = len(rows)
+            index[_text(entry_key)] = row_id
+
+        # rows are stored as (field, value) pairs of numbers of strings
+        strings = {}
+        row_list = [None] * len(rows)
+        for (row, row_id) in rows.iteritems():
+            row_list[row_id] = [
+                strings.setdefault(s, len(strings))
+                for pair in row
+                for s in pair
+            ]
+        row_offsets = array.array('I', [0])
+        row_data = array.array('I')
+        for row in row_list:
+            row_data.extend(row)
+            row_offsets.append(len(row_data))
+        string_list = [None] * len(strings)
+        for (string, string_id) in strings.iteritems():
+            string_list[string_id] = string
+        string_list = marshal.dumps(string_list)
+
+        keys = sorted(index)
+        offsets = array.array('I', [0])
+        offset = 0
+        for k in keys:
+            offset += len(k)
+            offsets.append(offset)
+        row_ids = array.array('I', [index[k] for k in keys])
+
+        table.write(self._HEADER.pack(len(keys), offset, len(row_list),
+                                      len(string_list)))
+        table.write(string_list)
+        row_offsets.tofile(table)
+        row_data.tofile(table)
+        offsets.tofile(table)
+        row_ids.tofile(table)
+        for k in keys:
+            table.write(k)
+        table.flush()
+
+    def _map(self, table):
+        table.seek(0)
+        (count, keys_size, rows, strings_size) = \
+            self._HEADER.unpack(table.read(self._HEADER.size))
+        self._strings = marshal.loads(table.read(strings_size))
+        self._row_offsets = array.array('I')
+        self._row_offsets.fromfile(table, rows + 1)
+        self._row_data = array.array('I')
+        self._row_data.fromfile(table, self._row_offsets[-1])
+        self._offsets = array.array('I')
+        self._offsets.fromfile(table, count + 1)
+        self._row_ids = array.array('I')
+        self._row_ids.fromfile(table, count)
+        if keys_size > 0:
+            # mmap() offset needs to be page-aligned
+            start = table.tell()
+            aligned = start - start % mmap.ALLOCATIONGRANULARITY
+            self._keys = mmap.mmap(table.fileno(), start - aligned + keys_size,
+                                   access = mmap.ACCESS_READ, offset = aligned)
+            self._base = start - aligned
+        else:
+            self._keys = ""
+            self._base = 0
+
+    def _read_csv(self, path):
+        with open(path, "rb") as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames is None or self.key not in reader.fieldnames:
+                raise ValueError("no %r column" % (self.key,))
+            for entry in reader:
+                if entry.get(self.key):
+                    yield (entry[self.key], entry)
+
+    def _read_json(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            entries = data.iteritems()
+        elif isinstance(data, list):
+            entries = (
+                (e.get(self.key), e) for e in data if isinstance(e, dict)
+            )
+        else:
+            raise ValueError("expected a list or an object")
+        for (entry_key, entry) in entries:
+            if not isinstance(entry, dict):
+                raise ValueError("entry %r is not an object" % (entry_key,))
+            if entry_key is not None:
+                yield (entry_key, entry)
+
+    def __len__(self):
+        return len(self._row_ids)
+
+    def rows(self):
+        '''
+        :return: number of distinct rows
+        '''
+        return len(self._row_offsets) - 1
+
+    def _row(self, row_id):
+        strings = self._strings
+        data = self._row_data[
+            self._row_offsets[row_id]:self._row_offsets[row_id + 1]
+        ]
+        return tuple([
+            (strings[data[i]], strings[data[i + 1]])
+            for i in xrange(0, len(data), 2)
+        ])
+
+    def get(self, key):
+        '''
+        :param key: key to look up
+        :return: tuple of ``(field, value)`` pairs or ``None`` if the key is
+            not in the inventory
+        '''
+        key = _text(key)
+        keys = self._keys
+        base = self._base
+        offsets = self._offsets
+        (low, high) = (0, len(self._row_ids))
+        while low < high:
+            middle = (low + high) // 2
+            candidate = keys[base + offsets[middle]:base + offsets[middle + 1]]
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                return self._row(self._row_ids[middle])
+        return None
+
+#-----------------------------------------------------------------------------
+
+class Enricher(Stage):
+    '''
+    Stage for :class:`seismometer.messenger.pipeline.Pipeline` adding
+    location fields from :class:`Inventory`.
+
+    Fields already present in message's location are kept, unless
+    :obj:`overwrite` is set. Messages with no key in location, with a key
+    that is not a string, or with a key not present in the inventory are
+    passed unchanged.
+
+    Lookup results are cached in two generations of at most
+    :obj:`max_cache` / 2 entries each.
+
+    Inventory reloaded with an event loop (see :meth:`reload()`) is loaded
+    in background, and the current one is used until the new one is ready.
+    '''
+    def __init__(self, path, key = "host", fields = None, overwrite = False,
+                 max_cache = 1000000):
+        '''
+        :param path: inventory file (see :class:`Inventory`)
+        :param key: location field to look up in the inventory
+        :param fields: list of fields to add (defaults to all)
+        :param overwrite: whether to replace fields present in location
+        :param max_cache: maximum number of cached lookup results
+        :throws: :exc:`ValueError`
+        '''
+        self.path = path
+        self.key = key
+        self.fields = fields
+        self.overwrite = overwrite
+        self.max_cache = max_cache
+        self.inventory = Inventory(path, key, fields)
+        self._current = {}  # key => row or None
+        self._previous = {} # older generation
+        self._loop = None   # event loop of the inventory being reloaded
+        self._loading = None
+
+    def reload(self, loop = None):
+        '''
+        :param loop: :class:`seismometer.eventloop.EventLoop` instance to
+            load the inventory in background with
+        :return: ``True`` if the inventory was reloaded (or, with
+            :obj:`loop`, reloading started), ``False`` on error
+
+        Load the inventory file again. The old inventory is replaced only
+        when the new one is loaded completely, and stays if loading fails.
+
+        With :obj:`loop`, this method doesn't wait for the inventory to be
+        loaded, and the loop doesn't wait for it either. Reload requested
+        while the inventory is being loaded in background is ignored.
+        '''
+        logger = logging.getLogger("enrich")
+        if self._loading is not None:
+            logger.info("inventory %s is already being reloaded", self.path)
+            return True
+        try:
+            inventory = Inventory(self.path, self.key, self.fields,
+                                  background = (loop is not None))
+        except (IOError, OSError, ValueError), e:
+            logger.warn("can't reload inventory: %s", e)
+            return False
+        if loop is not None:
+            self._loop = loop
+            self._loading = inventory
+            loop.add_reader(inventory, self._read_inventory,
+                            background = True)
+            return True
+        self._replace(inventory)
+        return True
+
+    def _read_inventory(self, inventory):
+        logger = logging.getLogger("enrich")
+        try:
+            if not inventory.read_result():
+                return
+        except (IOError, OSError, ValueError), e:
+            logger.warn("can't reload inventory: %s", e)
+            inventory = None
+        self._loop.remove_reader(self._loading)
+        self._loop = None
+        self._loading = None
+        if inventory is not None:
+            self._replace(inventory)
+
+    def _replace(self, inventory):
+        logger = logging.getLogger("enrich")
+        self.inventory = inventory
+        self._current = {}
+        self._previous = {}
+        logger.info("inventory %s reloaded: %d keys, %d distinct rows",
+                    self.path, len(inventory), inventory.rows())
+
+    def lookup(self, key):
+        '''
+        :param key: key to look up
+        :return: tuple of ``(field, value)`` pairs or ``None``
+
+        Look up a key in the inventory, using the cache. Keys other than
+        strings are never found.
+        '''
+        if not isinstance(key, (str, unicode)):
+            # inventory keys are strings
+            return None
+        try:
+            return self._current[key]
+        except KeyError:
+            pass
+        if key in self._previous:
+            row = self._previous.pop(key)
+        else:
+            row = self.inventory.get(key)
+        if len(self._current) >= self.max_cache / 2:
+            self._previous = self._current
+            self._current = {}
+        self._current[key] = row
+        return row
+
+    def process(self, messages):
+        '''
+        :param messages: list of message dictionaries
+        :return: the same list, with locations updated in place
+        '''
+        key = self.key
+        cache = self._current
+        overwrite = self.overwrite
+        for message in messages:
+            location = message.get("location")
+            if not isinstance(location, dict):
+                continue
+            value = location.get(key)
+            if not isinstance(value, (str, unicode)):
+                # missing, or not something an inventory key could match
+                continue
+            try:
+                row = cache[value]
+            except KeyError:
+                row = self.lookup(value)
+                cache = self._current
+            if row is None:
+                continue
+            for (field, field_value) in row:
+                if overwrite or field not in location:
+                    location[field] = field_value
+        return messages
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
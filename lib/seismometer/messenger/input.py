@@ -1,6 +1,5 @@
 #!/usr/bin/python
 
-import os
 import re
 import json
 import seismometer.input
@@ -12,15 +11,19 @@ class MessengerReader(seismometer.input.Reader):
     '''
     Network reader accepting JSON and Graphite-like messages.
 
-    This reader accepts three data formats, each in its own line: JSON hash,
-    Graphite/Carbon (``tag value timestamp``) or Graphite-like state (``tag
-    state severity timestamp``). The latter two are converted to Seismometer
-    Message structure.
+    This reader accepts four data formats, each in its own line: JSON hash,
+    JSON array of hashes (a batch of messages), Graphite/Carbon (``tag value
+    timestamp``) or Graphite-like state (``tag state severity timestamp``).
+    The latter two are converted to Seismometer Message structure. Batches
+    of samples from Carbon pickle sockets (see
+    :mod:`seismometer.input.carbon`) are converted the same way as Graphite
+    lines.
 
     Some notes:
       * severity must be equal to ``"expected"``, ``"warning"`` or
         ``"critical"``
-      * timestamp is an integer (epoch time)
+      * timestamp is an integer (epoch time); fractional part, if any, is
+        dropped
       * value for metric is integer, float in non-scientific notation or
         ``"U"`` ("undefined")
     '''
@@ -33,8 +36,8 @@ class MessengerReader(seismometer.input.Reader):
         r')[ \t]+(?P<time>[0-9.]+)$'
     )
 
-    def __init__(self, tag_matcher):
-        super(MessengerReader, self).__init__()
+    def __init__(self, tag_matcher, loop = None, quota = None, tracer = None):
+        super(MessengerReader, self).__init__(loop, quota, tracer)
         self.tag_matcher = tag_matcher
 
     def parse_line(self, host, line):
@@ -53,16 +56,29 @@ class MessengerReader(seismometer.input.Reader):
             except ValueError:
                 return None
 
+        if line[0] == '[': # JSON batch
+            try:
+                messages = json.loads(line)
+            except ValueError:
+                return None
+            if not isinstance(messages, list):
+                return None
+            return [m for m in messages if isinstance(m, dict)]
+
         match = MessengerReader._GRAPHITE_LINE.match(line)
         if match is None: # not a Graphite(like) protocol
             return None
 
         match = match.groupdict()
 
-        if host in (None, '127.0.0.1', 'localhost', 'localhost.localdomain'):
-            host = os.uname()[1]
-
-        timestamp = int(match['time'])
+        try:
+            if '.' in match['time']:
+                # fractional timestamps are allowed by Carbon
+                timestamp = int(float(match['time']))
+            else:
+                timestamp = int(match['time'])
+        except (ValueError, OverflowError): # e.g. "1.2.3" or huge number
+            return None
 
         (aspect, location) = self.tag_matcher.match(match['tag'])
 
@@ -71,23 +87,97 @@ class MessengerReader(seismometer.input.Reader):
                 aspect = aspect, location = location, time = timestamp,
                 state = match['state'], severity = match['severity']
             )
-        elif match['value'] == 'U':
-            message = seismometer.message.Message(
-                aspect = aspect, location = location, time = timestamp,
+            return message.to_dict()
+
+        try:
+            if match['value'] == 'U':
                 value = None
-            )
-        elif '.' in match['value']: # float
-            message = seismometer.message.Message(
-                aspect = aspect, location = location, time = timestamp,
+            elif '.' in match['value']: # float
                 value = float(match['value'])
-            )
-        else:
-            message = seismometer.message.Message(
-                aspect = aspect, location = location, time = timestamp,
+            else:
                 value = int(match['value'])
-            )
+        except ValueError: # e.g. "." or "1.2.3"
+            return None
+
+        # the same structure as seismometer.message.Message.to_dict()
+        # produces, built directly (see parse_samples())
+        return {
+            "v": 3,
+            "time": timestamp,
+            "location": location,
+            "event": {
+                "name": aspect,
+                "vset": { "value": { "value": value } },
+            },
+        }
+
+    def trace_parse(self, host, line):
+        '''
+        Parse a line, measuring separately the time spent on tag matching.
+        See :meth:`seismometer.input.Reader.trace_parse()`.
+        '''
+        clock = self.tracer.clock
+        tag_matcher = self.tag_matcher
+        self.tag_matcher = _TimedMatcher(tag_matcher, clock)
+        try:
+            start = clock()
+            message = self._parse(host, line)
+            elapsed = clock() - start
+        finally:
+            timed = self.tag_matcher
+            self.tag_matcher = tag_matcher
+        if timed.calls == 0:
+            return (message, elapsed, None)
+        return (message, elapsed - timed.elapsed, timed.elapsed)
+
+    def parse_samples(self, host, samples):
+        '''
+        :return: list of dicts, structured after
+           :class:``seismometer.message.Message``
 
-        return message.to_dict()
+        Convert a batch of Carbon samples (``(path, (timestamp, value))``
+        tuples) to messages. Invalid samples are skipped.
+        '''
+        match = self.tag_matcher.match
+        result = []
+        for sample in samples:
+            try:
+                (tag, (timestamp, value)) = sample
+                timestamp = int(timestamp)
+            except (TypeError, ValueError, OverflowError):
+                continue
+            if not isinstance(tag, (str, unicode)) or \
+               not isinstance(value, (int, long, float)) or \
+               isinstance(value, bool):
+                continue
+            (aspect, location) = match(tag)
+            # the same structure as seismometer.message.Message.to_dict()
+            # produces, built directly
+            result.append({
+                "v": 3,
+                "time": timestamp,
+                "location": location,
+                "event": {
+                    "name": aspect,
+                    "vset": { "value": { "value": value } },
+                },
+            })
+        return result
+
+class _TimedMatcher:
+    # tag matcher wrapper that sums up time spent on matching
+    def __init__(self, matcher, clock):
+        self.matcher = matcher
+        self.clock = clock
+        self.calls = 0
+        self.elapsed = 0.0
+
+    def match(self, tag):
+        start = self.clock()
+        result = self.matcher.match(tag)
+        self.elapsed += self.clock() - start
+        self.calls += 1
+        return result
 
 #-----------------------------------------------------------------------------
 # vim:ft=python
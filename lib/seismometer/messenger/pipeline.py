@@ -0,0 +1,220 @@
+#!/usr/bin/python
+'''
+Processing stages between reader and writer
+-------------------------------------------
+
+Messenger can pass messages through a chain of *stages* before sending them
+to destinations. Stages work on batches of messages, so a stage written in
+Python is called once per batch, not once per message.
+
+Stage API
+^^^^^^^^^
+
+Stage is an object with following methods:
+
+* ``process(messages)`` -- called with a list of message dictionaries;
+  returns a list of messages to pass to the next stage (it can be the same
+  list, modified in place, a shorter list, or a completely new one)
+* ``flush(now)`` (optional) -- called periodically with current epoch time;
+  returns a list of messages to pass to the next stage (e.g. aggregates
+  computed by the stage), possibly empty
+
+:class:`Stage` is a base class with no-op implementation of both methods.
+
+Example stage that drops messages without location::
+
+   class DropUnlocated(seismometer.messenger.pipeline.Stage):
+       def process(self, messages):
+           return [m for m in messages if len(m.get("location", {})) > 0]
+
+Plugin specification
+^^^^^^^^^^^^^^^^^^^^
+
+Stages, as well as input and output plugins, are specified with
+a dictionary:
+
+* ``module`` -- name of the module (from :obj:`sys.path`) with the class
+* ``file`` -- file with the class (alternative to ``module``)
+* ``class`` -- name of the class
+* ``params`` (optional) -- dictionary with keyword arguments for the class
+
+Stages file for :program:`messenger` is a YAML or JSON file with a list of
+such dictionaries, in the order the stages should be chained, e.g.:
+
+.. code-block:: yaml
+
+   - module: seismometer.messenger.throttle
+     class: FlowLimiter
+     params:
+       rate: 1
+       sampling: ["debug.*=0.1"]
+   - file: /etc/seismometer/stages/enrich.py
+     class: Enrich
+
+Input plugin is an object with ``fileno()`` and ``readline()`` methods (see
+:mod:`seismometer.input`); ``readline()`` should return ``(host, list)``
+with a whole batch of decoded messages. Output plugin is an object with
+``send()`` and ``flush()`` methods and optionally ``send_batch()`` (see
+:mod:`seismometer.output`).
+
+.. autoclass:: Stage
+   :members:
+
+.. autoclass:: Pipeline
+   :members:
+
+.. autofunction:: load_plugin
+
+.. autofunction:: load_stages
+
+'''
+#-----------------------------------------------------------------------------
+
+import yaml
+import seismometer.plugin
+
+__all__ = [
+    'Stage', 'Pipeline',
+    'load_plugin', 'load_stages',
+]
+
+#-----------------------------------------------------------------------------
+
+class Stage(object):
+    '''
+    Base class for stages, passing messages unchanged.
+    '''
+    def process(self, messages):
+        '''
+        :param messages: list of message dictionaries
+        :return: list of messages to pass further
+        '''
+        return messages
+
+    def flush(self, now):
+        '''
+        :param now: current epoch time
+        :return: list of messages to pass further
+
+        Process time-based events.
+        '''
+        return []
+
+#-----------------------------------------------------------------------------
+
+class Pipeline:
+    '''
+    Chain of stages.
+    '''
+    def __init__(self, stages = None):
+        '''
+        :param stages: list of stages
+        '''
+        self.stages = []
+        for stage in (stages or ()):
+            self.add(stage)
+
+    def __len__(self):
+        return len(self.stages)
+
+    def add(self, stage):
+        '''
+        :param stage: stage to add at the end of the chain
+        '''
+        self.stages.append(stage)
+
+    def process(self, messages, start = 0):
+        '''
+        :param messages: list of message dictionaries
+        :param start: index of the first stage to process messages with
+        :return: list of messages that passed all the stages
+        '''
+        for stage in self.stages[start:]:
+            if len(messages) == 0:
+                break
+            messages = stage.process(messages)
+        return messages
+
+    def flush(self, now):
+        '''
+        :param now: current epoch time
+        :return: list of messages emitted by stages' ``flush()`` methods,
+            processed by the stages that follow
+
+        Flush all the stages.
+        '''
+        result = []
+        for (i, stage) in enumerate(self.stages):
+            if not hasattr(stage, "flush"):
+                continue
+            messages = stage.flush(now)
+            if len(messages) > 0:
+                result.extend(self.process(messages, i + 1))
+        return result
+
+#-----------------------------------------------------------------------------
+
+_plugin_counter = [0]
+
+def load_plugin(spec, loader = None):
+    '''
+    :param spec: plugin specification (dictionary)
+    :param loader: :class:`seismometer.plugin.PluginLoader` instance to use
+    :return: plugin instance
+    :throws: :exc:`ValueError` on invalid specification or when the module
+        couldn't be loaded
+
+    Load a plugin class and create its instance.
+    '''
+    if not isinstance(spec, dict) or "class" not in spec or \
+       ("module" in spec) == ("file" in spec):
+        raise ValueError("plugin needs \"class\" and either \"module\" or"
+                         " \"file\" defined")
+    params = spec.get("params", {})
+    if not isinstance(params, dict):
+        raise ValueError("plugin's \"params\" needs to be a dictionary")
+
+    close_loader = (loader is None)
+    if loader is None:
+        loader = seismometer.plugin.PluginLoader()
+    try:
+        if "module" in spec:
+            module = loader.load(spec["module"])
+        else:
+            _plugin_counter[0] += 1
+            name = "seismometer.messenger.__plugin%d__" % (_plugin_counter[0],)
+            module = loader.load(name, spec["file"])
+    except (ImportError, IOError), e:
+        raise ValueError("can't load plugin: %s" % (e,))
+    finally:
+        if close_loader:
+            loader.close()
+
+    cls = getattr(module, spec["class"], None)
+    if cls is None:
+        raise ValueError("class %s not found" % (spec["class"],))
+    params = dict((str(k), v) for (k, v) in params.iteritems())
+    return cls(**params)
+
+def load_stages(filename):
+    '''
+    :param filename: YAML or JSON file with list of plugin specifications
+    :rtype: :class:`Pipeline`
+    :throws: :exc:`ValueError` on invalid configuration
+
+    Load stages from a file.
+    '''
+    with open(filename) as f:
+        config = yaml.safe_load(f)
+    if config is None:
+        config = []
+    if not isinstance(config, list):
+        raise ValueError("stages file needs to contain a list")
+    loader = seismometer.plugin.PluginLoader()
+    try:
+        return Pipeline([load_plugin(spec, loader) for spec in config])
+    finally:
+        loader.close()
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -171,12 +171,15 @@ class TagMatcher:
     _SEPARATOR    = re.compile(r'[ \t,]+')
     _REGEXP       = re.compile(r'/([^\\/]|\\.)+/')
 
-    def __init__(self, config = None):
+    def __init__(self, config = None, cache_size = 65536):
         '''
         :param config: configuration file with tag patterns
+        :param cache_size: number of tags to remember results of matching for
         '''
         self.config = config
         self.patterns = []
+        self.cache_size = cache_size
+        self._cache = {} # tag => (aspect, location)
         self.reload()
 
     def match(self, tag):
@@ -185,7 +188,20 @@ class TagMatcher:
         :rtype: tuple (string, dict)
 
         Match tag against patterns from configuration file.
+
+        Returned location is a new dictionary, so it can be modified by the
+        caller.
         '''
+        result = self._cache.get(tag)
+        if result is None:
+            result = self._match(tag)
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[tag] = result
+        (aspect, location) = result
+        return (aspect, dict(location))
+
+    def _match(self, tag):
         for pat in self.patterns:
             location = pat.match(tag)
             if location is not None:
@@ -351,6 +367,7 @@ class TagMatcher:
         process_line(prev_line)
 
         self.patterns = patterns
+        self._cache.clear()
 
 #-----------------------------------------------------------------------------
 # vim:ft=python:foldmethod=marker
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+'''
+Per-flow rate limiting and sampling of messages. Flow is identified by aspect
+name and location.
+
+.. autoclass:: FlowLimiter
+   :members:
+
+'''
+#-----------------------------------------------------------------------------
+
+import time
+import zlib
+import logging
+import seismometer.rate_limit
+from seismometer.output.routing import Rule, message_aspect, message_location
+
+#-----------------------------------------------------------------------------
+
+class FlowLimiter:
+    '''
+    Token bucket rate limiter for flows, with optional deterministic sampling
+    of selected aspects.
+
+    Buckets are refilled lazily, when a message for the flow arrives, so there
+    are no timers per flow. Buckets are kept in two generations of at most
+    :obj:`max_flows` / 2 entries each; when the current generation fills up,
+    the older one is discarded, so flows that haven't sent anything recently
+    are forgotten (and start with a full bucket when they come back).
+
+    Sampling keeps a fraction of messages of an aspect. Whether a message is
+    kept is decided by a hash of its aspect, location, and time, so two
+    messengers receiving the same messages keep the same subset.
+
+    The limiter is a stage for :class:`seismometer.messenger.pipeline.Pipeline`.
+    '''
+
+    def __init__(self, rate = None, burst = None, max_flows = 100000,
+                 sampling = None):
+        '''
+        :param rate: number of messages per second allowed for a single flow
+            (``None`` means no limit)
+        :param burst: size of the token bucket (defaults to :obj:`rate`, but
+            not less than 1)
+        :param max_flows: maximum number of flows to track
+        :param sampling: list of ``(rule, fraction)`` pairs, where ``rule`` is
+            :class:`seismometer.output.routing.Rule` and ``fraction`` is
+            a float from 0.0 to 1.0, or of strings accepted by
+            :meth:`parse_sampling()`; first matching rule wins
+        '''
+        self.rate = rate
+        if burst is None and rate is not None:
+            burst = max(rate, 1)
+        self.burst = burst
+        self.max_flows = max_flows
+        if sampling is not None:
+            sampling = [
+                self.parse_sampling(s) if isinstance(s, basestring) else s
+                for s in sampling
+            ]
+            self.sampling = [
+                (rule, int(fraction * 0xffffffff))
+                for (rule, fraction) in sampling
+            ]
+        else:
+            self.sampling = []
+        self._current = {}  # flow => [tokens, last_update]
+        self._previous = {} # older generation
+        self.dropped = seismometer.rate_limit.RateLimit(
+            rate_limited = 0,
+            sampled_out = 0,
+        )
+
+    @staticmethod
+    def parse_sampling(spec):
+        '''
+        :param spec: ``ASPECT=FRACTION``, where ``ASPECT`` is a name, glob, or
+            ``/regexp/`` (see :mod:`seismometer.output.routing`)
+        :return: ``(rule, fraction)``
+        :throws: :exc:`ValueError` on invalid specification
+
+        Parse sampling specification.
+        '''
+        if "=" not in spec:
+            raise ValueError("invalid sampling specification: %s" % (spec,))
+        (aspect, fraction) = spec.rsplit("=", 1)
+        fraction = float(fraction)
+        if not (0.0 <= fraction <= 1.0):
+            raise ValueError("invalid sampling fraction: %s" % (fraction,))
+        if len(aspect) > 1 and aspect.startswith("/") and aspect.endswith("/"):
+            rule = Rule(aspect[1:-1].replace('\\/', '/'), "regexp")
+        else:
+            rule = Rule(aspect)
+        return (rule, fraction)
+
+    def __len__(self):
+        '''
+        Return (approximate) number of tracked flows.
+        '''
+        return len(self._current) + len(self._previous)
+
+    def admit(self, message):
+        '''
+        :param message: message dictionary
+        :return: ``True`` if the message should be passed further, ``False``
+            if it should be dropped
+
+        Check the message against sampling rules and flow's rate limit.
+        '''
+        if self.rate is None and len(self.sampling) == 0:
+            return True
+
+        aspect = message_aspect(message)
+        location = message_location(message)
+        try:
+            flow = (aspect, tuple(sorted(location.iteritems())))
+            hash(flow)
+        except TypeError:
+            # not a valid location (unhashable values)
+            flow = (aspect, None)
+
+        if len(self.sampling) > 0 and not self._sampled(message, flow):
+            self.dropped.sampled_out += 1
+            self._report()
+            return False
+
+        if self.rate is None:
+            return True
+
+        bucket = self._current.get(flow)
+        if bucket is None:
+            bucket = self._previous.pop(flow, None)
+            if bucket is None:
+                bucket = [self.burst, None]
+            if len(self._current) >= self.max_flows / 2:
+                self._previous = self._current
+                self._current = {}
+            self._current[flow] = bucket
+
+        now = time.time()
+        if bucket[1] is not None:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+        if bucket[0] < 1:
+            self.dropped.rate_limited += 1
+            self._report()
+            return False
+        bucket[0] -= 1
+        return True
+
+    def process(self, messages):
+        '''
+        :param messages: list of message dictionaries
+        :return: list of messages that should be passed further
+
+        Filter a batch of messages with :meth:`admit()`.
+        '''
+        if self.rate is None and len(self.sampling) == 0:
+            return messages
+        return [m for m in messages if self.admit(m)]
+
+    def _sampled(self, message, flow):
+        for (rule, threshold) in self.sampling:
+            if rule.match_aspect(flow[0]):
+                key = "%r\0%r\0%r" % (flow[0], flow[1], message.get("time"))
+                return (zlib.crc32(key) & 0xffffffff) <= threshold
+        return True # no sampling rule for this aspect
+
+    def _report(self):
+        if not self.dropped.should_fire():
+            return
+        logger = logging.getLogger("throttle")
+        if self.dropped.rate_limited > 0:
+            logger.warn("dropped %d messages over flow rate limit",
+                        self.dropped.rate_limited)
+        if self.dropped.sampled_out > 0:
+            logger.info("sampled out %d messages", self.dropped.sampled_out)
+        self.dropped.rate_limited = 0
+        self.dropped.sampled_out = 0
+        self.dropped.fired()
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+'''
+Latency tracing
+---------------
+
+Messenger can follow a sample of messages on their way from a source to
+destinations and record how long each step took. Timings are collected in
+histograms with fixed buckets, per source (steps before routing) or per
+destination (steps after routing), and are periodically converted to metric
+messages.
+
+Trace of a message (:class:`Trace`) is kept aside of the message itself, so
+the message is not modified in any way. Steps recorded:
+
+* ``read`` (source) -- from reading data from the socket to the reader
+  taking the message from its queue (includes waiting behind other
+  sockets, see :option:`messenger --read-quota`)
+* ``parse`` (source) -- decoding the message, without tag matching
+* ``match`` (source) -- tag matching (Graphite-like formats only)
+* ``stages`` (source) -- processing stages
+* ``encode`` (destination) -- encoding the batch the message was in
+* ``write`` (destination) -- writing the batch to the socket
+* ``spool`` (destination) -- putting the batch in spool (instead of
+  ``write``)
+* ``delivery`` (destination) -- from reading the message from the source
+  socket to writing it to the destination socket, either directly or after
+  the spool was drained
+
+Time is measured with monotonic clock (see
+:func:`seismometer.clock.monotonic()`).
+
+Messages emitted by :meth:`Tracer.emit()` have aspect name
+``messenger.latency`` and location with fields ``host``, ``stage``, and
+``source`` or ``destination``. Their value set contains ``count``, ``sum``
+and ``max`` (in seconds), ``p50`` and ``p99`` (upper bounds of the buckets
+the percentiles fall into), and cumulative counts for buckets, named
+``le_<bound>`` (``le_inf`` for the last one).
+
+.. autoclass:: Tracer
+   :members:
+
+.. autoclass:: Trace
+   :members:
+
+.. autoclass:: Histogram
+   :members:
+
+'''
+#-----------------------------------------------------------------------------
+
+import os
+import time
+import bisect
+import random
+import seismometer.clock
+
+__all__ = [
+    'Tracer', 'Trace', 'Histogram',
+]
+
+#-----------------------------------------------------------------------------
+
+class Histogram:
+    '''
+    Latency histogram with fixed buckets.
+    '''
+
+    BUCKETS = (
+        0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+    )
+
+    def __init__(self, buckets = BUCKETS):
+        '''
+        :param buckets: sorted upper bounds of buckets (in seconds); values
+            above the last bound go to an additional bucket
+        '''
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        '''
+        :param seconds: time to record
+        '''
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        '''
+        :param fraction: percentile to find (e.g. 0.99)
+        :return: upper bound of the bucket where the percentile falls (or
+            :attr:`max` for the last bucket), ``None`` if empty
+        '''
+        if self.count == 0:
+            return None
+        threshold = fraction * self.count
+        total = 0
+        for (i, count) in enumerate(self.counts):
+            total += count
+            if total >= threshold:
+                break
+        if i < len(self.buckets):
+            return min(self.buckets[i], self.max)
+        return self.max
+
+    def to_vset(self):
+        '''
+        :return: dictionary with values for message's value set
+        '''
+        vset = {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+        }
+        total = 0
+        for (bound, count) in zip(self.buckets, self.counts):
+            total += count
+            vset["le_%g" % (bound,)] = total
+        vset["le_inf"] = self.count
+        return vset
+
+#-----------------------------------------------------------------------------
+
+class Trace(object):
+    '''
+    Trace of a single message.
+
+    .. attribute:: source
+
+       name of the source the message came from
+
+    .. attribute:: ingress
+
+       time (:func:`seismometer.clock.monotonic()`) when the message was
+       read from the socket
+    '''
+    __slots__ = ('source', 'ingress')
+
+    def __init__(self, source, ingress):
+        self.source = source
+        self.ingress = ingress
+
+class Tracer:
+    '''
+    Sampling decisions and latency histograms.
+
+    Instance of this class is passed to
+    :class:`seismometer.input.Reader`, :class:`seismometer.output.Writer`,
+    and (through the writer) to output sockets that support tracing.
+    '''
+
+    clock = staticmethod(seismometer.clock.monotonic)
+
+    def __init__(self, rate = 0.01, interval = 60, buckets = None,
+                 hostname = None):
+        '''
+        :param rate: fraction of messages to trace
+        :param interval: interval (in seconds) between emitting histograms
+            (informative, see :meth:`emit()`)
+        :param buckets: list of upper bounds of histogram buckets (defaults
+            to :attr:`Histogram.BUCKETS`)
+        :param hostname: value for ``host`` field of emitted messages'
+            location (defaults to local hostname)
+        '''
+        if not 0 < rate <= 1:
+            raise ValueError("rate needs to be in (0, 1] range")
+        self.rate = rate
+        self.interval = interval
+        self.buckets = buckets or Histogram.BUCKETS
+        self.hostname = hostname or os.uname()[1]
+        self.histograms = {} # (stage, kind, name) => Histogram
+        # messages are sampled at random intervals with the average of
+        # 1/rate, so periodic traffic doesn't get sampled at the same phase
+        self._stride = max(1, int(round(1.0 / rate)))
+        self._countdown = self._gap()
+
+    def _gap(self):
+        return random.randint(1, 2 * self._stride - 1)
+
+    def sample(self, count):
+        '''
+        :param count: number of messages in a batch
+        :return: sorted list of indices of messages to trace
+
+        Select messages to trace from a batch.
+        '''
+        result = []
+        pos = self._countdown - 1
+        while pos < count:
+            result.append(pos)
+            pos += self._gap()
+        self._countdown = pos - count + 1
+        return result
+
+    def trace(self, source, ingress):
+        '''
+        :param source: name of the source
+        :param ingress: time (:meth:`clock()`) when the message was read
+        :rtype: :class:`Trace`
+
+        Start tracing a message.
+        '''
+        return Trace(source, ingress)
+
+    def record(self, stage, kind, name, seconds):
+        '''
+        :param stage: name of the step
+        :param kind: ``"source"`` or ``"destination"``
+        :param name: name of the source or destination
+        :param seconds: time the step took
+
+        Add time to appropriate histogram.
+        '''
+        key = (stage, kind, name)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.add(seconds)
+
+    def emit(self, now = None):
+        '''
+        :param now: epoch time for messages' timestamp
+        :return: list of message dictionaries
+
+        Convert histograms to messages and start new ones.
+        '''
+        if now is None:
+            now = time.time()
+        messages = []
+        for ((stage, kind, name), histogram) in sorted(self.histograms.items()):
+            messages.append({
+                "v": 3,
+                "time": int(now),
+                "location": {
+                    "host": self.hostname,
+                    "stage": stage,
+                    kind: name if name is not None else "unknown",
+                },
+                "event": {
+                    "name": "messenger.latency",
+                    "interval": self.interval,
+                    "vset": dict(
+                        (n, { "value": v })
+                        for (n, v) in histogram.to_vset().iteritems()
+                    ),
+                },
+            })
+        self.histograms = {}
+        return messages
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
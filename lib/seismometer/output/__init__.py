@@ -7,13 +7,30 @@ Output sockets are only expected to implement ``send()`` and ``flush()``
 methods.
 
 * ``send(message)`` will be called with a dictionary representing a message
-  for every message to send (``message`` serializes clearly to JSON)
-* ``flush()`` will be called in regular intervals, to give output sockets the
-  chance to repair connection and send pending messages
+  for every message to send (``message`` serializes clearly to JSON); output
+  sockets used directly (e.g. by :program:`dumb-probe`) can also be passed
+  a :class:`seismometer.message.Message`, which should be serialized with
+  its :meth:`to_json()` method
+* ``flush()`` will be called in regular intervals (by a timer in event loop
+  passed to :class:`Writer`), to give output sockets the chance to repair
+  connection and send pending messages
+
+Output sockets that buffer messages on their own may also implement
+``close()``, called by :meth:`Writer.close()` on shutdown. Outputs writing to
+files may implement ``reopen()``, called by :meth:`Writer.reopen()` (e.g. on
+*SIGHUP*). Output with ``attach(loop)`` method gets the writer's event loop
+when added, to schedule its own timers.
+
+Output sockets may also implement ``send_batch(messages)``, which is called
+by :meth:`Writer.write_batch()` with a list of messages instead of calling
+``send()`` for each of them.
 
 Connectivity problems are not handled at :class:`Writer` level. It is assumed
 that the socket spools messages in case of errors.
 
+Output socket can be restricted to receive only some of the messages, by
+adding it with a list of routing rules (see :mod:`seismometer.output.routing`).
+
 Example implementation of output socket that ignores all the messages::
 
    class NullOutput:
@@ -29,12 +46,13 @@ Example implementation of output socket that ignores all the messages::
 #-----------------------------------------------------------------------------
 
 import json
-import signal
 
-import inet, stdout, unix
+import inet, stdout, unix, shm, archive, file, routing, pool, formats
+import factory
 __all__ = [
     'Writer',
-    'inet', 'stdin', 'unix',
+    'inet', 'stdin', 'unix', 'shm', 'archive', 'file', 'routing', 'pool',
+    'formats', 'factory',
 ]
 
 #-----------------------------------------------------------------------------
@@ -43,30 +61,155 @@ class Writer:
     '''
     Write a message to all added output sockets at once.
     '''
-    def __init__(self):
+    def __init__(self, loop = None, flush_interval = 10, tracer = None):
+        '''
+        :param loop: :class:`seismometer.eventloop.EventLoop` to schedule
+            flushing outputs in; if ``None``, the caller is responsible for
+            calling :meth:`flush()`
+        :param flush_interval: interval (in seconds) between flushing outputs
+        :param tracer: :class:`seismometer.messenger.tracing.Tracer` to
+            record timings of sending traced messages in
+        '''
         self.outputs = []
+        self.routes = routing.RoutingTable()
+        self.loop = loop
+        self.flush_interval = flush_interval
+        self.tracer = tracer
+        if loop is not None:
+            # try flushing all the outputs every N seconds (reconnecting to
+            # the remote if necessary)
+            loop.call_later(flush_interval, self._flush_timer)
+
+    def _flush_timer(self):
+        if self.flush():
+            # some output has more spooled messages to send; continue as soon
+            # as pending input is handled
+            self.loop.call_later(0, self._flush_timer)
+        else:
+            self.loop.call_later(self.flush_interval, self._flush_timer)
+
+    def flush(self):
+        '''
+        :return: ``True`` if any of the outputs has more messages to flush
+
+        Flush all the outputs. Output's ``flush()`` may return ``True`` to
+        indicate that it only sent a part of its spool.
+        '''
+        more = False
+        for o in self.outputs:
+            if o.flush():
+                more = True
+        return more
 
-        # setup SIGALRM to be called every N seconds and try flushing all the
-        # outputs (reconnecting to the remote if necessary)
-        flush_interval = 10
-        def alarm_handler(sig, stack):
-            for o in self.outputs:
-                o.flush()
-            signal.alarm(flush_interval)
-        signal.signal(signal.SIGALRM, alarm_handler)
-        signal.alarm(flush_interval)
-
-    def add(self, output):
+    def close(self):
+        '''
+        Close all the outputs that have ``close()`` method (e.g. to write
+        buffered messages).
+        '''
+        for o in self.outputs:
+            if hasattr(o, "close"):
+                o.close()
+
+    def reopen(self):
+        '''
+        Reopen files of all the outputs that have ``reopen()`` method.
+        '''
+        for o in self.outputs:
+            if hasattr(o, "reopen"):
+                o.reopen()
+
+    def add(self, output, rules = None):
         '''
         :param output: output socket to add
+        :param rules: list of :class:`routing.Rule` instances; if empty or
+            ``None``, all messages are sent to the output
 
         Add output socket to the list.
+
+        If the writer has an event loop and the output has ``attach()``
+        method, it's called with the loop.
+
+        If the writer has a tracer and the output has ``tracer`` attribute,
+        the attribute is set, and the output's ``send_batch()`` gets traced
+        messages as its second argument (list of ``(index, trace)`` tuples).
         '''
+        if self.tracer is not None and hasattr(output, "tracer"):
+            output.tracer = self.tracer
+        if self.loop is not None and hasattr(output, "attach"):
+            output.attach(self.loop)
         self.outputs.append(output)
+        self.routes.add(output, rules)
 
     def write(self, message):
-        for o in self.outputs:
+        '''
+        :param message: message to send
+
+        Send the message to all outputs that its routing rules select.
+        '''
+        for o in self.routes.route(message):
             o.send(message)
 
+    def write_batch(self, messages, traces = None):
+        '''
+        :param messages: list of messages to send
+        :param traces: list of ``(index, trace)`` tuples for messages that
+            are traced (see :mod:`seismometer.messenger.tracing`)
+
+        Send the messages to all outputs that their routing rules select.
+        Outputs that implement ``send_batch()`` get all their messages in
+        a single call.
+        '''
+        if len(messages) == 0:
+            return
+        if not traces or self.tracer is None:
+            traces = None
+        if not self.routes.has_rules():
+            batches = [(o, messages, traces) for o in self.outputs]
+        else:
+            batches = [(o, [], []) for o in self.outputs]
+            index = dict((id(o), (b, t)) for (o, b, t) in batches)
+            if traces is not None:
+                traced = dict((id(messages[i]), t) for (i, t) in traces)
+            else:
+                traced = None
+            for message in messages:
+                for o in self.routes.route(message):
+                    (batch, batch_traces) = index[id(o)]
+                    if traced is not None and id(message) in traced:
+                        batch_traces.append((len(batch), traced[id(message)]))
+                    batch.append(message)
+        for (o, batch, batch_traces) in batches:
+            if len(batch) == 0:
+                continue
+            if batch_traces:
+                self._send_traced(o, batch, batch_traces)
+            elif hasattr(o, "send_batch"):
+                o.send_batch(batch)
+            else:
+                for message in batch:
+                    o.send(message)
+
+    def _send_traced(self, o, batch, traces):
+        if getattr(o, "tracer", None) is not None:
+            # the output records its own timings
+            o.send_batch(batch, traces)
+            return
+        clock = self.tracer.clock
+        start = clock()
+        if hasattr(o, "send_batch"):
+            o.send_batch(batch)
+        else:
+            for message in batch:
+                o.send(message)
+        end = clock()
+        if hasattr(o, "get_name"):
+            name = o.get_name()
+        else:
+            name = o.__class__.__name__
+        for (i, trace) in traces:
+            self.tracer.record("write", "destination", name, end - start)
+            self.tracer.record("delivery", "destination", name,
+                               end - trace.ingress)
+
 #-----------------------------------------------------------------------------
 # vim:ft=python:foldmethod=marker
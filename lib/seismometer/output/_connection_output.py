@@ -9,8 +9,12 @@ Generic
 #-----------------------------------------------------------------------------
 
 import json
+import time
+import seismometer.message
 import seismometer.spool
+import seismometer.wire
 import seismometer.rate_limit
+import seismometer.output.routing
 
 #-----------------------------------------------------------------------------
 
@@ -19,19 +23,65 @@ class ConnectionOutput(object):
     Base class for output sockets that use *CONNECT* operation of some sort
     (e.g. TCP, stream/datagram UNIX sockets), which spools messages in case of
     connectivity problems.
+
+    Messages are spooled in lanes: ``"state"`` for messages carrying state
+    (or no value set), and ``"metric"`` for the others (see
+    :class:`seismometer.spool.LaneSpooler`). While anything is spooled, new
+    messages are spooled, too, and the spool is sent at most
+    :attr:`drain_budget` bytes at a time, so state messages get ahead of
+    metrics backlog and the event loop is not blocked for long.
+
+    .. attribute:: drain_budget
+
+       maximum number of bytes sent from spool in a single call to
+       :meth:`send_batch()` or :meth:`flush()`
+
+    .. attribute:: renegotiate_interval
+
+       time (seconds) after which binary wire format is offered again to
+       a peer that didn't accept it; until then, the peer gets JSON lines
+       without negotiation (which may take a few seconds of waiting for
+       a reply that never comes)
+
+    .. attribute:: tracer
+
+       :class:`seismometer.messenger.tracing.Tracer` to record timings of
+       traced messages in (set by :class:`seismometer.output.Writer`)
     '''
 
-    def __init__(self, spooler = None):
+    drain_budget = 1024 * 1024
+    renegotiate_interval = 3600
+    tracer = None
+    # maximum number of traced messages followed through spool
+    max_spool_traces = 1024
+
+    def __init__(self, spooler = None, wire_format = "json",
+                 output_format = None):
         '''
         :param spooler: place to put messages in case of connectivity problems
-            (defaults to :class:`seismometer.messenger.spool.MemorySpooler`
-            instance)
+            (defaults to :class:`seismometer.spool.LaneSpooler` instance)
+        :param wire_format: ``"json"`` or ``"binary"`` (see
+            :mod:`seismometer.wire`)
+        :param output_format: encoder for formats other than JSON lines (see
+            :mod:`seismometer.output.formats`); can't be used with binary
+            wire format
         '''
+        if output_format is not None and wire_format == "binary":
+            raise ValueError("output format can't be used with binary wire"
+                             " format")
+        self.wire_format = wire_format
+        self.output_format = output_format
+        # encoder for the current connection (None means JSON lines)
+        self.encoder = output_format
+        # time until which the peer is assumed not to know binary format
+        self._json_only_until = None
         if spooler is None:
-            self.spooler = seismometer.spool.MemorySpooler()
+            self.spooler = seismometer.spool.LaneSpooler()
         else:
             self.spooler = spooler
         self.spool_dropped = seismometer.rate_limit.RateLimit(count = 0)
+        # id(line) => (line, trace) for traced messages that were spooled
+        self.spool_traces = {}
 
     def __del__(self):
         logger = self.get_logger()
@@ -46,7 +96,8 @@ class ConnectionOutput(object):
         :return: ``True`` when line was sent successfully, ``False`` when
             problems occurred
 
-        Write a single line to socket. Function to be implemented in subclass.
+        Write a single line (or binary frame, see :meth:`negotiate()`) to
+        socket. Function to be implemented in subclass.
         '''
         raise NotImplementedError()
 
@@ -66,6 +117,46 @@ class ConnectionOutput(object):
         '''
         raise NotImplementedError()
 
+    def negotiate(self, conn):
+        '''
+        :param conn: freshly connected socket
+        :throws: :exc:`socket.error`
+
+        Negotiate wire format with the remote side. Function to be called by
+        subclasses in :meth:`repair_connection()`, before the connection is
+        used for anything else.
+        '''
+        self.encoder = self.output_format
+        if self.wire_format != "binary":
+            return
+        now = time.time()
+        if self._json_only_until is not None and now < self._json_only_until:
+            # negotiation runs in the event loop and blocks it until the
+            # reply comes, so don't repeat it on every reconnect
+            return
+        logger = self.get_logger()
+        self.encoder = seismometer.wire.negotiate(conn)
+        if self.encoder is not None:
+            self._json_only_until = None
+            logger.info("%s: using binary wire format", self.get_name())
+        else:
+            self._json_only_until = now + self.renegotiate_interval
+            logger.info("%s: binary wire format not supported by peer,"
+                        " using JSON (next try in %ds)", self.get_name(),
+                        self.renegotiate_interval)
+
+    def encode(self, message):
+        '''
+        :param message: message to encode
+        :type message: dict or :class:`seismometer.message.Message`
+        :return: data to write to the current connection
+        '''
+        if self.encoder is None:
+            return self.json_line(message)
+        if isinstance(message, seismometer.message.Message):
+            message = message.to_dict()
+        return self.encoder.encode(message)
+
     def get_logger(self):
         '''
         :return: logger instance (see :mod:`logging` module)
@@ -88,77 +179,212 @@ class ConnectionOutput(object):
         Send single message.
 
         In case of connectivity errors message will be spooled and sent later.
+        Spooled messages are kept as JSON lines, independent of the wire
+        format of any particular connection, and are encoded to the output
+        format when sent.
         '''
-        line = json.dumps(message) + "\n"
-        logger = self.get_logger()
+        self.send_batch([message])
+
+    def send_batch(self, messages, traces = None):
+        '''
+        :param messages: list of messages to send
+        :param traces: list of ``(index, trace)`` tuples for messages that
+            are traced (see :attr:`tracer`)
 
+        Send a batch of messages with a single write.
+
+        In case of connectivity errors messages will be spooled and sent
+        later (see :meth:`send()`).
+        '''
         if not self.is_connected() and not self.repair_connection():
             # lost connection, can't repair it at the moment
-            dropped_count = self.spooler.spool(line)
-            self.spool_dropped.count += dropped_count
-            if self.spool_dropped.count > 0 and \
-               self.spool_dropped.should_fire():
-                logger.warn("%s: dropped %d pending messages", self.get_name(),
-                            self.spool_dropped.count)
-                self.spool_dropped.count = 0
-                self.spool_dropped.fired()
+            self.spool(messages, traces)
+            return
+
+        if len(self.spooler) > 0:
+            # keep the messages behind the already spooled ones (in their
+            # lanes), and send as much as the budget allows
+            self.spool(messages, traces)
+            self.send_pending(self.drain_budget)
             return
 
         # self.is_connected()
         if self.spool_dropped.count > 0:
+            logger = self.get_logger()
             logger.warn("%s: dropped %d pending messages", self.get_name(),
                         self.spool_dropped.count)
             self.spool_dropped.count = 0
             self.spool_dropped.reset()
 
-        if not self.send_pending() or not self.write(line):
-            # didn't send all the pending lines -- make the current one
-            # pending, too didn't send the current line -- make it pending
-            dropped_count = self.spooler.spool(line)
+        if traces:
+            start = self.tracer.clock()
+        if len(messages) == 1:
+            data = self.encode(messages[0])
+        elif self.output_format is not None:
+            # encode straight into the write buffer
+            buffer = []
+            self.output_format.encode_batch(messages, buffer)
+            data = "".join(buffer)
+        else:
+            data = "".join([self.encode(m) for m in messages])
+        if data == "":
+            # nothing the output format could carry
+            return
+        if traces:
+            encoded = self.tracer.clock()
+        if not self.write(data):
+            # didn't send the current lines -- make them pending
+            self.spool(messages, traces)
+        elif traces:
+            end = self.tracer.clock()
+            name = self.get_name()
+            for (i, trace) in traces:
+                self.tracer.record("encode", "destination", name,
+                                   encoded - start)
+                self.tracer.record("write", "destination", name,
+                                   end - encoded)
+                self.tracer.record("delivery", "destination", name,
+                                   end - trace.ingress)
+
+    def spool(self, messages, traces = None):
+        '''
+        :param messages: list of messages
+        :param traces: list of ``(index, trace)`` tuples for messages that
+            are traced
+
+        Put messages in the spooler, to be sent later.
+        '''
+        if traces:
+            start = self.tracer.clock()
+            traced = dict(traces)
+        else:
+            traced = None
+        for (i, message) in enumerate(messages):
+            line = self.json_line(message)
+            dropped_count = self.spooler.spool(line, message_lane(message))
             self.spool_dropped.count += dropped_count
-            if self.spool_dropped.count > 0 and \
-               self.spool_dropped.should_fire():
-                logger.warn("%s: dropped %d pending messages", self.get_name(),
-                            self.spool_dropped.count)
-                self.spool_dropped.count = 0
-                self.spool_dropped.fired()
+            if traced is not None and i in traced:
+                if len(self.spool_traces) >= self.max_spool_traces:
+                    # entries of lines dropped from spool never go away
+                    # otherwise
+                    self.spool_traces.clear()
+                self.spool_traces[id(line)] = (line, traced[i])
+        if traced is not None:
+            spooled = self.tracer.clock() - start
+            name = self.get_name()
+            for trace in traced.itervalues():
+                self.tracer.record("spool", "destination", name, spooled)
+        if self.spool_dropped.count > 0 and self.spool_dropped.should_fire():
+            logger = self.get_logger()
+            logger.warn("%s: dropped %d pending messages", self.get_name(),
+                        self.spool_dropped.count)
+            self.spool_dropped.count = 0
+            self.spool_dropped.fired()
 
-    def send_pending(self):
+    def json_line(self, message):
         '''
+        :param message: message to encode
+        :type message: dict or :class:`seismometer.message.Message`
+        :return: message as a JSON line, for spooling
+        '''
+        if isinstance(message, seismometer.message.Message):
+            return message.to_json() + "\n"
+        return json.dumps(message) + "\n"
+
+    def send_pending(self, max_bytes = None):
+        '''
+        :param max_bytes: maximum number of bytes to send (``None`` means no
+            limit)
         :return: ``True`` if all pending messages were sent successfully,
             ``False`` otherwise.
 
-        Send all pending messages.
+        Send pending messages.
         '''
         pending_before = len(self.spooler)
 
         sent_all_pending = True
+        sent_bytes = 0
         line = self.spooler.peek()
         while line is not None:
-            if self.write(line):
+            if max_bytes is not None and sent_bytes >= max_bytes:
+                sent_all_pending = False
+                break
+            if self.encoder is not None:
+                data = self.encoder.encode(json.loads(line))
+            else:
+                data = line
+            if data == "" or self.write(data):
+                sent_bytes += len(data)
                 self.spooler.drop_one()
+                if len(self.spool_traces) > 0:
+                    self._trace_delivery(line)
                 line = self.spooler.peek()
             else:
                 sent_all_pending = False
                 break
 
         pending_after = len(self.spooler)
-        if pending_before != pending_after:
-            # no need to log totally unsuccessful flushes (partially
-            # successful ones are somewhat interesting, however)
+        if pending_before != pending_after and \
+           (pending_after == 0 or not self.is_connected()):
+            # no need to log totally unsuccessful flushes, nor each step of
+            # sending a large spool (partially successful ones are somewhat
+            # interesting, however)
             logger = self.get_logger()
             logger.info("%s: sent %d pending messages, %d left",
                         self.get_name(), pending_before - pending_after,
                         pending_after)
         return sent_all_pending
 
+    def _trace_delivery(self, line):
+        entry = self.spool_traces.pop(id(line), None)
+        if entry is None:
+            return
+        trace = entry[1]
+        self.tracer.record("delivery", "destination", self.get_name(),
+                           self.tracer.clock() - trace.ingress)
+
     def flush(self):
         '''
-        Flush spool.
+        :return: ``True`` if there are still messages to send from spool
+
+        Flush spool (up to :attr:`drain_budget` bytes).
         '''
         if not self.is_connected() and not self.repair_connection():
-            return
-        self.send_pending()
+            return False
+        self.send_pending(self.drain_budget)
+        return self.is_connected() and len(self.spooler) > 0
+
+    def stats(self):
+        '''
+        :return: dictionary with keys ``"name"``, ``"connected"``, and
+            ``"spool"`` (lanes' depth and drops, see
+            :meth:`seismometer.spool.LaneSpooler.stats()`)
+        '''
+        return {
+            "name": self.get_name(),
+            "connected": self.is_connected(),
+            "spool": self.spooler.stats(),
+        }
+
+#-----------------------------------------------------------------------------
+
+def message_lane(message):
+    '''
+    :param message: message to classify
+    :type message: dict or :class:`seismometer.message.Message`
+    :return: ``"metric"`` or ``"state"``
+
+    Determine spool lane for a message: messages with a value set and no
+    state are metrics, everything else goes to the state lane.
+    '''
+    if isinstance(message, seismometer.message.Message):
+        is_metric = (len(message) > 0)
+        is_state = (message.state is not None)
+    else:
+        (is_metric, is_state) = seismometer.output.routing.message_kind(message)
+    if is_metric and not is_state:
+        return "metric"
+    return "state"
 
 #-----------------------------------------------------------------------------
 # vim:ft=python:foldmethod=marker
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+'''
+Message archive writer
+----------------------
+
+.. autoclass:: Archive
+   :members:
+
+'''
+#-----------------------------------------------------------------------------
+
+import os
+import logging
+import seismometer.archive
+import seismometer.message
+import seismometer.rate_limit
+
+#-----------------------------------------------------------------------------
+
+class Archive:
+    '''
+    Sender storing messages in a time-indexed archive directory (see
+    :mod:`seismometer.archive`).
+
+    Messages are written in compressed blocks, when a block is full or, on
+    :meth:`flush()`, when it's older than :obj:`max_block_age`. Messages
+    that can't be written (e.g. disk is full) are dropped.
+    '''
+    def __init__(self, directory, block_size = seismometer.archive.BLOCK_SIZE,
+                 max_block_age = 60):
+        '''
+        :param directory: archive directory
+        :param block_size: size of uncompressed block
+        :param max_block_age: maximum time (in seconds) messages are kept in
+            memory before their block is written
+        '''
+        self.directory = os.path.abspath(directory)
+        self.archive = seismometer.archive.ArchiveWriter(
+            self.directory,
+            block_size = block_size,
+        )
+        self.max_block_age = max_block_age
+        # "write failed" rate limiter
+        self.write_failed = seismometer.rate_limit.RateLimit(dropped = 0)
+
+    def get_logger(self):
+        return logging.getLogger("output.archive")
+
+    def get_name(self):
+        return "archive:%s" % (self.directory,)
+
+    def send(self, message):
+        self.send_batch([message])
+
+    def send_batch(self, messages):
+        messages = [
+            m.to_dict() if isinstance(m, seismometer.message.Message) else m
+            for m in messages
+        ]
+        try:
+            self.archive.write(messages)
+        except (IOError, OSError), e:
+            self._failed(e, len(messages))
+
+    def _failed(self, error, count):
+        self.write_failed.dropped += count
+        if self.write_failed.should_fire():
+            logger = self.get_logger()
+            logger.warn("%s: write failed: %s; dropped %d messages",
+                        self.get_name(), error, self.write_failed.dropped)
+            self.write_failed.dropped = 0
+            self.write_failed.fired()
+
+    def flush(self):
+        '''
+        Write blocks older than :obj:`max_block_age`.
+        '''
+        try:
+            self.archive.seal(self.max_block_age)
+        except (IOError, OSError), e:
+            self._failed(e, 0)
+        return False
+
+    def close(self):
+        '''
+        Write all the collected messages and close the archive.
+        '''
+        try:
+            self.archive.close()
+        except (IOError, OSError), e:
+            self._failed(e, 0)
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -0,0 +1,597 @@
+#!/usr/bin/python
+'''
+Setting up destinations
+-----------------------
+
+Building a :class:`seismometer.output.Writer` with its destinations, their
+spoolers and routing rules, from command line options shared by programs
+that send messages (:program:`messenger` and :program:`dumb-probe`).
+
+:func:`add_options()` adds the options to :mod:`optparse` parser, and
+:meth:`OutputFactory.from_options()` reads them back. Destinations are
+validated when they're added to :class:`OutputFactory`, and created (e.g.
+files opened) only in :meth:`OutputFactory.create_writer()`.
+
+:class:`OutputPipeline` is a writer with processing stages (see
+:mod:`seismometer.messenger.pipeline`) in front of it, for programs that
+produce messages themselves and send them directly to destinations, without
+a separate :program:`messenger` process in between. Such program can pass
+:class:`seismometer.message.Message` objects, which are serialized once, by
+the destination. They're converted to dictionaries only when stages or
+routing rules need to look at them.
+
+.. autofunction:: add_options
+
+.. autoclass:: OutputFactory
+   :members:
+
+.. autoclass:: OutputPipeline
+   :members:
+
+.. autofunction:: parse_size
+
+.. autofunction:: parse_interval
+
+.. autofunction:: parse_sync_policy
+
+'''
+#-----------------------------------------------------------------------------
+
+import json
+import time
+import logging
+import optparse
+import seismometer.output
+import seismometer.message
+import seismometer.spool
+import inet, stdout, unix, shm, archive, file, routing, pool, formats
+
+__all__ = [
+    'add_options', 'OutputFactory', 'OutputPipeline',
+    'parse_size', 'parse_interval', 'parse_sync_policy',
+]
+
+#-----------------------------------------------------------------------------
+# parsing option values {{{
+
+def parse_size(size):
+    '''
+    :param size: size in bytes, with optional ``k`` or ``M`` suffix
+    :rtype: integer
+    :throws: :exc:`ValueError`
+    '''
+    if size.endswith("k") or size.endswith("K"):
+        return int(size[0:-1]) * 1024
+    elif size.endswith("m") or size.endswith("M"):
+        return int(size[0:-1]) * 1024 * 1024
+    else:
+        return int(size)
+
+_INTERVAL_UNITS = [
+    ("ms", 0.001), ("s", 1), ("m", 60), ("h", 60 * 60), ("d", 24 * 60 * 60),
+]
+
+def parse_interval(interval):
+    '''
+    :param interval: interval in seconds, with optional ``ms``, ``s``, ``m``,
+        ``h``, or ``d`` suffix
+    :rtype: float
+    :throws: :exc:`ValueError`
+    '''
+    for (suffix, unit) in _INTERVAL_UNITS:
+        if interval.endswith(suffix):
+            return float(interval[0:-len(suffix)]) * unit
+    return float(interval)
+
+def parse_sync_policy(policy):
+    '''
+    :param policy: ``None``, ``"batch"``, interval, size, or interval and
+        size separated with comma
+    :return: tuple ``(sync_interval, sync_bytes)``
+    :throws: :exc:`ValueError`
+    '''
+    if policy is None:
+        return (None, None)
+    if policy == "batch":
+        return (None, 0)
+    (sync_interval, sync_bytes) = (None, None)
+    for spec in policy.split(","):
+        if spec.endswith("s"):
+            sync_interval = parse_interval(spec)
+        else:
+            sync_bytes = parse_size(spec)
+    return (sync_interval, sync_bytes)
+
+# }}}
+#-----------------------------------------------------------------------------
+# command line options {{{
+
+def _preceding_destination(opt, parser):
+    if len(parser.values.destination) == 0:
+        raise optparse.OptionValueError(
+            "option %s: needs to follow --destination" % (opt,)
+        )
+    return len(parser.values.destination) - 1
+
+def _add_route(option, opt, value, parser):
+    dest_idx = _preceding_destination(opt, parser)
+    parser.values.routes.setdefault(dest_idx, []).append(value)
+
+def _set_wire_format(option, opt, value, parser):
+    dest_idx = _preceding_destination(opt, parser)
+    if value not in ("json", "binary"):
+        raise optparse.OptionValueError(
+            "option %s: invalid wire format: %r" % (opt, value)
+        )
+    parser.values.wire_formats[dest_idx] = value
+
+def _set_dest_format(option, opt, value, parser):
+    dest_idx = _preceding_destination(opt, parser)
+    try:
+        formats.create(value)
+    except ValueError, e:
+        raise optparse.OptionValueError("option %s: %s" % (opt, e))
+    parser.values.dest_formats[dest_idx] = value
+
+def add_options(parser):
+    '''
+    :param parser: :class:`optparse.OptionParser` instance
+
+    Add options for destinations, spooling, and ``file:`` destinations to
+    the parser.
+    '''
+    parser.add_option(
+        "--destination", "--dest", dest = "destination",
+        action = "append", default = [],
+        help = "where to send messages (stdout, tcp:HOST:PORT, ssl:HOST:PORT,"
+               " udp:HOST:PORT, unix:PATH, unix-stream:PATH, shm:PATH,"
+               " archive:DIR, file:PATH, or pool:ADDR,ADDR,... with tcp: and"
+               " ssl: addresses; stdout is the default)",
+        metavar = "ADDR",
+    )
+    parser.add_option(
+        "--route", dest = "routes",
+        action = "callback", callback = _add_route, type = "string",
+        default = {},
+        help = "send only messages matching this rule to the preceding"
+               " destination (can be specified multiple times)",
+        metavar = "RULE",
+    )
+    parser.add_option(
+        "--wire", dest = "wire_formats",
+        action = "callback", callback = _set_wire_format, type = "string",
+        default = {},
+        help = "wire format for the preceding tcp:, ssl:, pool:, or"
+               " unix-stream: destination"
+               " (json or binary; binary falls back to json if the receiver"
+               " doesn't support it)",
+        metavar = "FORMAT",
+    )
+    parser.add_option(
+        "--dest-format", dest = "dest_formats",
+        action = "callback", callback = _set_dest_format, type = "string",
+        default = {},
+        help = "format of messages sent to the preceding destination (json,"
+               " graphite, graphite:TEMPLATE, or influx)",
+        metavar = "FORMAT",
+    )
+    parser.add_option(
+        "--ssl-ca-file", dest = "ssl_ca_file",
+        help = "file with CA certificates for SSL connection"
+               " (without this option no server verification is performed)",
+        metavar = "CA_FILE",
+    )
+    parser.add_option(
+        "--spool", dest = "spool_dir",
+        help = "directory to spool messages in case of network problems",
+        metavar = "SPOOLDIR",
+    )
+    parser.add_option(
+        "--max-spool", dest = "max_spool",
+        help = "how much to keep in spool before dropping the earliest"
+               " messages (in bytes; allowed suffixes are 'k' and 'M')",
+        metavar = "SIZE",
+    )
+    parser.add_option(
+        "--max-spool-metrics", dest = "max_spool_metrics",
+        help = "how much of the spool can be taken by metrics (messages with"
+               " values and no state); state messages are kept and sent first"
+               " (same units as --max-spool)",
+        metavar = "SIZE",
+    )
+    parser.add_option(
+        "--file-sync", dest = "file_sync",
+        default = None,
+        help = "when to sync file: destinations to disk: \"batch\" (after"
+               " every batch of messages), interval (e.g. 1s, 100ms), size"
+               " (e.g. 1M), or interval and size separated with comma"
+               " (default: leave it to the operating system)",
+        metavar = "POLICY",
+    )
+    parser.add_option(
+        "--file-max-size", dest = "file_max_size",
+        default = None,
+        help = "size to rotate file: destinations at (same units as"
+               " --max-spool)",
+        metavar = "SIZE",
+    )
+    parser.add_option(
+        "--file-rotate", dest = "file_rotate",
+        default = None,
+        help = "interval of rotating file: destinations (e.g. 1h, 1d; allowed"
+               " suffixes are 's', 'm', 'h', and 'd')",
+        metavar = "INTERVAL",
+    )
+    parser.add_option(
+        "--file-compress", dest = "file_compress",
+        action = "store_true", default = False,
+        help = "compress rotated files of file: destinations with gzip",
+    )
+
+# }}}
+#-----------------------------------------------------------------------------
+# destinations {{{
+
+_ADDRESS_TYPES = (
+    "tcp", "ssl", "pool", "udp", "unix", "unix-stream", "shm", "archive",
+    "file",
+)
+
+class OutputFactory:
+    '''
+    Set of destinations (with their routing rules and formats) and options
+    for creating them.
+
+    .. attribute:: destinations
+
+       list of ``(address, wire_format, output_format, rules)`` tuples, in
+       the order the destinations were added
+    '''
+    def __init__(self, ssl_ca_file = None, spool_dir = None, max_spool = None,
+                 max_spool_metrics = None, file_sync = None,
+                 file_max_size = None, file_rotate = None,
+                 file_compress = False):
+        '''
+        :param ssl_ca_file: file with CA certificates for ``ssl:``
+            destinations
+        :param spool_dir: directory to spool messages in (not supported yet)
+        :param max_spool: maximum size of a destination's spool (bytes)
+        :param max_spool_metrics: maximum size of a spool taken by metrics
+            (bytes)
+        :param file_sync: tuple ``(sync_interval, sync_bytes)`` for ``file:``
+            destinations (see :func:`parse_sync_policy()`)
+        :param file_max_size: size to rotate ``file:`` destinations at
+        :param file_rotate: interval of rotating ``file:`` destinations
+        :param file_compress: whether to compress rotated files
+        '''
+        self.ssl_ca_file = ssl_ca_file
+        self.spool_dir = spool_dir
+        self.max_spool = max_spool
+        self.max_spool_metrics = max_spool_metrics
+        self.file_sync = file_sync or (None, None)
+        self.file_max_size = file_max_size
+        self.file_rotate = file_rotate
+        self.file_compress = file_compress
+        self.destinations = []
+
+    @classmethod
+    def from_options(cls, options):
+        '''
+        :param options: options parsed by a parser with :func:`add_options()`
+        :rtype: :class:`OutputFactory`
+        :throws: :exc:`ValueError`
+
+        Create a factory with all the destinations from command line
+        (``stdout`` if there were none).
+        '''
+        try:
+            max_spool = max_spool_metrics = None
+            if options.max_spool is not None:
+                max_spool = parse_size(options.max_spool)
+            if options.max_spool_metrics is not None:
+                max_spool_metrics = parse_size(options.max_spool_metrics)
+        except ValueError:
+            raise ValueError("invalid --max-spool or --max-spool-metrics")
+        try:
+            file_sync = parse_sync_policy(options.file_sync)
+        except ValueError:
+            raise ValueError("invalid --file-sync")
+        try:
+            file_max_size = file_rotate = None
+            if options.file_max_size is not None:
+                file_max_size = parse_size(options.file_max_size)
+            if options.file_rotate is not None:
+                file_rotate = parse_interval(options.file_rotate)
+        except ValueError:
+            raise ValueError("invalid --file-max-size or --file-rotate")
+
+        factory = cls(
+            ssl_ca_file = options.ssl_ca_file,
+            spool_dir = options.spool_dir,
+            max_spool = max_spool,
+            max_spool_metrics = max_spool_metrics,
+            file_sync = file_sync,
+            file_max_size = file_max_size,
+            file_rotate = file_rotate,
+            file_compress = options.file_compress,
+        )
+        for (dest_idx, address) in enumerate(options.destination or
+                                             ["stdout"]):
+            factory.add_destination(
+                address,
+                wire_format = options.wire_formats.get(dest_idx, "json"),
+                output_format = options.dest_formats.get(dest_idx, "json"),
+                routes = options.routes.get(dest_idx, ()),
+            )
+        return factory
+
+    def add_destination(self, address, wire_format = "json",
+                        output_format = "json", routes = ()):
+        '''
+        :param address: destination address, e.g. ``tcp:HOST:PORT``, or JSON
+            specification of a plugin (see
+            :func:`seismometer.messenger.pipeline.load_plugin()`)
+        :param wire_format: ``"json"`` or ``"binary"``
+        :param output_format: output format specification (see
+            :func:`seismometer.output.formats.create()`)
+        :param routes: list of routing rule specifications (see
+            :mod:`seismometer.output.routing`)
+        :throws: :exc:`ValueError`
+
+        Add a destination to create.
+        '''
+        kind = address.split(":", 1)[0]
+        if address != "stdout" and not address.startswith("{") and \
+           (":" not in address or kind not in _ADDRESS_TYPES):
+            raise ValueError("invalid --destination: %s" % (address,))
+        if wire_format != "json" and \
+           kind not in ("tcp", "ssl", "pool", "unix-stream"):
+            raise ValueError("--wire is only supported for tcp:, ssl:, pool:,"
+                             " and unix-stream: destinations")
+        if output_format != "json":
+            if kind in ("shm", "archive") or address.startswith("{"):
+                raise ValueError("--dest-format is not supported for shm:,"
+                                 " archive:, and plugin destinations")
+            if wire_format != "json":
+                raise ValueError("--dest-format can't be used with --wire=%s" % \
+                                 (wire_format,))
+            formats.create(output_format)
+        if kind == "pool":
+            for member in address[5:].split(","):
+                if not (member.startswith("tcp:") or member.startswith("ssl:")):
+                    raise ValueError("pool: members need to be tcp: or ssl:"
+                                     " addresses")
+        rules = []
+        for spec in routes:
+            try:
+                rules.append(routing.Rule.parse(spec))
+            except ValueError, e:
+                raise ValueError("invalid --route %r: %s" % (spec, e))
+            logger = logging.getLogger("output")
+            logger.info("adding route for destination #%d: %s",
+                        len(self.destinations), spec)
+        self.destinations.append((address, wire_format, output_format, rules))
+
+    def create_spooler(self):
+        '''
+        :return: spooler for a destination or ``None`` if messages shouldn't
+            be spooled
+        '''
+        if self.max_spool is None and self.max_spool_metrics is None:
+            return None
+
+        lane_max = {}
+        if self.max_spool_metrics is not None:
+            lane_max["metric"] = self.max_spool_metrics
+
+        if self.spool_dir is not None:
+            # TODO: implement disk spooler
+            raise NotImplementedError("spooling to disk not supported yet")
+        elif self.max_spool is not None:
+            return seismometer.spool.LaneSpooler(
+                max = self.max_spool,
+                lane_max = lane_max,
+            )
+        else:
+            return seismometer.spool.LaneSpooler(lane_max = lane_max)
+
+    def create_writer(self, loop = None, tracer = None):
+        '''
+        :param loop: event loop for the writer (see
+            :class:`seismometer.output.Writer`)
+        :param tracer: tracer for the writer
+        :rtype: :class:`seismometer.output.Writer`
+        :throws: :exc:`ValueError`
+
+        Create all the destinations and a writer sending messages to them.
+        '''
+        writer = seismometer.output.Writer(loop = loop, tracer = tracer)
+        for (address, wire_format, output_format, rules) in self.destinations:
+            if output_format == "json":
+                output_format = None
+            else:
+                logger = logging.getLogger("output")
+                logger.info("destination %s format: %s", address,
+                            output_format)
+                output_format = formats.create(output_format)
+            writer.add(self.create(address, wire_format, output_format), rules)
+        return writer
+
+    def create(self, address, wire_format = "json", output_format = None):
+        '''
+        :param address: destination address
+        :param wire_format: ``"json"`` or ``"binary"``
+        :param output_format: encoder (see :mod:`seismometer.output.formats`)
+            or ``None`` for JSON lines
+        :return: output socket
+        :throws: :exc:`ValueError`
+
+        Create a single destination.
+        '''
+        logger = logging.getLogger("output")
+
+        if address == "stdout":
+            logger.info("adding destination: STDOUT")
+            return stdout.STDOUT(output_format)
+
+        if address.startswith("tcp:") or address.startswith("ssl:"):
+            return self._connection(address, wire_format, output_format)
+
+        if address.startswith("pool:"):
+            logger.info("adding destination: pool")
+            members = [
+                self._connection(m, wire_format, output_format)
+                for m in address[5:].split(",")
+            ]
+            return pool.Pool(members)
+
+        if address.startswith("udp:"):
+            (host, port) = self._host_port(address[4:])
+            logger.info("adding destination: UDP:%s:%d", host, port)
+            return inet.UDP(host, port, output_format)
+
+        if address.startswith("unix:"):
+            path = address[5:]
+            logger.info("adding destination: UNIX:%s", path)
+            return unix.UNIX(path, self.create_spooler(), output_format)
+
+        if address.startswith("unix-stream:"):
+            path = address[12:]
+            logger.info("adding destination: UNIX-STREAM:%s (%s)", path,
+                        wire_format)
+            return unix.UNIXStream(path, self.create_spooler(), wire_format,
+                                   output_format)
+
+        if address.startswith("shm:"):
+            path = address[4:]
+            logger.info("adding destination: SHM:%s", path)
+            return shm.SHM(path, self.create_spooler())
+
+        if address.startswith("archive:"):
+            directory = address[8:]
+            logger.info("adding destination: ARCHIVE:%s", directory)
+            return archive.Archive(directory)
+
+        if address.startswith("file:"):
+            path = address[5:]
+            logger.info("adding destination: FILE:%s", path)
+            (sync_interval, sync_bytes) = self.file_sync
+            return file.File(
+                path,
+                sync_interval = sync_interval,
+                sync_bytes = sync_bytes,
+                max_size = self.file_max_size,
+                rotate_interval = self.file_rotate,
+                compress = self.file_compress,
+                output_format = output_format,
+            )
+
+        if address.startswith("{"):
+            # imported here, as seismometer.messenger imports this package
+            import seismometer.messenger.pipeline
+            try:
+                spec = json.loads(address)
+                logger.info("adding destination: plugin %s",
+                            spec.get("class"))
+                return seismometer.messenger.pipeline.load_plugin(spec)
+            except ValueError, e:
+                raise ValueError("invalid destination plugin: %s" % (e,))
+
+        raise ValueError("invalid --destination: %s" % (address,))
+
+    def _host_port(self, address):
+        try:
+            (host, port) = address.split(":")
+            return (host, int(port))
+        except ValueError:
+            raise ValueError("invalid address: %s" % (address,))
+
+    def _connection(self, address, wire_format, output_format):
+        logger = logging.getLogger("output")
+        (host, port) = self._host_port(address[4:])
+        if address.startswith("tcp:"):
+            logger.info("adding destination: TCP:%s:%d (%s)", host, port,
+                        wire_format)
+            return inet.TCP(host, port, self.create_spooler(), wire_format,
+                            output_format)
+        logger.info("adding destination: SSL:%s:%d (%s)", host, port,
+                    wire_format)
+        return inet.SSL(host, port, self.ssl_ca_file, self.create_spooler(),
+                        wire_format, output_format)
+
+# }}}
+#-----------------------------------------------------------------------------
+# embedded pipeline {{{
+
+class OutputPipeline:
+    '''
+    Processing stages followed by a writer, for sending messages produced in
+    the same process.
+
+    If the writer has an event loop, stages are flushed by a timer in the
+    loop. Otherwise both the stages and the writer are flushed from
+    :meth:`send()`.
+    '''
+    def __init__(self, writer, stages = None, flush_interval = 1.0):
+        '''
+        :param writer: :class:`seismometer.output.Writer` to send messages to
+        :param stages: :class:`seismometer.messenger.pipeline.Pipeline` (or
+            other object with ``process()``, ``flush()``, and ``len()``) to
+            pass messages through before sending them
+        :param flush_interval: interval (in seconds) between flushing stages
+        '''
+        self.writer = writer
+        self.stages = stages
+        self.flush_interval = flush_interval
+        self._next_flush = time.time() + flush_interval
+        self._has_stages = (stages is not None and len(stages) > 0)
+        # stages and routing rules work on message dictionaries
+        self._dicts = self._has_stages or writer.routes.has_rules()
+        if self._has_stages and writer.loop is not None:
+            writer.loop.call_later(flush_interval, self._flush_timer)
+
+    def _flush_timer(self):
+        self.writer.write_batch(self.stages.flush(time.time()))
+        self.writer.loop.call_later(self.flush_interval, self._flush_timer)
+
+    def send(self, messages):
+        '''
+        :param messages: list of messages (dicts or
+            :class:`seismometer.message.Message` instances)
+
+        Pass messages through the stages and send them to the destinations.
+        '''
+        if self._dicts:
+            Message = seismometer.message.Message
+            messages = [
+                m.to_dict() if isinstance(m, Message) else m
+                for m in messages
+            ]
+        if self._has_stages:
+            messages = self.stages.process(messages)
+        self.writer.write_batch(messages)
+        if self.writer.loop is None:
+            now = time.time()
+            if self._has_stages and now >= self._next_flush:
+                self._next_flush = now + self.flush_interval
+                self.writer.write_batch(self.stages.flush(now))
+            self.writer.flush()
+
+    def reopen(self):
+        '''
+        Reopen files of the destinations (see
+        :meth:`seismometer.output.Writer.reopen()`).
+        '''
+        self.writer.reopen()
+
+    def close(self):
+        '''
+        Flush the stages and close the destinations.
+        '''
+        if self._has_stages:
+            self.writer.write_batch(self.stages.flush(time.time()))
+        self.writer.close()
+
+# }}}
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -0,0 +1,315 @@
+#!/usr/bin/python
+'''
+File message writer
+-------------------
+
+.. autoclass:: File
+   :members:
+
+.. autofunction:: compress_file
+
+'''
+#-----------------------------------------------------------------------------
+
+import os
+import time
+import gzip
+import errno
+import signal
+import shutil
+import logging
+import seismometer.rate_limit
+import seismometer.output.formats
+
+#-----------------------------------------------------------------------------
+
+def compress_file(path):
+    '''
+    :param path: file to compress
+
+    Compress a file with gzip, replacing it with ``<path>.gz``.
+    '''
+    with open(path, "rb") as src:
+        dest = gzip.open(path + ".gz.tmp", "wb")
+        try:
+            shutil.copyfileobj(src, dest, 1024 * 1024)
+        finally:
+            dest.close()
+    os.rename(path + ".gz.tmp", path + ".gz")
+    os.unlink(path)
+
+#-----------------------------------------------------------------------------
+
+class File:
+    '''
+    Sender writing messages to a file, one JSON per line (or in another
+    format, see :mod:`seismometer.output.formats`).
+
+    Messages are collected in a buffer and written when the buffer is full or
+    every :obj:`flush_interval` seconds. Written data is synced to disk
+    (``fsync()``) in groups: every :obj:`sync_interval` seconds, after
+    :obj:`sync_bytes` bytes were written, or both, whichever comes first.
+    Without either, syncing is left to the operating system.
+
+    The file can be rotated when it reaches :obj:`max_size` or every
+    :obj:`rotate_interval` seconds (aligned to epoch, so e.g. 3600 rotates
+    at full hours). Rotated file is renamed to ``<path>.YYYYMMDD-HHMMSS``
+    (local time of rotation) and, if :obj:`compress` is set, gzipped by
+    a child process.
+
+    Timers for writing and syncing need an event loop (see :meth:`attach()`).
+    Without one, they're run on :meth:`flush()`.
+
+    Messages that can't be written (e.g. disk is full) are dropped.
+    '''
+    def __init__(self, path, buffer_size = 1024 * 1024, flush_interval = 1,
+                 sync_interval = None, sync_bytes = None,
+                 max_size = None, rotate_interval = None, compress = False,
+                 output_format = None):
+        '''
+        :param path: file to write to
+        :param buffer_size: number of bytes collected before writing
+        :param flush_interval: maximum time (in seconds) messages stay in
+            the buffer
+        :param sync_interval: interval (in seconds) between syncing the file
+            to disk
+        :param sync_bytes: number of bytes written before syncing the file
+            to disk (``0`` syncs after every batch of messages)
+        :param max_size: size of the file to rotate it at
+        :param rotate_interval: interval (in seconds) of rotating the file
+        :param compress: whether to compress rotated files
+        :param output_format: encoder of a format other than JSON lines
+        '''
+        self.path = os.path.abspath(path)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.sync_interval = sync_interval
+        self.sync_bytes = sync_bytes
+        self.max_size = max_size
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        if output_format is None:
+            output_format = seismometer.output.formats.JSONEncoder()
+        self.output_format = output_format
+        self.file = None
+        self.size = 0
+        self._buffer = []
+        self._buffered = 0
+        self._buffered_messages = 0
+        self._unsynced = 0
+        self._next_rotation = None
+        self._next_sync = None
+        self._children = []
+        self._loop = None
+        # "write failed" rate limiter
+        self.write_failed = seismometer.rate_limit.RateLimit(dropped = 0)
+
+    def get_logger(self):
+        return logging.getLogger("output.file")
+
+    def get_name(self):
+        return "file:%s" % (self.path,)
+
+    def attach(self, loop):
+        '''
+        :param loop: :class:`seismometer.eventloop.EventLoop` instance
+
+        Schedule writing and syncing the file in the event loop.
+        '''
+        self._loop = loop
+        loop.call_later(self._timer_interval(), self._timer)
+
+    def _timer_interval(self):
+        if self.sync_interval is not None:
+            return min(self.flush_interval, self.sync_interval)
+        return self.flush_interval
+
+    def _timer(self):
+        self._tick(time.time())
+        self._loop.call_later(self._timer_interval(), self._timer)
+
+    def _tick(self, now):
+        self._write()
+        if self._next_sync is not None and now >= self._next_sync:
+            self._sync()
+        if self._next_rotation is not None and now >= self._next_rotation:
+            self._rotate()
+        self._reap()
+
+    #-------------------------------------------------------------------
+    # file operations
+
+    def _open(self):
+        # throws IOError
+        if self.file is not None:
+            return
+        self.file = open(self.path, "ab")
+        self.size = os.fstat(self.file.fileno()).st_size
+        now = time.time()
+        if self.rotate_interval is not None:
+            self._next_rotation = \
+                (int(now) // self.rotate_interval + 1) * self.rotate_interval
+        if self.sync_interval is not None:
+            self._next_sync = now + self.sync_interval
+
+    def _close(self):
+        # the file is opened on the first write, so there may be buffered
+        # messages even if it's not open yet
+        self._write()
+        if self.file is None:
+            return
+        if self.sync_interval is not None or self.sync_bytes is not None:
+            self._sync()
+        try:
+            self.file.close()
+        except IOError:
+            pass
+        self.file = None
+        # size is read again when the file is opened; until then, it
+        # shouldn't trigger another rotation
+        self.size = 0
+        self._next_rotation = None
+        self._next_sync = None
+
+    def _write(self):
+        if self._buffered == 0:
+            return
+        data = "".join(self._buffer)
+        count = self._buffered_messages
+        self._buffer = []
+        self._buffered = 0
+        self._buffered_messages = 0
+        try:
+            self._open()
+            # file object's own buffer is flushed, too, so the data reaches
+            # the kernel with a single write()
+            self.file.write(data)
+            self.file.flush()
+        except IOError, e:
+            self._failed(e, count)
+            return
+        self.size += len(data)
+        self._unsynced += len(data)
+
+    def _sync(self):
+        if self.file is None or self._unsynced == 0:
+            return
+        try:
+            os.fsync(self.file.fileno())
+        except OSError, e:
+            self._failed(e, 0)
+        self._unsynced = 0
+        if self.sync_interval is not None:
+            self._next_sync = time.time() + self.sync_interval
+
+    def _rotate(self):
+        logger = self.get_logger()
+        self._close()
+        rotated = "%s.%s" % (self.path, time.strftime("%Y%m%d-%H%M%S"))
+        suffix = 0
+        while os.path.exists(rotated + (".%d" % suffix if suffix else "")):
+            suffix += 1
+        if suffix > 0:
+            rotated = "%s.%d" % (rotated, suffix)
+        try:
+            os.rename(self.path, rotated)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logger.warn("%s: can't rotate: %s", self.get_name(),
+                            e.strerror)
+            return
+        logger.info("%s: rotated to %s", self.get_name(), rotated)
+        if self.compress:
+            self._compress(rotated)
+
+    def _compress(self, path):
+        try:
+            pid = os.fork()
+        except OSError, e:
+            logger = self.get_logger()
+            logger.warn("%s: can't compress %s: %s", self.get_name(), path,
+                        e.strerror)
+            return
+        if pid == 0:
+            # child process: don't touch anything inherited from the parent
+            code = 1
+            try:
+                for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+                    signal.signal(signum, signal.SIG_DFL)
+                os.nice(10)
+                compress_file(path)
+                code = 0
+            finally:
+                os._exit(code)
+        self._children.append(pid)
+
+    def _reap(self):
+        for pid in self._children[:]:
+            try:
+                (result, status) = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                # already reaped by somebody else
+                self._children.remove(pid)
+                continue
+            if result == 0:
+                continue
+            self._children.remove(pid)
+            if status != 0:
+                logger = self.get_logger()
+                logger.warn("%s: compressing rotated file failed",
+                            self.get_name())
+
+    def _failed(self, error, count):
+        self.write_failed.dropped += count
+        if self.write_failed.should_fire():
+            logger = self.get_logger()
+            logger.warn("%s: write failed: %s; dropped %d messages",
+                        self.get_name(), error, self.write_failed.dropped)
+            self.write_failed.dropped = 0
+            self.write_failed.fired()
+
+    #-------------------------------------------------------------------
+    # output interface
+
+    def send(self, message):
+        self.send_batch([message])
+
+    def send_batch(self, messages):
+        self._buffered += \
+            self.output_format.encode_batch(messages, self._buffer)
+        self._buffered_messages += len(messages)
+
+        if self._buffered >= self.buffer_size or \
+           self.sync_bytes is not None and \
+           self._unsynced + self._buffered >= self.sync_bytes:
+            self._write()
+        if self.sync_bytes is not None and self._unsynced >= self.sync_bytes:
+            self._sync()
+        if self.max_size is not None and self.size >= self.max_size:
+            self._rotate()
+
+    def flush(self):
+        '''
+        Write buffered messages if there's no event loop to do that.
+        '''
+        if self._loop is None:
+            self._tick(time.time())
+        return False
+
+    def reopen(self):
+        '''
+        Close the file, so it's opened again on the next write (e.g. after it
+        was moved away by :manpage:`logrotate(8)`).
+        '''
+        self._close()
+        self.get_logger().info("%s: reopening", self.get_name())
+
+    def close(self):
+        '''
+        Write buffered messages and close the file.
+        '''
+        self._close()
+        self._reap()
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
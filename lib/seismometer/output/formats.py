@@ -0,0 +1,384 @@
+#!/usr/bin/python
+'''
+Output formats
+--------------
+
+Encoders converting messages to formats understood by storage systems other
+than *messenger*, so they can be fed directly, without a converting process
+in between.
+
+Each encoder has two methods: ``encode(message)``, returning the encoded
+message as a string, and ``encode_batch(messages, buffer)``, which appends
+encoded messages to a list (typically the output's write buffer) and returns
+the number of bytes appended. Messages can be dictionaries or
+:class:`seismometer.message.Message` instances. A message may be encoded to
+several lines (one per value) or to none at all, if the format can't carry
+anything from it.
+
+Encoded series prefix (everything that depends on aspect name and location
+only) is cached for each flow, so messages of a flow seen before only need
+their values and timestamp encoded.
+
+Graphite plaintext
+^^^^^^^^^^^^^^^^^^
+
+Each value from value set is a separate line ``<path> <value> <timestamp>``.
+Path is built from a template with location fields and aspect name in curly
+braces, e.g. ``servers.{host}.{aspect}``. Dots and other characters not
+allowed in a Graphite path are replaced with underscore in location values
+(but dots are kept in aspect name). Without a template (or for messages
+missing a field the template needs), path is made of all location values,
+in order of their field names, followed by the aspect name. Value name is
+appended to the path, except for the value called ``value``.
+
+Undefined values, infinities, NaNs, values that are not numbers, and
+integers too large for a float are skipped, and so are messages carrying only
+state.
+
+Line protocol
+^^^^^^^^^^^^^
+
+InfluxDB line protocol: aspect name is the measurement, location fields are
+tags (sorted by field name), values from value set are fields (always
+floats), and state and its severity are string fields ``state`` and
+``severity``. Timestamp is in nanoseconds. Values are skipped the same way
+as for Graphite.
+
+Messages without aspect name, location, or timestamp (or with any of these
+of a wrong type) are skipped by all encoders except JSON.
+
+.. autofunction:: create
+
+.. autoclass:: JSONEncoder
+   :members:
+
+.. autoclass:: GraphiteEncoder
+   :members:
+
+.. autoclass:: InfluxEncoder
+   :members:
+
+'''
+#-----------------------------------------------------------------------------
+
+import re
+import json
+import seismometer.message
+
+__all__ = [
+    'create', 'JSONEncoder', 'GraphiteEncoder', 'InfluxEncoder',
+]
+
+#-----------------------------------------------------------------------------
+
+def create(spec):
+    '''
+    :param spec: ``"json"``, ``"graphite"``, ``"graphite:<template>"``, or
+        ``"influx"``
+    :return: encoder instance
+    :throws: :exc:`ValueError`
+
+    Create an encoder from its textual specification (e.g. from command
+    line).
+    '''
+    if spec == "json":
+        return JSONEncoder()
+    if spec == "graphite":
+        return GraphiteEncoder()
+    if spec.startswith("graphite:"):
+        return GraphiteEncoder(spec[9:])
+    if spec == "influx":
+        return InfluxEncoder()
+    raise ValueError("unknown output format: %r" % (spec,))
+
+def _utf8(string):
+    if isinstance(string, unicode):
+        return string.encode("utf-8")
+    return str(string)
+
+def _series_key(aspect, location):
+    return (aspect, tuple(sorted(location.iteritems())))
+
+_INFINITY = float("inf")
+
+def _is_string(value):
+    return isinstance(value, (str, unicode))
+
+def _is_number(value):
+    # bool is a subclass of int, but it's not a number in a message
+    if not isinstance(value, (int, long, float)) or isinstance(value, bool):
+        return False
+    if isinstance(value, long):
+        # storage systems keep values as floats, and longs may not fit
+        try:
+            float(value)
+        except OverflowError:
+            return False
+        return True
+    return value == value and value != _INFINITY and value != -_INFINITY
+
+def _message_parts(message):
+    # (event, location, time) of a message that has the structure an encoder
+    # needs, or None
+    if isinstance(message, seismometer.message.Message):
+        message = message.to_dict()
+    if not isinstance(message, dict) or not _is_number(message.get("time")):
+        return None
+    event = message.get("event")
+    location = message.get("location")
+    if not isinstance(event, dict) or not _is_string(event.get("name")) or \
+       not isinstance(location, dict):
+        return None
+    for (field, value) in location.iteritems():
+        if not _is_string(field) or not _is_string(value):
+            return None
+    return (event, location, message["time"])
+
+#-----------------------------------------------------------------------------
+# JSON lines {{{
+
+class JSONEncoder:
+    '''
+    Encoder of JSON lines, the native format of *messenger*.
+    '''
+    def encode(self, message):
+        '''
+        :param message: message to encode
+        :return: encoded message
+        '''
+        if isinstance(message, seismometer.message.Message):
+            return message.to_json() + "\n"
+        return json.dumps(message) + "\n"
+
+    def encode_batch(self, messages, buffer):
+        '''
+        :param messages: list of messages to encode
+        :param buffer: list to append encoded messages to
+        :return: number of bytes appended
+        '''
+        size = 0
+        for message in messages:
+            line = self.encode(message)
+            buffer.append(line)
+            size += len(line)
+        return size
+
+# }}}
+#-----------------------------------------------------------------------------
+# Graphite plaintext {{{
+
+class GraphiteEncoder:
+    '''
+    Encoder of Graphite plaintext protocol.
+    '''
+    _TEMPLATE_FIELD = re.compile(r'\{([a-zA-Z0-9_]+)\}')
+    _INVALID_WORD = re.compile(r'[^a-zA-Z0-9_-]')
+    _INVALID_PATH = re.compile(r'[^a-zA-Z0-9_.-]')
+
+    def __init__(self, template = None, max_series = 100000):
+        '''
+        :param template: path template, e.g. ``servers.{host}.{aspect}``
+        :param max_series: maximum number of series whose paths are cached
+        :throws: :exc:`ValueError`
+        '''
+        if template is not None:
+            fields = self._TEMPLATE_FIELD.findall(template)
+            if "aspect" not in fields:
+                raise ValueError("template %r doesn't include {aspect}" % \
+                                 (template,))
+            self.fields = [f for f in fields if f != "aspect"]
+        else:
+            self.fields = None
+        self.template = template
+        self.max_series = max_series
+        # (aspect, location) => (path, {value name => "<value path> "})
+        self._series = {}
+
+    def _path(self, aspect, location):
+        aspect = self._INVALID_PATH.sub("_", _utf8(aspect))
+        if self.fields is None or \
+           [f for f in self.fields if f not in location]:
+            words = [self._word(location[f]) for f in sorted(location)]
+            words.append(aspect)
+            return ".".join(words)
+        return self._TEMPLATE_FIELD.sub(
+            lambda m: aspect if m.group(1) == "aspect" \
+                      else self._word(location[m.group(1)]),
+            self.template
+        )
+
+    def _word(self, word):
+        return self._INVALID_WORD.sub("_", _utf8(word)) or "_"
+
+    def _add_series(self, key, aspect, location):
+        if len(self._series) >= self.max_series:
+            self._series.clear()
+        entry = self._series[key] = (self._path(aspect, location), {})
+        return entry
+
+    def _value_path(self, entry, name):
+        (path, paths) = entry
+        if name != "value":
+            path = "%s.%s" % (path, self._word(name))
+        paths[name] = path + " "
+        return paths[name]
+
+    def encode(self, message):
+        '''
+        :param message: message to encode
+        :return: encoded message (possibly empty string)
+        '''
+        buffer = []
+        self.encode_batch([message], buffer)
+        return "".join(buffer)
+
+    def encode_batch(self, messages, buffer):
+        '''
+        :param messages: list of messages to encode
+        :param buffer: list to append encoded lines to
+        :return: number of bytes appended
+        '''
+        size = 0
+        series = self._series
+        for message in messages:
+            parts = _message_parts(message)
+            if parts is None:
+                continue
+            (event, location, timestamp) = parts
+            vset = event.get("vset")
+            if not vset or not isinstance(vset, dict):
+                continue
+            aspect = event["name"]
+            key = _series_key(aspect, location)
+            entry = series.get(key) or self._add_series(key, aspect, location)
+            paths = entry[1]
+            timestamp = " %d\n" % (timestamp,)
+            for (name, value) in vset.iteritems():
+                if not isinstance(value, dict) or not _is_string(name):
+                    continue
+                value = value.get("value")
+                if not _is_number(value):
+                    continue
+                path = paths.get(name) or self._value_path(entry, name)
+                if type(value) is float:
+                    line = path + repr(value) + timestamp
+                else:
+                    line = path + ("%d" % value) + timestamp
+                buffer.append(line)
+                size += len(line)
+        return size
+
+# }}}
+#-----------------------------------------------------------------------------
+# InfluxDB line protocol {{{
+
+class InfluxEncoder:
+    '''
+    Encoder of InfluxDB line protocol.
+    '''
+    def __init__(self, max_series = 100000):
+        '''
+        :param max_series: maximum number of series whose measurement and tags
+            are cached
+        '''
+        self.max_series = max_series
+        # (aspect, location) => "<measurement>,<tags> "
+        self._series = {}
+        # value name => "<field>="
+        self._fields = {}
+
+    @staticmethod
+    def _escape(string, special):
+        string = _utf8(string).replace("\n", " ")
+        if "\\" in string:
+            string = string.replace("\\", "\\\\")
+        for c in special:
+            if c in string:
+                string = string.replace(c, "\\" + c)
+        return string
+
+    @staticmethod
+    def _string(string):
+        string = _utf8(string).replace("\\", "\\\\").replace('"', '\\"')
+        return '"' + string + '"'
+
+    def _prefix(self, key, aspect, location):
+        if len(self._series) >= self.max_series:
+            self._series.clear()
+        tags = [
+            "%s=%s" % (self._escape(f, ", ="), self._escape(v, ", ="))
+            for (f, v) in sorted(location.iteritems())
+            if v != ""
+        ]
+        tags.insert(0, self._escape(aspect, ", "))
+        prefix = self._series[key] = ",".join(tags) + " "
+        return prefix
+
+    def _field(self, name):
+        if len(self._fields) >= self.max_series:
+            self._fields.clear()
+        field = self._fields[name] = self._escape(name, ", =") + "="
+        return field
+
+    def encode(self, message):
+        '''
+        :param message: message to encode
+        :return: encoded message (possibly empty string)
+        '''
+        buffer = []
+        self.encode_batch([message], buffer)
+        return "".join(buffer)
+
+    def encode_batch(self, messages, buffer):
+        '''
+        :param messages: list of messages to encode
+        :param buffer: list to append encoded lines to
+        :return: number of bytes appended
+        '''
+        size = 0
+        series = self._series
+        field_names = self._fields
+        for message in messages:
+            parts = _message_parts(message)
+            if parts is None:
+                continue
+            (event, location, timestamp) = parts
+            fields = []
+            vset = event.get("vset")
+            if vset and isinstance(vset, dict):
+                for (name, value) in vset.iteritems():
+                    if not isinstance(value, dict) or not _is_string(name):
+                        continue
+                    value = value.get("value")
+                    if not _is_number(value):
+                        continue
+                    field = field_names.get(name) or self._field(name)
+                    fields.append(field + repr(float(value)))
+            state = event.get("state")
+            if isinstance(state, dict) and _is_string(state.get("value")):
+                fields.append("state=" + self._string(state["value"]))
+                if _is_string(state.get("severity")):
+                    fields.append("severity=" +
+                                  self._string(state["severity"]))
+            if not fields:
+                continue
+
+            aspect = event["name"]
+            key = _series_key(aspect, location)
+            prefix = series.get(key) or self._prefix(key, aspect, location)
+
+            if type(timestamp) is int or type(timestamp) is long:
+                timestamp = " %d000000000\n" % (timestamp,)
+            else:
+                # float can't hold nanoseconds of current epoch time
+                # exactly, so it's rounded to microseconds first (integer
+                # arithmetic keeps the sign right for times before epoch)
+                timestamp = " %d\n" % (int(round(timestamp * 1e6)) * 1000,)
+            line = prefix + ",".join(fields) + timestamp
+            buffer.append(line)
+            size += len(line)
+        return size
+
+# }}}
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -20,6 +20,7 @@ import ssl
 import json
 from _connection_output import ConnectionOutput
 import logging
+import seismometer.message
 import seismometer.rate_limit
 import platform
 
@@ -30,18 +31,23 @@ class TCP(ConnectionOutput):
     Sender passing message to another messenger (or anything accepting raw JSON
     lines through TCP).
     '''
-    def __init__(self, host, port, spooler = None):
+    def __init__(self, host, port, spooler = None, wire_format = "json",
+                 output_format = None):
         '''
         :param host: address to send data to
         :param port: address to send data to
         :param spooler: spooler object
+        :param wire_format: ``"json"`` or ``"binary"`` (the latter falls back
+            to JSON if the receiver doesn't support it)
+        :param output_format: encoder of a format other than JSON lines (see
+            :mod:`seismometer.output.formats`)
         '''
         self.host = host
         self.port = port
         self.conn = None
         # "connection still closed" rate limiter
         self.conn_still_closed = seismometer.rate_limit.RateLimit()
-        super(TCP, self).__init__(spooler)
+        super(TCP, self).__init__(spooler, wire_format, output_format)
 
     def get_logger(self):
         return logging.getLogger("output.tcp")
@@ -54,7 +60,7 @@ class TCP(ConnectionOutput):
             return False
 
         try:
-            self.conn.send(line)
+            self.conn.sendall(line)
             return True
         except socket.error: # this covers `socket.timeout'
             # lost connection
@@ -82,6 +88,7 @@ class TCP(ConnectionOutput):
                 conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 30)
                 # after this many probes the connection drops
                 conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 9)
+            self.negotiate(conn)
             self.conn = conn
             logger.info("%s: reconnected", self.get_name())
             self.conn_still_closed.reset()
@@ -105,12 +112,17 @@ class SSL(ConnectionOutput):
     Sender passing message to an SSL-enabled service that accepts raw JSON
     lines.
     '''
-    def __init__(self, host, port, ca_file = None, spooler = None):
+    def __init__(self, host, port, ca_file = None, spooler = None,
+                 wire_format = "json", output_format = None):
         '''
         :param host: address to send data to
         :param port: address to send data to
         :param ca_file: file with CA certificates to verify server cert
         :param spooler: spooler object
+        :param wire_format: ``"json"`` or ``"binary"`` (the latter falls back
+            to JSON if the receiver doesn't support it)
+        :param output_format: encoder of a format other than JSON lines (see
+            :mod:`seismometer.output.formats`)
         '''
         self.host = host
         self.port = port
@@ -118,7 +130,7 @@ class SSL(ConnectionOutput):
         self.conn = None
         # "connection still closed" rate limiter
         self.conn_still_closed = seismometer.rate_limit.RateLimit()
-        super(SSL, self).__init__(spooler)
+        super(SSL, self).__init__(spooler, wire_format, output_format)
 
     def get_logger(self):
         return logging.getLogger("output.ssl")
@@ -131,7 +143,7 @@ class SSL(ConnectionOutput):
             return False
 
         try:
-            self.conn.send(line)
+            self.conn.sendall(line)
             return True
         except socket.error: # this covers `socket.timeout'
             # lost connection
@@ -162,6 +174,7 @@ class SSL(ConnectionOutput):
             conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 30)
             # after this many probes the connection drops
             conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 9)
+        self.negotiate(conn)
         return conn
 
     def repair_connection(self):
@@ -191,18 +204,28 @@ class UDP:
     lines through UDP).
     '''
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, output_format = None):
         '''
         :param host: address to send data to
         :param port: address to send data to
+        :param output_format: encoder of a format other than JSON lines (see
+            :mod:`seismometer.output.formats`)
         '''
         self.host = host
         self.port = port
+        self.output_format = output_format
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.conn.connect((self.host, self.port))
 
     def send(self, message):
-        line = json.dumps(message) + "\n"
+        if self.output_format is not None:
+            line = self.output_format.encode(message)
+            if line == "":
+                return
+        elif isinstance(message, seismometer.message.Message):
+            line = message.to_json() + "\n"
+        else:
+            line = json.dumps(message) + "\n"
         self.conn.send(line)
 
     def flush(self):
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+'''
+Pool of output sockets
+----------------------
+
+:class:`Pool` spreads messages over several output sockets (typically
+:class:`seismometer.output.inet.TCP` instances), so that all the messages of
+a single flow (aspect name + location) go to the same socket. This keeps the
+state of each flow in one receiver, which matters for tools like
+:program:`hailerter`.
+
+Sockets are placed on a ring of hashes (*consistent hashing*), each at many
+points. Message goes to the socket owning the first point on the ring after
+the hash of message's flow. If that socket is down, the message goes to the
+next socket on the ring. Adding, removing, failing, or recovering a socket
+moves only the flows that belong (or belonged) to that socket.
+
+Socket that failed to send a message is considered down and is not tried
+again until :meth:`Pool.flush()` is called after retry interval.
+
+A batch of messages is split by the socket each message goes to, and each
+socket gets its part with a single write.
+
+.. autoclass:: Pool
+   :members:
+
+'''
+#-----------------------------------------------------------------------------
+
+import time
+import struct
+import bisect
+import hashlib
+import logging
+import seismometer.message
+from seismometer.output.routing import message_aspect, message_location
+
+__all__ = [
+    'Pool',
+]
+
+#-----------------------------------------------------------------------------
+
+class Pool:
+    '''
+    Output socket that sends each message to one of its member sockets.
+
+    Members are expected to be instances of
+    :class:`seismometer.output._connection_output.ConnectionOutput` (each
+    with its own connection and spooler).
+    '''
+    def __init__(self, members, replicas = 128, retry_interval = 10,
+                 cache_size = 65536):
+        '''
+        :param members: list of output sockets
+        :param replicas: number of points on the hash ring for each member
+        :param retry_interval: time (seconds) after which a failed member is
+            tried again
+        :param cache_size: number of flows to remember positions on the ring
+            for
+        '''
+        if len(members) == 0:
+            raise ValueError("pool needs at least one member")
+        self.members = list(members)
+        self.retry_interval = retry_interval
+        self.cache_size = cache_size
+        # members' counters and state
+        self.sent = [0] * len(self.members)
+        self.failovers = [0] * len(self.members)
+        self.down_until = [None] * len(self.members)
+
+        ring = []
+        for (idx, member) in enumerate(self.members):
+            for i in xrange(replicas):
+                point = _hash("%s#%d" % (member.get_name(), i))
+                ring.append((point, idx))
+        ring.sort()
+        self._points = [entry[0] for entry in ring]
+        self._owners = [entry[1] for entry in ring]
+        self._order_cache = {} # flow key => tuple of member indices
+
+    def get_logger(self):
+        return logging.getLogger("output.pool")
+
+    def get_name(self):
+        return "pool(%s)" % (",".join(m.get_name() for m in self.members),)
+
+    def order(self, message):
+        '''
+        :param message: message to find members for
+        :type message: dict or :class:`seismometer.message.Message`
+        :return: tuple of member indices, in order of preference
+
+        Return the members the message should be sent to: the owner of
+        message's flow first, then the others in ring order.
+        '''
+        key = _flow_key(message)
+        order = self._order_cache.get(key)
+        if order is not None:
+            return order
+
+        pos = bisect.bisect(self._points, _hash(key))
+        order = []
+        for i in xrange(len(self._owners)):
+            idx = self._owners[(pos + i) % len(self._owners)]
+            if idx not in order:
+                order.append(idx)
+                if len(order) == len(self.members):
+                    break
+        order = tuple(order)
+
+        if len(self._order_cache) >= self.cache_size:
+            self._order_cache.clear()
+        self._order_cache[key] = order
+        return order
+
+    def send(self, message):
+        '''
+        :param message: message to send
+
+        Send the message to the first member of :meth:`order()` that is not
+        down. If all of them are down, the message is spooled in the flow
+        owner's spooler.
+        '''
+        self.send_batch([message])
+
+    def send_batch(self, messages):
+        '''
+        :param messages: list of messages to send
+
+        Send messages, each to its member (see :meth:`send()`). Messages for
+        the same member are sent in a single batch, in their original order.
+        '''
+        now = time.time()
+        batches = {}    # member index => messages to send
+        spool = {}      # member index => messages to spool (all members down)
+        for message in messages:
+            order = self.order(message)
+            for idx in order:
+                if self._available(idx, now):
+                    break
+            else:
+                spool.setdefault(order[0], []).append(message)
+                continue
+            batches.setdefault(idx, []).append(message)
+            self.sent[idx] += 1
+            if idx != order[0]:
+                self.failovers[idx] += 1
+
+        for (idx, batch) in sorted(batches.iteritems()):
+            member = self.members[idx]
+            member.send_batch(batch)
+            if not member.is_connected():
+                # the messages were spooled by the member, they're going to
+                # be sent when the member comes back
+                self._mark_down(idx, now)
+        for (idx, batch) in sorted(spool.iteritems()):
+            self.members[idx].spool(batch)
+
+    def _available(self, idx, now):
+        # check if the member is up, trying to recover it if it was down
+        # for long enough
+        if self.down_until[idx] is not None:
+            if self.down_until[idx] > now:
+                return False
+            self._try_recover(idx, now)
+            if self.down_until[idx] is not None:
+                return False
+        member = self.members[idx]
+        if not member.is_connected() and not member.repair_connection():
+            self._mark_down(idx, now)
+            return False
+        return True
+
+    def _mark_down(self, idx, now):
+        if self.down_until[idx] is None:
+            logger = self.get_logger()
+            logger.warn("%s: member down, moving its flows to other members",
+                        self.members[idx].get_name())
+        self.down_until[idx] = now + self.retry_interval
+
+    def _try_recover(self, idx, now):
+        member = self.members[idx]
+        if member.is_connected() or member.repair_connection():
+            logger = self.get_logger()
+            logger.info("%s: member back up", member.get_name())
+            self.down_until[idx] = None
+        else:
+            self.down_until[idx] = now + self.retry_interval
+
+    def flush(self):
+        '''
+        :return: ``True`` if any of the members has more messages to flush
+
+        Retry members that are down (if it's time already) and flush all
+        members that are up.
+        '''
+        more = False
+        now = time.time()
+        for (idx, member) in enumerate(self.members):
+            if self.down_until[idx] is not None:
+                if self.down_until[idx] > now:
+                    continue
+                self._try_recover(idx, now)
+                if self.down_until[idx] is not None:
+                    continue
+            if member.flush():
+                more = True
+        return more
+
+    def stats(self):
+        '''
+        :return: list of dictionaries
+
+        Return counters of all members. Each dictionary has keys ``"name"``,
+        ``"up"``, ``"sent"`` (messages sent or spooled by the member),
+        ``"failovers"`` (messages that the member got because their owner
+        was down), ``"spooled"`` (messages waiting in member's spooler), and
+        ``"lanes"`` (member's spool stats per lane, see
+        :meth:`seismometer.spool.LaneSpooler.stats()`).
+        '''
+        return [
+            {
+                "name": member.get_name(),
+                "up": self.down_until[idx] is None,
+                "sent": self.sent[idx],
+                "failovers": self.failovers[idx],
+                "spooled": len(member.spooler),
+                "lanes": member.spooler.stats(),
+            }
+            for (idx, member) in enumerate(self.members)
+        ]
+
+#-----------------------------------------------------------------------------
+
+def _hash(string):
+    if isinstance(string, unicode):
+        string = string.encode("utf-8")
+    return struct.unpack(">Q", hashlib.md5(string).digest()[:8])[0]
+
+def _utf8(value):
+    if isinstance(value, str):
+        return value
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return value.encode("utf-8")
+
+def _flow_key(message):
+    if isinstance(message, seismometer.message.Message):
+        aspect = message.aspect
+        location = message.location
+    else:
+        aspect = message_aspect(message)
+        location = message_location(message)
+    if aspect is None:
+        # not a schema-conforming message; they all go to the same member
+        return ""
+    parts = [_utf8(aspect)]
+    for name in sorted(location):
+        parts.append(_utf8(name))
+        parts.append(_utf8(location[name]))
+    return "\0".join(parts)
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
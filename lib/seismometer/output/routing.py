@@ -0,0 +1,429 @@
+#!/usr/bin/python
+'''
+Routing messages to selected destinations
+-----------------------------------------
+
+By default every message is sent to every destination. A destination can be
+restricted with routing rules, so it only receives messages that match at
+least one of its rules.
+
+A rule is a comma-separated list of conditions, all of which need to be met:
+
+* ``aspect=NAME`` -- aspect name equal to ``NAME``
+* ``aspect=GLOB`` -- aspect name matching shell-like glob (``*``, ``?``,
+  ``[...]``)
+* ``aspect=/REGEXP/`` -- aspect name matching regular expression (whole name
+  needs to match; ``"/"`` needs to be quoted with backslash)
+* ``kind=metric`` or ``kind=state`` -- message carrying value set or state,
+  respectively
+* ``location.KEY=VALUE`` -- location field ``KEY`` equal to ``VALUE``
+
+Example rules::
+
+   kind=state
+   kind=metric,aspect=disk *
+   aspect=/(cpu|memory) usage/,location.datacenter=dc1
+
+Rules are compiled into an index (exact aspect names, then a prefix tree of
+globs, then regexps), so routing a message doesn't need to check every rule
+defined. Routing decisions are additionally cached.
+
+.. autoclass:: Rule
+   :members:
+
+.. autoclass:: RoutingTable
+   :members:
+
+'''
+#-----------------------------------------------------------------------------
+
+import re
+import fnmatch
+
+__all__ = [
+    'Rule', 'RoutingTable',
+]
+
+#-----------------------------------------------------------------------------
+
+def message_kind(message):
+    '''
+    :return: tuple ``(is_metric, is_state)``
+
+    Determine what kind of data the message dictionary carries.
+    '''
+    event = message.get("event")
+    if not isinstance(event, dict):
+        return (False, False)
+    return (isinstance(event.get("vset"), dict),
+            isinstance(event.get("state"), dict))
+
+def message_aspect(message):
+    '''
+    :return: aspect name or ``None``
+
+    Extract aspect name from message dictionary.
+    '''
+    event = message.get("event")
+    if not isinstance(event, dict):
+        return None
+    aspect = event.get("name")
+    if not isinstance(aspect, (str, unicode)):
+        return None
+    return aspect
+
+def message_location(message):
+    '''
+    :return: location dictionary (possibly empty)
+
+    Extract location from message dictionary.
+    '''
+    location = message.get("location")
+    if not isinstance(location, dict):
+        return {}
+    return location
+
+#-----------------------------------------------------------------------------
+# Rule {{{
+
+class Rule:
+    '''
+    Single routing rule.
+
+    .. attribute:: aspect_type
+
+       ``None`` (any aspect), ``"exact"``, ``"glob"``, or ``"regexp"``
+
+    .. attribute:: aspect
+
+       aspect name, glob, or regexp (string form)
+
+    .. attribute:: kind
+
+       ``None``, ``"metric"``, or ``"state"``
+
+    .. attribute:: location
+
+       dictionary of location fields that need to match
+    '''
+
+    _GLOB_CHARS = re.compile(r'[*?\[]')
+
+    def __init__(self, aspect = None, aspect_type = None, kind = None,
+                 location = None):
+        '''
+        :param aspect: aspect name, glob, or regexp
+        :param aspect_type: ``"exact"``, ``"glob"``, or ``"regexp"``; if left
+            ``None``, ``"glob"`` or ``"exact"`` is guessed from :obj:`aspect`
+        :param kind: ``"metric"``, ``"state"``, or ``None``
+        :param location: location fields that need to match
+        :type location: dict(str => str)
+        '''
+        if kind not in (None, "metric", "state"):
+            raise ValueError("invalid message kind: %s" % (kind,))
+        if aspect is None:
+            aspect_type = None
+        elif aspect_type is None:
+            if Rule._GLOB_CHARS.search(aspect):
+                aspect_type = "glob"
+            else:
+                aspect_type = "exact"
+        if aspect_type not in (None, "exact", "glob", "regexp"):
+            raise ValueError("invalid aspect match type: %s" % (aspect_type,))
+
+        self.aspect = aspect
+        self.aspect_type = aspect_type
+        self.kind = kind
+        if location is not None:
+            self.location = dict(location)
+        else:
+            self.location = {}
+
+        if aspect_type == "regexp":
+            try:
+                self._regexp = re.compile(aspect)
+            except Exception, e:
+                raise ValueError("invalid regexp: %s" % (e.args[0],))
+        elif aspect_type == "glob":
+            self._regexp = re.compile(fnmatch.translate(aspect))
+        else:
+            self._regexp = None
+
+    @staticmethod
+    def parse(spec):
+        '''
+        :param spec: rule specification (see module description)
+        :rtype: :class:`Rule`
+        :throws: :exc:`ValueError` on invalid specification
+
+        Parse a rule from its text form.
+        '''
+        aspect = None
+        aspect_type = None
+        kind = None
+        location = {}
+
+        rest = spec.strip()
+        if rest == "":
+            raise ValueError("empty routing rule")
+
+        while rest != "":
+            if "=" not in rest:
+                raise ValueError("invalid routing condition: %s" % (rest,))
+            (name, rest) = rest.split("=", 1)
+            name = name.strip()
+
+            if rest.startswith("/"):
+                # regexp; consume up to the first unquoted slash
+                match = re.match(r'/((?:[^\\/]|\\.)*)/', rest)
+                if match is None:
+                    raise ValueError("unterminated regexp: %s" % (rest,))
+                value = match.group(1).replace('\\/', '/')
+                value_type = "regexp"
+                rest = rest[match.end():].lstrip()
+                if rest != "" and not rest.startswith(","):
+                    raise ValueError("garbage after regexp: %s" % (rest,))
+            else:
+                if "," in rest:
+                    (value, rest) = rest.split(",", 1)
+                    rest = "," + rest
+                else:
+                    (value, rest) = (rest, "")
+                value = value.strip()
+                value_type = None
+            # skip the comma that separates conditions
+            rest = rest[1:].lstrip()
+
+            if name == "aspect":
+                if aspect is not None:
+                    raise ValueError("duplicate aspect condition")
+                aspect = value
+                aspect_type = value_type
+            elif name == "kind" and value_type is None:
+                if kind is not None:
+                    raise ValueError("duplicate kind condition")
+                kind = value
+            elif name.startswith("location.") and value_type is None and \
+                 len(name) > len("location."):
+                location[name[len("location."):]] = value
+            else:
+                raise ValueError("invalid routing condition: %s" % (name,))
+
+        return Rule(aspect, aspect_type, kind, location)
+
+    def glob_prefix(self):
+        '''
+        :return: literal prefix of the glob (empty string if the glob starts
+            with a wildcard)
+        '''
+        match = Rule._GLOB_CHARS.search(self.aspect)
+        return self.aspect[:match.start()]
+
+    def match_aspect(self, aspect):
+        '''
+        Check if the aspect name matches the aspect condition of this rule.
+        '''
+        if self.aspect_type is None:
+            return True
+        if aspect is None:
+            return False
+        if self.aspect_type == "exact":
+            return (aspect == self.aspect)
+        # glob or regexp
+        match = self._regexp.match(aspect)
+        return (match is not None and match.end() == len(aspect))
+
+    def match_rest(self, kind, location):
+        '''
+        :param kind: tuple ``(is_metric, is_state)``
+        :param location: location dictionary
+
+        Check if the message kind and location match this rule.
+        '''
+        if self.kind == "metric" and not kind[0]:
+            return False
+        if self.kind == "state" and not kind[1]:
+            return False
+        for (name, value) in self.location.iteritems():
+            if location.get(name) != value:
+                return False
+        return True
+
+    def __repr__(self):
+        conditions = []
+        if self.aspect_type == "regexp":
+            conditions.append("aspect=/%s/" % (self.aspect,))
+        elif self.aspect_type is not None:
+            conditions.append("aspect=%s" % (self.aspect,))
+        if self.kind is not None:
+            conditions.append("kind=%s" % (self.kind,))
+        for (name, value) in sorted(self.location.items()):
+            conditions.append("location.%s=%s" % (name, value))
+        return "<Rule %s>" % (",".join(conditions),)
+
+# }}}
+#-----------------------------------------------------------------------------
+# RoutingTable {{{
+
+class RoutingTable:
+    '''
+    Compiled set of routing rules for a list of targets.
+
+    Target is an opaque object (typically an output socket). Targets added
+    without any rule receive all messages.
+    '''
+
+    #-------------------------------------------------------
+    # glob prefix tree node {{{
+
+    class _TrieNode:
+        def __init__(self):
+            self.children = {}
+            self.rules = [] # rule IDs with glob prefix ending at this node
+
+    # }}}
+    #-------------------------------------------------------
+
+    def __init__(self, cache_size = 65536):
+        '''
+        :param cache_size: maximum number of cached routing decisions
+        '''
+        self._targets = []
+        self._rules = [] # [(target_idx, rule)]
+        self._routed = set() # indices of targets that have rules
+        self._cache_size = cache_size
+        self._compiled = False
+        self._clear_index()
+
+    def _clear_index(self):
+        self._exact = {}
+        self._trie = RoutingTable._TrieNode()
+        self._regexps = []
+        self._any_aspect = []
+        self._location_keys = ()
+        self._cache = {}
+
+    def add(self, target, rules = None):
+        '''
+        :param target: object to route messages to
+        :param rules: list of :class:`Rule` instances; ``None`` or empty list
+            means all messages
+        '''
+        target_idx = len(self._targets)
+        self._targets.append(target)
+        if rules:
+            self._routed.add(target_idx)
+            for rule in rules:
+                self._rules.append((target_idx, rule))
+        self._compiled = False
+
+    def targets(self):
+        '''
+        :return: list of all targets, in order of adding
+        '''
+        return self._targets[:]
+
+    def has_rules(self):
+        '''
+        Check if any of the targets is restricted by rules.
+        '''
+        return len(self._rules) > 0
+
+    def compile(self):
+        '''
+        Build the index of rules. It's called automatically before first
+        :meth:`route()` after targets were added.
+        '''
+        self._clear_index()
+        location_keys = set()
+        for (rule_id, (target_idx, rule)) in enumerate(self._rules):
+            location_keys.update(rule.location)
+            if rule.aspect_type is None:
+                self._any_aspect.append(rule_id)
+            elif rule.aspect_type == "exact":
+                self._exact.setdefault(rule.aspect, []).append(rule_id)
+            elif rule.aspect_type == "glob":
+                node = self._trie
+                for char in rule.glob_prefix():
+                    node = node.children.setdefault(char,
+                                                    RoutingTable._TrieNode())
+                node.rules.append(rule_id)
+            else: # rule.aspect_type == "regexp"
+                self._regexps.append(rule_id)
+        self._location_keys = tuple(sorted(location_keys))
+        self._compiled = True
+
+    def _candidates(self, aspect):
+        # rules that possibly match the aspect name (globs and regexps still
+        # need checking)
+        result = list(self._any_aspect)
+        if aspect is None:
+            return result
+        result.extend(self._exact.get(aspect, ()))
+        node = self._trie
+        rules = self._rules
+        for rule_id in node.rules:
+            if rules[rule_id][1].match_aspect(aspect):
+                result.append(rule_id)
+        for char in aspect:
+            node = node.children.get(char)
+            if node is None:
+                break
+            for rule_id in node.rules:
+                if rules[rule_id][1].match_aspect(aspect):
+                    result.append(rule_id)
+        for rule_id in self._regexps:
+            if rules[rule_id][1].match_aspect(aspect):
+                result.append(rule_id)
+        return result
+
+    def route(self, message):
+        '''
+        :param message: message (dictionary) to route
+        :return: list of targets that should receive the message, in order
+            of adding
+
+        Select targets for a message.
+        '''
+        if not self._compiled:
+            self.compile()
+        if len(self._rules) == 0:
+            return self._targets
+
+        aspect = message_aspect(message)
+        kind = message_kind(message)
+        location = message_location(message)
+        cache_key = (
+            aspect, kind,
+            tuple([location.get(k) for k in self._location_keys]),
+        )
+        try:
+            result = self._cache.get(cache_key)
+        except TypeError:
+            # not a valid location (unhashable values), route uncached
+            cache_key = None
+            result = None
+        if result is not None:
+            return result
+
+        selected = set()
+        for rule_id in self._candidates(aspect):
+            (target_idx, rule) = self._rules[rule_id]
+            if target_idx not in selected and rule.match_rest(kind, location):
+                selected.add(target_idx)
+        result = [
+            self._targets[i]
+            for i in xrange(len(self._targets))
+            if i not in self._routed or i in selected
+        ]
+
+        if cache_key is None:
+            return result
+        if len(self._cache) >= self._cache_size:
+            self._cache.clear()
+        self._cache[cache_key] = result
+        return result
+
+# }}}
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
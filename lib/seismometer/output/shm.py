@@ -0,0 +1,122 @@
+#!/usr/bin/python
+'''
+Shared memory ring writer
+-------------------------
+
+.. autoclass:: SHM
+   :members:
+
+'''
+#-----------------------------------------------------------------------------
+
+import os
+import time
+import logging
+import seismometer.ring
+import seismometer.rate_limit
+from _connection_output import ConnectionOutput
+
+#-----------------------------------------------------------------------------
+
+class SHM(ConnectionOutput):
+    '''
+    Sender passing messages to another messenger on the same host through
+    a shared memory ring buffer (see :mod:`seismometer.ring`). The ring is
+    created by the receiving side.
+
+    Full ring is treated like a lost connection: messages are spooled and
+    sent when the receiver makes room in the ring (half of it free).
+    '''
+    def __init__(self, path, spooler = None):
+        '''
+        :param path: path to the ring file
+        :param spooler: spooler object
+        '''
+        self.path = os.path.abspath(path)
+        self.ring = None
+        self.full = False
+        # "connection still closed" rate limiter
+        self.conn_still_closed = seismometer.rate_limit.RateLimit()
+        self._next_check = 0
+        self._oversized = 0
+        super(SHM, self).__init__(spooler)
+
+    def get_logger(self):
+        return logging.getLogger("output.shm")
+
+    def get_name(self):
+        return "shm:%s" % (self.path,)
+
+    def write(self, line):
+        if self.ring is None:
+            return False
+
+        now = time.time()
+        if now >= self._next_check:
+            # the receiver could have restarted with a new ring file
+            self._next_check = now + 1
+            if self.ring.replaced():
+                logger = self.get_logger()
+                logger.warn("%s: ring file replaced", self.get_name())
+                self._close()
+                return False
+
+        if self.encoder.oversized != self._oversized:
+            logger = self.get_logger()
+            logger.warn("%s: dropped %d messages too large for the ring",
+                        self.get_name(),
+                        self.encoder.oversized - self._oversized)
+            self._oversized = self.encoder.oversized
+
+        if not self.ring.write(line):
+            logger = self.get_logger()
+            logger.warn("%s: ring full", self.get_name())
+            self.full = True
+            return False
+        return True
+
+    def _close(self):
+        self.ring.close()
+        self.ring = None
+        self.encoder = None
+        self.full = False
+
+    def is_connected(self):
+        return (self.ring is not None and not self.full)
+
+    def repair_connection(self):
+        logger = self.get_logger()
+        if self.ring is not None:
+            if self.ring.replaced():
+                logger.warn("%s: ring file replaced", self.get_name())
+                self._close()
+            elif self.ring.size - self.ring.pending() >= self.ring.max_record():
+                logger.info("%s: ring has room again", self.get_name())
+                self.full = False
+                return True
+            else:
+                return False
+
+        try:
+            self.ring = seismometer.ring.Ring(self.path,
+                                              seismometer.ring.PRODUCER)
+        except (IOError, OSError), e:
+            if self.conn_still_closed.should_fire():
+                logger.warn("%s: opening ring failed: %s", self.get_name(),
+                            e.strerror)
+                self.conn_still_closed.fired()
+            return False
+        except ValueError, e:
+            if self.conn_still_closed.should_fire():
+                logger.warn("%s: opening ring failed: %s", self.get_name(), e)
+                self.conn_still_closed.fired()
+            return False
+        self.encoder = seismometer.ring.RecordEncoder(self.ring.max_record())
+        self._oversized = 0
+        self._next_check = time.time() + 1
+        logger.info("%s: ring opened", self.get_name())
+        self.conn_still_closed.reset()
+        return True
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -11,7 +11,7 @@ STDOUT message writer
 
 import sys
 import logging
-import json
+import seismometer.output.formats
 
 #-----------------------------------------------------------------------------
 
@@ -19,12 +19,26 @@ class STDOUT:
     '''
     Sender printing message to STDOUT.
     '''
-    def __init__(self):
-        pass
+    def __init__(self, output_format = None):
+        '''
+        :param output_format: encoder of a format other than JSON lines (see
+            :mod:`seismometer.output.formats`)
+        '''
+        if output_format is None:
+            output_format = seismometer.output.formats.JSONEncoder()
+        self.output_format = output_format
+
+    def get_name(self):
+        return "stdout"
 
     def send(self, message):
-        line = json.dumps(message) + '\n'
-        sys.stdout.write(line)
+        sys.stdout.write(self.output_format.encode(message))
+        sys.stdout.flush()
+
+    def send_batch(self, messages):
+        lines = []
+        self.output_format.encode_batch(messages, lines)
+        sys.stdout.write("".join(lines))
         sys.stdout.flush()
 
     def flush(self):
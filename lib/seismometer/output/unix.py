@@ -6,6 +6,9 @@ UNIX domain socket writer
 .. autoclass:: UNIX
    :members:
 
+.. autoclass:: UNIXStream
+   :members:
+
 '''
 #-----------------------------------------------------------------------------
 
@@ -19,18 +22,21 @@ from _connection_output import ConnectionOutput
 
 class UNIX(ConnectionOutput):
     '''
-    Sender passing message to another messenger through UNIX sockets.
+    Sender passing message to another messenger through UNIX datagram
+    sockets.
     '''
-    def __init__(self, path, spooler = None):
+    def __init__(self, path, spooler = None, output_format = None):
         '''
         :param path: socket path to send data to
         :param spooler: spooler object
+        :param output_format: encoder of a format other than JSON lines (see
+            :mod:`seismometer.output.formats`)
         '''
         self.path = os.path.abspath(path)
         self.conn = None
         # "connection still closed" rate limiter
         self.conn_still_closed = seismometer.rate_limit.RateLimit()
-        super(UNIX, self).__init__(spooler)
+        super(UNIX, self).__init__(spooler, output_format = output_format)
 
     def get_logger(self):
         return logging.getLogger("output.af_unix")
@@ -72,5 +78,75 @@ class UNIX(ConnectionOutput):
                 self.conn_still_closed.fired()
             return False
 
+#-----------------------------------------------------------------------------
+
+class UNIXStream(ConnectionOutput):
+    '''
+    Sender passing message to another messenger through UNIX stream sockets.
+    '''
+    def __init__(self, path, spooler = None, wire_format = "json",
+                 output_format = None):
+        '''
+        :param path: socket path to send data to
+        :param spooler: spooler object
+        :param wire_format: ``"json"`` or ``"binary"`` (the latter falls back
+            to JSON if the receiver doesn't support it)
+        :param output_format: encoder of a format other than JSON lines (see
+            :mod:`seismometer.output.formats`)
+        '''
+        self.path = os.path.abspath(path)
+        self.conn = None
+        # "connection still closed" rate limiter
+        self.conn_still_closed = seismometer.rate_limit.RateLimit()
+        super(UNIXStream, self).__init__(spooler, wire_format,
+                                         output_format)
+
+    def get_logger(self):
+        return logging.getLogger("output.af_unix")
+
+    def get_name(self):
+        return "%s" % (self.path,)
+
+    def write(self, line):
+        if self.conn is None:
+            return False
+
+        try:
+            self.conn.sendall(line)
+            return True
+        except socket.error: # this covers `socket.timeout'
+            # lost connection
+            logger = self.get_logger()
+            logger.warn("%s: lost connection", self.get_name())
+            self.conn = None
+            return False
+
+    def is_connected(self):
+        # FIXME: better check
+        return (self.conn is not None)
+
+    def repair_connection(self):
+        logger = self.get_logger()
+        try:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.settimeout(5) # 5s timeout for connect, send, and such
+            conn.connect(self.path)
+            self.negotiate(conn)
+            self.conn = conn
+            logger.info("%s: reconnected", self.get_name())
+            self.conn_still_closed.reset()
+            return True
+        except socket.timeout, e:
+            if self.conn_still_closed.should_fire():
+                logger.warn("%s: reconnecting failed: timeout", self.get_name())
+                self.conn_still_closed.fired()
+            return False
+        except socket.error, e:
+            if self.conn_still_closed.should_fire():
+                logger.warn("%s: reconnecting failed: %s", self.get_name(),
+                            e.strerror)
+                self.conn_still_closed.fired()
+            return False
+
 #-----------------------------------------------------------------------------
 # vim:ft=python:foldmethod=marker
@@ -0,0 +1,465 @@
+#!/usr/bin/python
+'''
+Shared memory ring buffer
+-------------------------
+
+Single-producer, single-consumer ring buffer in a memory-mapped file, for
+passing messages between processes on the same host without a syscall per
+message (see :mod:`seismometer.input.shm` and
+:mod:`seismometer.output.shm`).
+
+File layout
+^^^^^^^^^^^
+
+The file starts with a header of :data:`DATA_OFFSET` bytes, followed by the
+data area. Header fields (little endian) are:
+
+* offset 0: magic string ``"SEISRING"``
+* offset 8: version (32-bit)
+* offset 12: size of data area (32-bit)
+* offset 64: *head*, number of bytes written so far (64-bit)
+* offset 128: *tail*, number of bytes read so far (64-bit)
+* offset 192: *waiting* flag, set by the consumer when it's about to sleep
+  (32-bit)
+
+*head* is only modified by the producer and *tail* only by the consumer.
+Position in the data area is the counter modulo data area size.
+
+Each record is a 32-bit length followed by payload (a message serialized
+with :mod:`marshal`). A record never crosses the end of the data area; if it
+doesn't fit, the rest of the area is skipped (with a length of
+``0xFFFFFFFF`` as a marker, if there's room for it).
+
+Producer only advances *head* after the whole record is in place, so
+a producer that died in the middle of writing leaves no partial record, and
+a restarted producer just continues from *head*. The same goes for the
+consumer and *tail*.
+
+Wakeups go through a named pipe (``<ring>.wakeup``): consumer sets the
+*waiting* flag when it finds the ring empty, and producer writes a byte to
+the pipe after adding records if the flag was set. Producer stores *head*
+and then reads the flag, while consumer stores the flag and then reads
+*head* again, both with a full memory barrier in between, so at least one of
+them sees the other's store: either the consumer doesn't go to sleep or the
+producer wakes it up.
+
+Producer and consumer hold POSIX locks on the first and the second byte of
+the file, respectively, so a second producer (or consumer) is refused.
+
+.. autoclass:: Ring
+   :members:
+
+.. autoclass:: RecordEncoder
+   :members:
+
+.. autofunction:: decode
+
+'''
+#-----------------------------------------------------------------------------
+
+import os
+import stat
+import mmap
+import fcntl
+import errno
+import struct
+import ctypes
+import ctypes.util
+import marshal
+
+__all__ = [
+    'Ring', 'RecordEncoder', 'decode',
+]
+
+#-----------------------------------------------------------------------------
+
+MAGIC = "SEISRING"
+VERSION = 1
+DATA_OFFSET = 4096
+DEFAULT_SIZE = 4 * 1024 * 1024
+WRAP = 0xFFFFFFFF
+
+PRODUCER = 0
+CONSUMER = 1
+
+_LENGTH = struct.Struct("<I")
+
+class _Header(ctypes.Structure):
+    _fields_ = [
+        ("magic", ctypes.c_char * 8),
+        ("version", ctypes.c_uint32),
+        ("size", ctypes.c_uint32),
+        ("_pad1", ctypes.c_char * 48),
+        ("head", ctypes.c_uint64),
+        ("_pad2", ctypes.c_char * 56),
+        ("tail", ctypes.c_uint64),
+        ("_pad3", ctypes.c_char * 56),
+        ("waiting", ctypes.c_uint32),
+    ]
+
+def _memory_barrier_function():
+    # POSIX mutex operations synchronize memory (full barrier), and that's
+    # the only barrier available without a compiled module
+    try:
+        library = ctypes.CDLL(ctypes.util.find_library("pthread") or
+                              ctypes.util.find_library("c"))
+        lock = library.pthread_mutex_lock
+        unlock = library.pthread_mutex_unlock
+    except (OSError, AttributeError, TypeError):
+        return lambda: None
+    # zeroed memory is a valid default mutex (PTHREAD_MUTEX_INITIALIZER), and
+    # a generous size for any platform
+    mutex = ctypes.create_string_buffer(256)
+    mutex_ref = ctypes.byref(mutex)
+    def memory_barrier():
+        lock(mutex_ref)
+        unlock(mutex_ref)
+    return memory_barrier
+
+_memory_barrier = _memory_barrier_function()
+
+#-----------------------------------------------------------------------------
+
+class RecordEncoder:
+    '''
+    Encoder of messages to ring records, usable as
+    :attr:`seismometer.output._connection_output.ConnectionOutput.encoder`.
+
+    .. attribute:: oversized
+
+       number of messages dropped because they wouldn't fit in the ring
+    '''
+    def __init__(self, max_record):
+        '''
+        :param max_record: maximum size of a record
+        '''
+        self.max_record = max_record
+        self.oversized = 0
+
+    def encode(self, message):
+        '''
+        :param message: message to encode
+        :type message: dict
+        :return: record (empty string if the message is too large)
+        '''
+        payload = marshal.dumps(message)
+        if len(payload) + 4 > self.max_record:
+            self.oversized += 1
+            return ""
+        return _LENGTH.pack(len(payload)) + payload
+
+def decode(payload):
+    '''
+    :param payload: payload of a record
+    :return: message
+    :rtype: dict
+    :throws: :exc:`ValueError` on invalid payload
+    '''
+    try:
+        message = marshal.loads(payload)
+    except (ValueError, EOFError, TypeError):
+        raise ValueError("invalid record")
+    if not isinstance(message, dict):
+        raise ValueError("invalid record")
+    return message
+
+#-----------------------------------------------------------------------------
+
+class Ring:
+    '''
+    Ring buffer in a memory-mapped file.
+
+    .. attribute:: size
+
+       size of the data area
+    '''
+    def __init__(self, path, role, size = DEFAULT_SIZE, mode = 0600):
+        '''
+        :param path: path to the ring file
+        :param role: :data:`PRODUCER` or :data:`CONSUMER`
+        :param size: size of the data area of a newly created file
+        :param mode: permissions of a newly created file (and wakeup pipe)
+        :throws: :exc:`IOError` or :exc:`OSError` when the file couldn't be
+            opened (e.g. it doesn't exist and role is producer, or another
+            process holds the role), :exc:`ValueError` when the file is not
+            a valid ring
+
+        Open a ring. Consumer creates the file (and the wakeup pipe) if it
+        doesn't exist or is not a valid ring.
+        '''
+        self.path = path
+        self.role = role
+        self.fd = None
+        self.mmap = None
+        self.header = None
+        self.wakeup_fd = None
+        try:
+            if role == CONSUMER:
+                self._open_consumer(size, mode)
+            else:
+                self._open_producer()
+        except:
+            self.close()
+            raise
+
+    def _open_consumer(self, size, mode):
+        try:
+            self._open_file()
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._create(size, mode)
+            self._open_file()
+        except ValueError:
+            # not a ring (or an incompatible one); the lock is ours, so no
+            # other consumer uses it
+            self.close()
+            self._create(size, mode)
+            self._open_file()
+        wakeup = self.path + ".wakeup"
+        try:
+            if not stat.S_ISFIFO(os.stat(wakeup).st_mode):
+                os.unlink(wakeup)
+                os.mkfifo(wakeup, mode)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            os.mkfifo(wakeup, mode)
+        # read-write, so the pipe never reports EOF when producers go away
+        self.wakeup_fd = os.open(wakeup, os.O_RDWR | os.O_NONBLOCK)
+
+    def _open_producer(self):
+        self._open_file()
+        self._open_wakeup()
+
+    def _open_wakeup(self):
+        try:
+            self.wakeup_fd = os.open(self.path + ".wakeup",
+                                     os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            self.wakeup_fd = None # no consumer yet
+
+    def _create(self, size, mode):
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            os.ftruncate(fd, DATA_OFFSET + size)
+            header = _Header()
+            header.magic = MAGIC
+            header.version = VERSION
+            header.size = size
+            os.write(fd, ctypes.string_at(ctypes.addressof(header),
+                                          ctypes.sizeof(header)))
+        finally:
+            os.close(fd)
+        os.rename(tmp, self.path)
+
+    def _open_file(self):
+        self.fd = os.open(self.path, os.O_RDWR)
+        # the lock is released by the OS when the process dies
+        fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.role)
+        file_size = os.fstat(self.fd).st_size
+        if file_size < DATA_OFFSET:
+            raise ValueError("not a ring file")
+        self.mmap = mmap.mmap(self.fd, file_size)
+        self.header = _Header.from_buffer(self.mmap)
+        if self.header.magic != MAGIC or self.header.version != VERSION or \
+           self.header.size + DATA_OFFSET != file_size or \
+           self.header.head - self.header.tail > self.header.size:
+            raise ValueError("not a ring file")
+        self.size = self.header.size
+        self.inode = os.fstat(self.fd).st_ino
+
+    def close(self):
+        '''
+        Close the ring.
+        '''
+        # the header refers to the mmap's memory and needs to go first
+        self.header = None
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.wakeup_fd is not None:
+            os.close(self.wakeup_fd)
+            self.wakeup_fd = None
+
+    def replaced(self):
+        '''
+        :return: ``True`` if the file was removed or replaced with another
+            one (e.g. by a restarted consumer), ``False`` otherwise
+        '''
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError:
+            return True
+
+    def max_record(self):
+        '''
+        :return: maximum size of a record that can be written
+        '''
+        return self.size // 2
+
+    def pending(self):
+        '''
+        :return: number of bytes written but not read yet
+        '''
+        return self.header.head - self.header.tail
+
+    #-------------------------------------------------------------------
+    # producer side
+
+    def write(self, data):
+        '''
+        :param data: concatenated records (see :class:`RecordEncoder`)
+        :return: ``True`` if all the records were written, ``False`` if
+            there's not enough room (nothing is written then)
+
+        Add records to the ring and wake the consumer up if it's waiting.
+        '''
+        if data == "":
+            return True
+        header = self.header
+        size = self.size
+        head = header.head
+        free = size - (head - header.tail)
+        offset = head % size
+        if offset + len(data) <= size:
+            # fast path: no wrapping
+            if len(data) > free:
+                return False
+            self.mmap[DATA_OFFSET + offset:DATA_OFFSET + offset + len(data)] = data
+            header.head = head + len(data)
+        else:
+            if not self._write_wrapping(data, head, free):
+                return False
+        # head needs to be visible to the consumer before the flag is read
+        _memory_barrier()
+        if header.waiting:
+            header.waiting = 0
+            self.wake()
+        return True
+
+    def _write_wrapping(self, data, head, free):
+        # plan the copies first, so nothing is written if there's no room
+        size = self.size
+        copies = [] # (ring position, data start, data end)
+        markers = []
+        pos = head
+        seg_pos = head
+        seg_start = 0
+        i = 0
+        while i < len(data):
+            if pos % size == 0 and i > seg_start:
+                # the previous record ended exactly at the end of data area
+                copies.append((seg_pos, seg_start, i))
+                seg_pos = pos
+                seg_start = i
+            (length,) = _LENGTH.unpack_from(data, i)
+            record = 4 + length
+            room = size - pos % size
+            if record > room:
+                if i > seg_start:
+                    copies.append((seg_pos, seg_start, i))
+                if room >= 4:
+                    markers.append(pos)
+                pos += room
+                seg_pos = pos
+                seg_start = i
+            pos += record
+            i += record
+        copies.append((seg_pos, seg_start, len(data)))
+        if pos - head > free:
+            return False
+        for mark in markers:
+            offset = DATA_OFFSET + mark % size
+            self.mmap[offset:offset + 4] = _LENGTH.pack(WRAP)
+        for (copy_pos, start, end) in copies:
+            offset = DATA_OFFSET + copy_pos % size
+            self.mmap[offset:offset + end - start] = data[start:end]
+        self.header.head = pos
+        return True
+
+    def wake(self):
+        '''
+        Wake the consumer up.
+        '''
+        if self.wakeup_fd is None:
+            self._open_wakeup()
+            if self.wakeup_fd is None:
+                return
+        try:
+            os.write(self.wakeup_fd, "\0")
+        except OSError, e:
+            if e.errno == errno.EPIPE:
+                # consumer went away; maybe there will be a new one
+                os.close(self.wakeup_fd)
+                self.wakeup_fd = None
+            # EAGAIN: the pipe is full, so the consumer will wake up anyway
+
+    #-------------------------------------------------------------------
+    # consumer side
+
+    def read(self, max_bytes = 1024 * 1024):
+        '''
+        :param max_bytes: read at most this many bytes of records (at least
+            one record is read, if available)
+        :return: list of payloads
+        :throws: :exc:`ValueError` on corrupted ring (it's emptied then)
+
+        Take records from the ring.
+        '''
+        header = self.header
+        size = self.size
+        head = header.head
+        pos = header.tail
+        limit = pos + max_bytes
+        mm = self.mmap
+        unpack_from = _LENGTH.unpack_from
+        result = []
+        while pos < head and (pos < limit or len(result) == 0):
+            offset = pos % size
+            room = size - offset
+            if room < 4:
+                pos += room
+                continue
+            (length,) = unpack_from(mm, DATA_OFFSET + offset)
+            if length == WRAP:
+                pos += room
+                continue
+            if length + 4 > room or pos + 4 + length > head:
+                header.tail = head
+                raise ValueError("corrupted ring")
+            start = DATA_OFFSET + offset + 4
+            result.append(mm[start:start + length])
+            pos += 4 + length
+        header.tail = pos
+        return result
+
+    def wait(self):
+        '''
+        :return: ``True`` if the ring is empty and the consumer may sleep,
+            ``False`` if there's data to read
+
+        Prepare for sleeping: clear the wakeup pipe, set the *waiting* flag,
+        and check *head* again, in case the producer added records without
+        seeing the flag.
+        '''
+        try:
+            while os.read(self.wakeup_fd, 4096) != "":
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        self.header.waiting = 1
+        # the flag needs to be visible to the producer before head is read
+        _memory_barrier()
+        if self.header.head != self.header.tail:
+            self.header.waiting = 0
+            return False
+        return True
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
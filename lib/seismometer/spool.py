@@ -6,6 +6,9 @@ problems.
 .. autoclass:: MemorySpooler
    :members:
 
+.. autoclass:: LaneSpooler
+   :members:
+
 '''
 #-----------------------------------------------------------------------------
 
@@ -29,9 +32,10 @@ class MemorySpooler:
         self._max = max
         self._size = 0
 
-    def spool(self, line):
+    def spool(self, line, lane = None):
         '''
         :param line: line to spool
+        :param lane: ignored (see :class:`LaneSpooler`)
         :returns: number of messages dropped to keep the queue under its limit
 
         Spool single line. If spool limit was set, oldest entries will be
@@ -69,5 +73,155 @@ class MemorySpooler:
         '''
         return len(self._queue)
 
+    def stats(self):
+        '''
+        :return: dictionary ``{lane: {"messages": N, "bytes": N}}``
+
+        Return queue depth, for consistency with :class:`LaneSpooler`.
+        '''
+        return { None: { "messages": len(self._queue), "bytes": self._size } }
+
+#-----------------------------------------------------------------------------
+
+class LaneSpooler:
+    '''
+    Spooler that keeps data in memory, in separate queues (*lanes*) for
+    different kinds of messages.
+
+    Lines are retrieved from lanes in weighted round-robin: with weights
+    ``{"state": 8, "metric": 1}`` eight state lines are retrieved for every
+    metric line, as long as there are state lines waiting. When the total
+    size goes over the limit, lines are dropped from the lane that comes
+    last in :obj:`lanes` first (oldest lines first).
+
+    .. attribute:: dropped
+
+       dictionary with number of lines dropped from each lane
+    '''
+    def __init__(self, max = 20 * 1024 * 1024, lanes = ("state", "metric"),
+                 weights = None, lane_max = None):
+        '''
+        :param max: maximum number of bytes to keep in all lanes together
+            (``None`` means no limit)
+        :param lanes: names of lanes, from the most important one
+        :param weights: dictionary with weights of lanes (defaults to 8 for
+            the first lane and 1 for the others)
+        :param lane_max: dictionary with maximum number of bytes to keep in
+            specific lanes
+        '''
+        self._lanes = tuple(lanes)
+        self._queues = dict((l, collections.deque()) for l in self._lanes)
+        self._sizes = dict((l, 0) for l in self._lanes)
+        if weights is None:
+            weights = dict((l, 1) for l in self._lanes)
+            weights[self._lanes[0]] = 8
+        self._weights = {}
+        for l in self._lanes:
+            weight = int(weights.get(l, 1))
+            # each lane needs to be drained at least a little
+            self._weights[l] = weight if weight > 0 else 1
+        self._credits = dict(self._weights)
+        self._lane_max = dict(lane_max or {})
+        self._max = max
+        self._size = 0
+        self._count = 0
+        self._selected = None # lane the next line comes from
+        self.dropped = dict((l, 0) for l in self._lanes)
+
+    def spool(self, line, lane = None):
+        '''
+        :param line: line to spool
+        :param lane: lane to put the line in (defaults to the last one)
+        :returns: number of messages dropped to keep the lanes under their
+            limits
+
+        Spool single line. If spool limits were set, oldest entries will be
+        dropped, from the least important lanes first.
+        '''
+        if lane is None:
+            lane = self._lanes[-1]
+        self._queues[lane].append(line)
+        self._sizes[lane] += len(line)
+        self._size += len(line)
+        self._count += 1
+
+        dropped_count = 0
+        lane_max = self._lane_max.get(lane)
+        if lane_max is not None:
+            while self._sizes[lane] > lane_max:
+                self._drop(lane)
+                dropped_count += 1
+        if self._max is not None:
+            for victim in reversed(self._lanes):
+                while self._size > self._max and len(self._queues[victim]) > 0:
+                    self._drop(victim)
+                    dropped_count += 1
+        return dropped_count
+
+    def _drop(self, lane):
+        line = self._queues[lane].popleft()
+        self._sizes[lane] -= len(line)
+        self._size -= len(line)
+        self._count -= 1
+        self.dropped[lane] += 1
+        self._selected = None
+
+    def _select(self):
+        if self._selected is not None:
+            return self._selected
+        if self._count == 0:
+            return None
+        while True:
+            for lane in self._lanes:
+                if self._credits[lane] > 0 and len(self._queues[lane]) > 0:
+                    self._selected = lane
+                    return lane
+            # all non-empty lanes used their credits
+            self._credits = dict(self._weights)
+
+    def peek(self):
+        '''
+        Retrieve the next line from spool, according to lanes' weights. The
+        line *will not* be removed from spool.
+        '''
+        lane = self._select()
+        if lane is None:
+            return None
+        return self._queues[lane][0]
+
+    def drop_one(self):
+        '''
+        Drop the line returned by :meth:`peek()` from spool.
+        '''
+        lane = self._select()
+        line = self._queues[lane].popleft()
+        self._sizes[lane] -= len(line)
+        self._size -= len(line)
+        self._count -= 1
+        self._credits[lane] -= 1
+        self._selected = None
+
+    def __len__(self):
+        '''
+        Return number of messages in all the lanes.
+        '''
+        return self._count
+
+    def stats(self):
+        '''
+        :return: dictionary ``{lane: {"messages": N, "bytes": N,
+            "dropped": N}}``
+
+        Return depth of lanes and number of lines dropped from them.
+        '''
+        return dict(
+            (lane, {
+                "messages": len(self._queues[lane]),
+                "bytes": self._sizes[lane],
+                "dropped": self.dropped[lane],
+            })
+            for lane in self._lanes
+        )
+
 #-----------------------------------------------------------------------------
 # vim:ft=python:foldmethod=marker
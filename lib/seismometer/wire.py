@@ -0,0 +1,614 @@
+#!/usr/bin/python
+'''
+Binary wire format
+------------------
+
+Compact format for passing messages between two messengers over a stream
+connection (TCP or SSL). It is an alternative to JSON lines, negotiated when
+the connection is established.
+
+Negotiation
+^^^^^^^^^^^
+
+The sending side, right after connecting, sends a hello line with the list of
+format versions it supports (:const:`HELLO`). Since the line doesn't look
+like JSON nor Graphite data, receivers that don't know the binary format just
+drop it. A receiver that knows the format replies with a line naming the
+chosen version, or ``none`` if there's no common version.
+
+If the reply doesn't come in a few seconds or names no version, the sender
+falls back to JSON lines on the same connection. Waiting for the reply
+blocks the sender, so it remembers such peer and sends it JSON lines without
+negotiating on the following connections for a while (see
+:attr:`seismometer.output._connection_output.ConnectionOutput.renegotiate_interval`).
+
+Framing
+^^^^^^^
+
+After a successful negotiation, the sender only sends frames: *varint*
+payload length followed by payload. Payload's first byte tells its type:
+
+* ``0x00`` -- message encoded as JSON (used for messages that don't conform
+  to schema v3 closely enough to be encoded in binary form)
+* ``0x01`` -- message in binary form
+
+*Varint* is an unsigned integer encoded in 7-bit groups, least significant
+first, with the highest bit set in all bytes except the last one. Signed
+integers are first mapped to unsigned ones with *zigzag* encoding (``0, -1,
+1, -2, ...`` becomes ``0, 1, 2, 3, ...``).
+
+Strings (aspect names, location keys and values, state names, units,
+threshold names) are sent once per connection and referenced by ID
+afterwards. String is encoded as a varint with its lowest two bits telling
+what follows:
+
+* ``0`` -- reference to a string already defined, ``ID = varint >> 2``
+* ``1`` -- definition of a new string, ``varint >> 2`` bytes of UTF-8 follow;
+  the string gets the next ID (IDs start at 0)
+* ``2`` -- literal string that is not remembered, ``varint >> 2`` bytes of
+  UTF-8 follow (used for comments and when the dictionary is full)
+
+Numbers are encoded as a tag byte followed by data: ``0x00`` for ``null``,
+``0x01`` with zigzag varint for integer, ``0x02`` with IEEE 754 double
+(little-endian), ``0x03`` for ``true``, and ``0x04`` for ``false``.
+
+Binary message is encoded as follows:
+
+* flags byte: ``0x01`` interval present, ``0x02`` state present, ``0x04``
+  comment present, ``0x08`` threshold_kept present, ``0x10`` value set
+  present
+* timestamp: zigzag varint, difference from the previous message's timestamp
+  on this connection (the first one is relative to 0)
+* aspect name: string
+* location: varint number of fields, each field as two strings: name and
+  value
+* interval: number
+* state: flags byte (``0x01`` value present, ``0x02`` severity present),
+  then value and severity as strings
+* comment: string
+* threshold_kept: string
+* value set: varint number of values, each value encoded as:
+  * name: string
+  * flags byte: ``0x01`` unit present, ``0x02`` type present, ``0x04`` high
+    thresholds present, ``0x08`` low thresholds present
+  * value: number
+  * unit and type: strings
+  * high and low thresholds: varint number of thresholds, each one as name
+    (string), value (number), and severity (string)
+
+The decoded message is exactly the same dictionary as the one produced by
+:func:`json.loads()` from the message's JSON form.
+
+.. autodata:: VERSION
+
+.. autodata:: HELLO
+
+.. autoclass:: Encoder
+   :members:
+
+.. autoclass:: Decoder
+   :members:
+
+.. autofunction:: negotiate
+
+.. autofunction:: accept_hello
+
+'''
+#-----------------------------------------------------------------------------
+
+import json
+import socket
+import struct
+import time
+
+__all__ = [
+    'VERSION', 'HELLO',
+    'Encoder', 'Decoder',
+    'negotiate', 'accept_hello',
+]
+
+#-----------------------------------------------------------------------------
+
+VERSION = 1
+'''
+Version of the binary format implemented by this module.
+'''
+
+HELLO_PREFIX = "#seismometer-wire"
+
+HELLO = "%s %d\n" % (HELLO_PREFIX, VERSION)
+'''
+Hello line sent by the sending side after connecting.
+'''
+
+MAX_STRINGS = 65536
+MAX_FRAME = 16 * 1024 * 1024
+
+_FRAME_JSON = "\x00"
+_FRAME_MESSAGE = "\x01"
+
+# message flags
+_F_INTERVAL = 0x01
+_F_STATE = 0x02
+_F_COMMENT = 0x04
+_F_THRESHOLD_KEPT = 0x08
+_F_VSET = 0x10
+
+# state flags
+_S_VALUE = 0x01
+_S_SEVERITY = 0x02
+
+# value flags
+_V_UNIT = 0x01
+_V_TYPE = 0x02
+_V_HIGH = 0x04
+_V_LOW = 0x08
+
+_MESSAGE_KEYS = frozenset(["v", "time", "location", "event"])
+_EVENT_KEYS = frozenset([
+    "name", "interval", "state", "comment", "threshold_kept", "vset",
+])
+_STATE_KEYS = frozenset(["value", "severity"])
+_VALUE_KEYS = frozenset([
+    "value", "unit", "type", "threshold_high", "threshold_low",
+])
+_THRESHOLD_KEYS = frozenset(["name", "value", "severity"])
+
+_DOUBLE = struct.Struct("<d")
+_SMALL_VARINTS = [chr(i) for i in xrange(128)]
+
+#-----------------------------------------------------------------------------
+# helpers {{{
+
+def _varint(number):
+    if number < 0x80:
+        return _SMALL_VARINTS[number]
+    result = []
+    while number >= 0x80:
+        result.append(chr((number & 0x7f) | 0x80))
+        number >>= 7
+    result.append(chr(number))
+    return "".join(result)
+
+def _zigzag(number):
+    if number >= 0:
+        return _varint(number << 1)
+    return _varint(((-number) << 1) - 1)
+
+class _Fallback(Exception):
+    # message can't be encoded in binary form
+    pass
+
+# }}}
+#-----------------------------------------------------------------------------
+# Encoder {{{
+
+class Encoder:
+    '''
+    Encoder of messages for a single connection.
+    '''
+    def __init__(self, max_strings = MAX_STRINGS):
+        '''
+        :param max_strings: maximum size of string dictionary
+        '''
+        self._strings = {} # string => encoded reference
+        self._max_strings = max_strings
+        self._added = [] # strings added while encoding current message
+        self._last_time = 0
+
+    def encode(self, message):
+        '''
+        :param message: message to encode
+        :type message: dict
+        :return: frame (string)
+
+        Encode a message to a frame. Messages that don't conform to schema
+        v3 are encoded as JSON.
+        '''
+        self._added = []
+        try:
+            payload = _FRAME_MESSAGE + self._message(message)
+        except _Fallback:
+            # forget strings defined by the partially encoded message
+            for string in self._added:
+                del self._strings[string]
+            self._added = []
+            payload = _FRAME_JSON + json.dumps(message)
+        else:
+            self._last_time = message["time"]
+        return _varint(len(payload)) + payload
+
+    def _string(self, string, remember = True):
+        ref = self._strings.get(string)
+        if ref is not None:
+            return ref
+        if isinstance(string, unicode):
+            data = string.encode("utf-8")
+        elif isinstance(string, str):
+            try:
+                string.decode("utf-8")
+            except UnicodeDecodeError:
+                raise _Fallback()
+            data = string
+        else:
+            raise _Fallback()
+        if remember and len(self._strings) < self._max_strings:
+            self._strings[string] = _varint(len(self._strings) << 2)
+            self._added.append(string)
+            return _varint((len(data) << 2) | 1) + data
+        return _varint((len(data) << 2) | 2) + data
+
+    def _number(self, number):
+        kind = type(number)
+        if kind is int or kind is long:
+            return "\x01" + _zigzag(number)
+        if kind is float:
+            return "\x02" + _DOUBLE.pack(number)
+        if number is None:
+            return "\x00"
+        if number is True:
+            return "\x03"
+        if number is False:
+            return "\x04"
+        raise _Fallback()
+
+    def _message(self, message):
+        if type(message) is not dict or \
+           message.viewkeys() != _MESSAGE_KEYS or \
+           type(message["v"]) is not int or message["v"] != 3 or \
+           type(message["time"]) not in (int, long) or \
+           type(message["event"]) is not dict or \
+           type(message["location"]) is not dict:
+            raise _Fallback()
+        event = message["event"]
+        if not event.viewkeys() <= _EVENT_KEYS or "name" not in event:
+            raise _Fallback()
+
+        string = self._string
+        flags = 0
+        result = []
+
+        result.append(_zigzag(message["time"] - self._last_time))
+        result.append(string(event["name"]))
+        location = message["location"]
+        result.append(_varint(len(location)))
+        for (name, value) in location.iteritems():
+            result.append(string(name))
+            result.append(string(value))
+
+        if "interval" in event:
+            flags |= _F_INTERVAL
+            result.append(self._number(event["interval"]))
+        if "state" in event:
+            flags |= _F_STATE
+            state = event["state"]
+            if type(state) is not dict or not state.viewkeys() <= _STATE_KEYS:
+                raise _Fallback()
+            state_flags = 0
+            if "value" in state: state_flags |= _S_VALUE
+            if "severity" in state: state_flags |= _S_SEVERITY
+            result.append(chr(state_flags))
+            if "value" in state:
+                result.append(string(state["value"]))
+            if "severity" in state:
+                result.append(string(state["severity"]))
+        if "comment" in event:
+            flags |= _F_COMMENT
+            result.append(string(event["comment"], remember = False))
+        if "threshold_kept" in event:
+            flags |= _F_THRESHOLD_KEPT
+            result.append(string(event["threshold_kept"]))
+        if "vset" in event:
+            flags |= _F_VSET
+            vset = event["vset"]
+            if type(vset) is not dict:
+                raise _Fallback()
+            result.append(_varint(len(vset)))
+            for (name, value) in vset.iteritems():
+                result.append(string(name))
+                result.append(self._value(value))
+
+        return chr(flags) + "".join(result)
+
+    def _value(self, value):
+        if type(value) is not dict or "value" not in value or \
+           not value.viewkeys() <= _VALUE_KEYS:
+            raise _Fallback()
+        flags = 0
+        result = [self._number(value["value"])]
+        if "unit" in value:
+            flags |= _V_UNIT
+            result.append(self._string(value["unit"]))
+        if "type" in value:
+            flags |= _V_TYPE
+            result.append(self._string(value["type"]))
+        if "threshold_high" in value:
+            flags |= _V_HIGH
+            result.append(self._thresholds(value["threshold_high"]))
+        if "threshold_low" in value:
+            flags |= _V_LOW
+            result.append(self._thresholds(value["threshold_low"]))
+        return chr(flags) + "".join(result)
+
+    def _thresholds(self, thresholds):
+        if type(thresholds) is not list:
+            raise _Fallback()
+        result = [_varint(len(thresholds))]
+        for thr in thresholds:
+            if type(thr) is not dict or thr.viewkeys() != _THRESHOLD_KEYS:
+                raise _Fallback()
+            result.append(self._string(thr["name"]))
+            result.append(self._number(thr["value"]))
+            result.append(self._string(thr["severity"]))
+        return "".join(result)
+
+# }}}
+#-----------------------------------------------------------------------------
+# Decoder {{{
+
+class Decoder:
+    '''
+    Decoder of frames from a single connection.
+    '''
+    def __init__(self, max_strings = MAX_STRINGS, max_frame = MAX_FRAME):
+        '''
+        :param max_strings: maximum size of string dictionary
+        :param max_frame: maximum size of a single frame
+        '''
+        self._strings = []
+        self._max_strings = max_strings
+        self._max_frame = max_frame
+        self._buffer = ""
+        self._last_time = 0
+        # position in the currently decoded payload
+        self._data = None
+        self._pos = 0
+
+    def feed(self, data):
+        '''
+        :param data: data read from the connection
+        :return: list of decoded messages
+        :throws: :exc:`ValueError` on protocol error
+
+        Add data to the buffer and decode all the complete frames.
+        '''
+        buf = self._buffer + data
+        result = []
+        pos = 0
+        while pos < len(buf):
+            # frame length (varint)
+            length = 0
+            shift = 0
+            end = pos
+            while True:
+                if end >= len(buf):
+                    length = None
+                    break
+                byte = ord(buf[end])
+                end += 1
+                length |= (byte & 0x7f) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+                if shift > 35:
+                    raise ValueError("invalid frame length")
+            if length is None or end + length > len(buf):
+                if length is not None and length > self._max_frame:
+                    raise ValueError("frame too large")
+                break # incomplete frame
+            result.append(self._frame(buf[end:end + length]))
+            pos = end + length
+        self._buffer = buf[pos:]
+        return result
+
+    def _frame(self, payload):
+        if payload == "":
+            raise ValueError("empty frame")
+        if payload[0] == _FRAME_JSON:
+            return json.loads(payload[1:])
+        if payload[0] != _FRAME_MESSAGE:
+            raise ValueError("unknown frame type: %d" % (ord(payload[0]),))
+        self._data = payload
+        self._pos = 1
+        try:
+            message = self._message()
+        except (IndexError, OverflowError):
+            raise ValueError("truncated frame")
+        if self._pos != len(payload):
+            raise ValueError("garbage at the end of frame")
+        return message
+
+    def _varint(self):
+        data = self._data
+        pos = self._pos
+        byte = ord(data[pos])
+        pos += 1
+        result = byte & 0x7f
+        shift = 7
+        while byte >= 0x80:
+            byte = ord(data[pos])
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            shift += 7
+        self._pos = pos
+        return result
+
+    def _count(self):
+        # number of items that follow; each takes at least one byte
+        count = self._varint()
+        if count > len(self._data) - self._pos:
+            raise ValueError("invalid item count")
+        return count
+
+    def _zigzag(self):
+        number = self._varint()
+        if number & 1:
+            return -((number + 1) >> 1)
+        return number >> 1
+
+    def _string(self):
+        code = self._varint()
+        kind = code & 3
+        if kind == 0:
+            try:
+                return self._strings[code >> 2]
+            except (IndexError, OverflowError):
+                raise ValueError("unknown string reference")
+        if kind == 3:
+            raise ValueError("invalid string encoding")
+        length = code >> 2
+        start = self._pos
+        self._pos += length
+        if self._pos > len(self._data):
+            raise ValueError("truncated frame")
+        string = self._data[start:self._pos].decode("utf-8")
+        if kind == 1:
+            if len(self._strings) >= self._max_strings:
+                raise ValueError("string dictionary overflow")
+            self._strings.append(string)
+        return string
+
+    def _number(self):
+        tag = self._data[self._pos]
+        self._pos += 1
+        if tag == "\x01":
+            return self._zigzag()
+        if tag == "\x02":
+            start = self._pos
+            self._pos += 8
+            if self._pos > len(self._data):
+                raise ValueError("truncated frame")
+            return _DOUBLE.unpack(self._data[start:self._pos])[0]
+        if tag == "\x00":
+            return None
+        if tag == "\x03":
+            return True
+        if tag == "\x04":
+            return False
+        raise ValueError("invalid number tag: %d" % (ord(tag),))
+
+    def _message(self):
+        flags = ord(self._data[self._pos])
+        self._pos += 1
+        string = self._string
+
+        self._last_time += self._zigzag()
+        event = { "name": string() }
+        location = {}
+        for i in xrange(self._count()):
+            name = string()
+            location[name] = string()
+        message = {
+            "v": 3,
+            "time": self._last_time,
+            "location": location,
+            "event": event,
+        }
+
+        if flags & _F_INTERVAL:
+            event["interval"] = self._number()
+        if flags & _F_STATE:
+            state_flags = ord(self._data[self._pos])
+            self._pos += 1
+            state = event["state"] = {}
+            if state_flags & _S_VALUE:
+                state["value"] = string()
+            if state_flags & _S_SEVERITY:
+                state["severity"] = string()
+        if flags & _F_COMMENT:
+            event["comment"] = string()
+        if flags & _F_THRESHOLD_KEPT:
+            event["threshold_kept"] = string()
+        if flags & _F_VSET:
+            vset = event["vset"] = {}
+            for i in xrange(self._count()):
+                name = string()
+                vset[name] = self._value()
+        return message
+
+    def _value(self):
+        flags = ord(self._data[self._pos])
+        self._pos += 1
+        value = { "value": self._number() }
+        if flags & _V_UNIT:
+            value["unit"] = self._string()
+        if flags & _V_TYPE:
+            value["type"] = self._string()
+        if flags & _V_HIGH:
+            value["threshold_high"] = self._thresholds()
+        if flags & _V_LOW:
+            value["threshold_low"] = self._thresholds()
+        return value
+
+    def _thresholds(self):
+        result = []
+        for i in xrange(self._count()):
+            name = self._string()
+            value = self._number()
+            result.append({
+                "name": name,
+                "value": value,
+                "severity": self._string(),
+            })
+        return result
+
+# }}}
+#-----------------------------------------------------------------------------
+# negotiation {{{
+
+def negotiate(conn, timeout = 3):
+    '''
+    :param conn: connected socket
+    :param timeout: time to wait for the reply
+    :return: :class:`Encoder` or ``None``
+    :throws: :exc:`socket.error`
+
+    Negotiate binary format on a freshly connected socket (the sending side
+    of the connection). If the other side doesn't support it, ``None`` is
+    returned and the connection can be used for sending JSON lines.
+    '''
+    conn.sendall(HELLO)
+    old_timeout = conn.gettimeout()
+    deadline = time.time() + timeout
+    reply = ""
+    try:
+        while "\n" not in reply and len(reply) < 256:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            conn.settimeout(remaining)
+            try:
+                chunk = conn.recv(256 - len(reply))
+            except socket.timeout:
+                return None
+            if chunk == "":
+                raise socket.error("connection closed by peer")
+            reply += chunk
+    finally:
+        conn.settimeout(old_timeout)
+
+    words = reply.split("\n", 1)[0].split()
+    if len(words) == 2 and words[0] == HELLO_PREFIX and \
+       words[1] == str(VERSION):
+        return Encoder()
+    return None
+
+def accept_hello(line):
+    '''
+    :param line: first line received on a connection
+    :return: tuple ``(reply, decoder)``; ``reply`` is ``None`` if the line is
+        not a hello line, and ``decoder`` is ``None`` if there's no common
+        format version
+
+    Process a hello line (the receiving side of the connection).
+    '''
+    words = line.split()
+    if len(words) == 0 or words[0] != HELLO_PREFIX:
+        return (None, None)
+    if str(VERSION) in words[1:]:
+        return ("%s %d\n" % (HELLO_PREFIX, VERSION), Decoder())
+    return ("%s none\n" % (HELLO_PREFIX,), None)
+
+# }}}
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import seismometer.output.file
+import seismometer.input.file
+
+#-----------------------------------------------------------------------------
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write(self, name, data, mode = "a"):
+        with open(self.path(name), mode) as f:
+            f.write(data)
+
+#-----------------------------------------------------------------------------
+
+def message(i):
+    return {
+        "v": 3, "time": 1400000000 + i, "location": { "host": "web01" },
+        "event": { "name": "requests", "vset": { "value": { "value": i } } },
+    }
+
+class TestFileOutput(TempDirTestCase):
+    def read_all(self):
+        # lines from rotated files (in order of rotation) and the current file
+        names = sorted(
+            [n for n in os.listdir(self.dir) if n != "out.log"],
+            key = self.rotation_order,
+        )
+        names.append("out.log")
+        lines = []
+        for name in names:
+            if os.path.exists(self.path(name)):
+                with open(self.path(name)) as f:
+                    lines.extend(f.read().splitlines())
+        return [json.loads(l)["event"]["vset"]["value"]["value"]
+                for l in lines]
+
+    @staticmethod
+    def rotation_order(name):
+        # out.log.<date>-<time>[.<n>]
+        parts = name.split(".")
+        if len(parts) == 3:
+            return (parts[2], 0)
+        return (parts[2], int(parts[3]))
+
+    def test_buffering(self):
+        output = seismometer.output.file.File(self.path("out.log"),
+                                              buffer_size = 1000)
+        output.send(message(0))
+        self.assertFalse(os.path.exists(self.path("out.log")))
+        output.flush()
+        self.assertEqual(self.read_all(), [0])
+        output.close()
+
+    def test_size_rotation(self):
+        # a few messages are buffered before each write
+        output = seismometer.output.file.File(self.path("out.log"),
+                                              buffer_size = 300,
+                                              max_size = 500)
+        for i in xrange(100):
+            output.send_batch([message(i)])
+        output.close()
+        rotated = [n for n in os.listdir(self.dir) if n != "out.log"]
+        self.assertTrue(len(rotated) > 1)
+        for name in rotated:
+            # no leftover files rotated right after the previous rotation
+            self.assertTrue(os.path.getsize(self.path(name)) >= 500)
+        self.assertEqual(self.read_all(), range(100))
+
+    def test_rotation_of_existing_file(self):
+        self.write("out.log", "x" * 1000 + "\n")
+        output = seismometer.output.file.File(self.path("out.log"),
+                                              buffer_size = 0,
+                                              max_size = 500)
+        output.send(message(0))
+        output.send(message(1))
+        output.close()
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+        with open(self.path("out.log")) as f:
+            self.assertEqual(len(f.read().splitlines()), 1)
+
+    def test_reopen(self):
+        output = seismometer.output.file.File(self.path("out.log"),
+                                              buffer_size = 0)
+        output.send(message(0))
+        os.rename(self.path("out.log"), self.path("old.log"))
+        output.reopen()
+        output.send(message(1))
+        output.close()
+        with open(self.path("out.log")) as f:
+            self.assertEqual(len(f.read().splitlines()), 1)
+
+#-----------------------------------------------------------------------------
+
+class TestFileFollow(TempDirTestCase):
+    def follow(self, **kwargs):
+        kwargs.setdefault("from_start", True)
+        kwargs.setdefault("use_inotify", False)
+        follower = seismometer.input.file.File(self.path("*.log"), **kwargs)
+        self.addCleanup(follower.close)
+        return follower
+
+    def read(self, follower):
+        # what the event loop would do: check the files and read for as
+        # long as there's something ready, until the files stop changing
+        lines = []
+        for i in xrange(100):
+            follower._scan()
+            if len(follower._ready) == 0:
+                break
+            while len(follower._ready) > 0:
+                (host, data) = follower.readline()
+                if data != "":
+                    lines.extend(data.split("\n"))
+        return lines
+
+    def test_append(self):
+        self.write("app.log", "a\nb\n")
+        follower = self.follow()
+        self.assertEqual(self.read(follower), ["a", "b"])
+        self.assertEqual(self.read(follower), [])
+        self.write("app.log", "c\nunfinished")
+        self.assertEqual(self.read(follower), ["c"])
+        self.write("app.log", " line\n")
+        self.assertEqual(self.read(follower), ["unfinished line"])
+
+    def test_existing_from_end(self):
+        self.write("app.log", "old\n")
+        follower = self.follow(from_start = False)
+        self.assertEqual(self.read(follower), [])
+        self.write("app.log", "new\n")
+        self.assertEqual(self.read(follower), ["new"])
+
+    def test_new_file(self):
+        follower = self.follow(from_start = False)
+        self.assertEqual(self.read(follower), [])
+        self.write("other.log", "first\n")
+        self.assertEqual(self.read(follower), ["first"])
+
+    def test_rotation(self):
+        self.write("app.log", "a\n")
+        follower = self.follow()
+        self.assertEqual(self.read(follower), ["a"])
+        # lines written just before rotation are read from the old file
+        self.write("app.log", "b\nlast")
+        os.rename(self.path("app.log"), self.path("app.log.1"))
+        self.write("app.log", "c\n")
+        self.assertEqual(self.read(follower), ["b", "last", "c"])
+        self.write("app.log", "d\n")
+        self.assertEqual(self.read(follower), ["d"])
+
+    def test_removal(self):
+        self.write("app.log", "a\n")
+        follower = self.follow()
+        self.assertEqual(self.read(follower), ["a"])
+        os.unlink(self.path("app.log"))
+        self.assertEqual(self.read(follower), [])
+        self.assertEqual(follower.files, {})
+        self.write("app.log", "b\n")
+        self.assertEqual(self.read(follower), ["b"])
+
+    def test_truncation(self):
+        self.write("app.log", "long line\nanother\n")
+        follower = self.follow()
+        self.assertEqual(self.read(follower), ["long line", "another"])
+        self.write("app.log", "x\n", mode = "w")
+        self.assertEqual(self.read(follower), ["x"])
+        self.write("app.log", "y\n")
+        self.assertEqual(self.read(follower), ["y"])
+
+    def test_checkpoint(self):
+        checkpoint_path = self.path("checkpoint.json")
+        self.write("app.log", "a\nb\n")
+        follower = self.follow(
+            checkpoint = seismometer.input.file.Checkpoint(checkpoint_path),
+        )
+        self.assertEqual(self.read(follower), ["a", "b"])
+        follower.close()
+
+        # rotated while not running
+        self.write("app.log", "c\n")
+        os.rename(self.path("app.log"), self.path("app.log.1"))
+        self.write("app.log", "d\n")
+        follower = seismometer.input.file.File(
+            self.path("app.log"), use_inotify = False,
+            checkpoint = seismometer.input.file.Checkpoint(checkpoint_path),
+        )
+        self.addCleanup(follower.close)
+        self.assertEqual(self.read(follower), ["c", "d"])
+
+#-----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
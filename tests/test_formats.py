@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+import unittest
+from seismometer.output.formats import GraphiteEncoder, InfluxEncoder
+from seismometer.message import Message
+
+#-----------------------------------------------------------------------------
+
+def message(vset = None, state = None, location = None, time = 1400000000,
+            aspect = "disk.usage"):
+    event = { "name": aspect }
+    if vset is not None:
+        event["vset"] = dict(
+            (name, { "value": value }) for (name, value) in vset.items()
+        )
+    if state is not None:
+        event["state"] = state
+    if location is None:
+        location = { "host": "web01" }
+    return { "v": 3, "time": time, "location": location, "event": event }
+
+# messages and values outside of the schema
+INVALID_MESSAGES = [
+    [], "message", {},
+    { "time": 1, "location": {}, "event": [] },
+    { "time": 1, "location": {}, "event": { "name": 5 } },
+    { "time": 1, "event": { "name": "a", "vset": { "v": { "value": 1 } } } },
+    message(vset = { "value": 1 }, time = "1"),
+    message(vset = { "value": 1 }, time = None),
+    message(vset = { "value": 1 }, time = True),
+    message(vset = { "value": 1 }, time = float("nan")),
+    message(vset = { "value": 1 }, location = "web01"),
+    message(vset = { "value": 1 }, location = { "host": ["web01"] }),
+    message(vset = { "value": 1 }, location = { "host": { "a": "b" } }),
+    message(vset = { "value": 1 }, location = { "host": 1 }),
+    message(state = "ok"),
+    message(state = { "value": 1 }),
+]
+INVALID_VALUES = [
+    None, True, False, "1", u"1", [1], { "value": 1 },
+    float("nan"), float("inf"), -float("inf"), 10 ** 400,
+]
+
+class TestGraphite(unittest.TestCase):
+    def test_values(self):
+        encoder = GraphiteEncoder()
+        lines = encoder.encode(message(vset = { "value": 1, "free": 2.5 }))
+        self.assertEqual(sorted(lines.splitlines(True)), [
+            "web01.disk.usage 1 1400000000\n",
+            "web01.disk.usage.free 2.5 1400000000\n",
+        ])
+
+    def test_template(self):
+        encoder = GraphiteEncoder("servers.{host}.{aspect}")
+        self.assertEqual(encoder.encode(message(vset = { "value": 1 })),
+                         "servers.web01.disk.usage 1 1400000000\n")
+
+    def test_message_object(self):
+        m = Message(aspect = "disk.usage", location = { "host": "web01" },
+                    time = 1400000000, value = 3)
+        self.assertEqual(GraphiteEncoder().encode(m),
+                         "web01.disk.usage 3 1400000000\n")
+
+    def test_state_only(self):
+        self.assertEqual(GraphiteEncoder().encode(message(state = {
+            "value": "ok",
+        })), "")
+
+    def test_invalid_messages(self):
+        encoder = GraphiteEncoder()
+        buffer = []
+        size = encoder.encode_batch(INVALID_MESSAGES, buffer)
+        self.assertEqual((size, buffer), (0, []))
+
+    def test_invalid_values(self):
+        encoder = GraphiteEncoder()
+        for value in INVALID_VALUES:
+            self.assertEqual(encoder.encode(message(vset = { "v": value })),
+                             "")
+
+    def test_invalid_value_entries(self):
+        m = message(vset = { "value": 1 })
+        m["event"]["vset"]["other"] = 5
+        m["event"]["vset"][1] = { "value": 1 }
+        self.assertEqual(GraphiteEncoder().encode(m),
+                         "web01.disk.usage 1 1400000000\n")
+
+class TestInflux(unittest.TestCase):
+    def test_values_and_state(self):
+        encoder = InfluxEncoder()
+        m = message(vset = { "value": 1 },
+                    state = { "value": "ok", "severity": "expected" })
+        self.assertEqual(encoder.encode(m),
+                         'disk.usage,host=web01 value=1.0,state="ok",'
+                         'severity="expected" 1400000000000000000\n')
+
+    def test_escaping(self):
+        m = message(vset = { "free space": 1 },
+                    location = { "host": "a b", "dc": "x,y" })
+        self.assertEqual(InfluxEncoder().encode(m),
+                         'disk.usage,dc=x\\,y,host=a\\ b free\\ space=1.0'
+                         ' 1400000000000000000\n')
+
+    def test_float_time(self):
+        encoder = InfluxEncoder()
+        self.assertEqual(encoder.encode(message(vset = { "value": 1 },
+                                                time = 1400000000.25)),
+                         'disk.usage,host=web01 value=1.0'
+                         ' 1400000000250000000\n')
+
+    def test_negative_time(self):
+        encoder = InfluxEncoder()
+        for (time, ns) in ((-1.5, "-1500000000"), (-0.25, "-250000000"),
+                           (-2, "-2000000000")):
+            line = encoder.encode(message(vset = { "value": 1 }, time = time))
+            self.assertEqual(line, "disk.usage,host=web01 value=1.0 %s\n" % \
+                                   (ns,))
+
+    def test_invalid_messages(self):
+        encoder = InfluxEncoder()
+        buffer = []
+        size = encoder.encode_batch(INVALID_MESSAGES, buffer)
+        self.assertEqual((size, buffer), (0, []))
+
+    def test_invalid_values(self):
+        encoder = InfluxEncoder()
+        for value in INVALID_VALUES:
+            self.assertEqual(encoder.encode(message(vset = { "v": value })),
+                             "")
+
+    def test_invalid_values_with_state(self):
+        encoder = InfluxEncoder()
+        m = message(vset = { "v": "1", "w": 10 ** 400 },
+                    state = { "value": "ok", "severity": 3 })
+        self.assertEqual(encoder.encode(m),
+                         'disk.usage,host=web01 state="ok"'
+                         ' 1400000000000000000\n')
+
+#-----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+import unittest
+from seismometer.output.routing import RoutingTable, Rule
+
+#-----------------------------------------------------------------------------
+
+def message(aspect, location, vset = True, state = False):
+    event = { "name": aspect }
+    if vset:
+        event["vset"] = { "value": { "value": 1 } }
+    if state:
+        event["state"] = { "value": "ok" }
+    return { "v": 3, "time": 1, "location": location, "event": event }
+
+class TestRouting(unittest.TestCase):
+    def setUp(self):
+        self.table = RoutingTable()
+        self.table.add("web", [Rule(location = { "role": "web" })])
+        self.table.add("disk", [Rule(aspect = "disk.*", aspect_type = "glob")])
+        self.table.add("states", [Rule(kind = "state")])
+        self.table.add("all")
+
+    def route(self, message):
+        return self.table.route(message)
+
+    def test_location(self):
+        self.assertEqual(self.route(message("cpu", { "role": "web" })),
+                         ["web", "all"])
+        self.assertEqual(self.route(message("cpu", { "role": "db" })),
+                         ["all"])
+
+    def test_aspect_glob(self):
+        self.assertEqual(self.route(message("disk.usage", {})),
+                         ["disk", "all"])
+        self.assertEqual(self.route(message("diskette", {})), ["all"])
+
+    def test_kind(self):
+        self.assertEqual(self.route(message("cpu", {}, vset = False,
+                                            state = True)),
+                         ["states", "all"])
+
+    def test_cached_result(self):
+        m = message("cpu", { "role": "web" })
+        self.assertEqual(self.route(m), self.route(m))
+
+    def test_unhashable_location_values(self):
+        for value in (["web"], { "a": "web" }):
+            m = message("cpu", { "role": value })
+            self.assertEqual(self.route(m), ["all"])
+            # the same message again, with nothing cached for it
+            self.assertEqual(self.route(m), ["all"])
+
+    def test_non_string_location_values(self):
+        for value in (1, 1.5, None, True):
+            self.assertEqual(self.route(message("cpu", { "role": value })),
+                             ["all"])
+
+    def test_invalid_messages(self):
+        for m in ({}, { "event": [] }, { "event": { "name": 5 } },
+                  { "event": { "name": "disk.x" }, "location": "web" }):
+            self.assertTrue("all" in self.route(m))
+
+#-----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+import unittest
+import seismometer.wire
+from seismometer.wire import Encoder, Decoder, accept_hello, _varint
+
+#-----------------------------------------------------------------------------
+
+def message(**event):
+    event.setdefault("name", "disk.usage")
+    return {
+        "v": 3,
+        "time": 1400000000,
+        "location": { "host": "web01", "mount": "/" },
+        "event": event,
+    }
+
+def frame(payload):
+    return _varint(len(payload)) + payload
+
+class TestRoundTrip(unittest.TestCase):
+    def test_metric(self):
+        m = message(vset = {
+            "value": { "value": 12.5, "unit": "%" },
+            "free": { "value": 1024 },
+            "none": { "value": None },
+        })
+        data = Encoder().encode(m)
+        self.assertEqual(data[len(_varint(len(data) - 1)):][0], "\x01")
+        self.assertEqual(Decoder().feed(data), [m])
+
+    def test_state_and_thresholds(self):
+        m = message(
+            interval = 60,
+            state = { "value": "ok", "severity": "expected" },
+            comment = "all fine",
+            vset = { "value": {
+                "value": 3,
+                "threshold_high": [
+                    { "name": "warn", "value": 5, "severity": "warning" },
+                ],
+            } },
+        )
+        self.assertEqual(Decoder().feed(Encoder().encode(m)), [m])
+
+    def test_string_dictionary(self):
+        encoder = Encoder()
+        decoder = Decoder()
+        messages = [message(vset = { "value": { "value": i } })
+                    for i in xrange(3)]
+        data = "".join([encoder.encode(m) for m in messages])
+        self.assertEqual(decoder.feed(data), messages)
+
+    def test_non_schema_message(self):
+        m = { "something": ["else"] }
+        self.assertEqual(Decoder().feed(Encoder().encode(m)), [m])
+
+class TestTruncated(unittest.TestCase):
+    def test_split_stream(self):
+        m = message(vset = { "value": { "value": 1 } })
+        data = Encoder().encode(m)
+        decoder = Decoder()
+        for i in xrange(len(data) - 1):
+            self.assertEqual(decoder.feed(data[i]), [])
+        self.assertEqual(decoder.feed(data[-1]), [m])
+
+    def test_truncated_payload(self):
+        m = message(vset = { "value": { "value": 1 } })
+        data = Encoder().encode(m)
+        payload = data[len(_varint(len(data) - 1)):]
+        for i in xrange(1, len(payload)):
+            self.assertRaises(ValueError, Decoder().feed, frame(payload[:i]))
+
+    def test_empty_frame(self):
+        self.assertRaises(ValueError, Decoder().feed, frame(""))
+
+    def test_unknown_frame_type(self):
+        self.assertRaises(ValueError, Decoder().feed, frame("\x07abc"))
+
+class TestOversized(unittest.TestCase):
+    def header(self):
+        # message frame, no flags, time, aspect name defined inline
+        return "\x01" + "\x00" + "\x00" + chr((1 << 2) | 1) + "a"
+
+    def test_frame_too_large(self):
+        decoder = Decoder(max_frame = 100)
+        self.assertRaises(ValueError, decoder.feed, _varint(1000) + "\x01")
+
+    def test_huge_location_count(self):
+        payload = self.header() + _varint(2 ** 64)
+        self.assertRaises(ValueError, Decoder().feed, frame(payload))
+
+    def test_location_count_over_payload(self):
+        payload = self.header() + _varint(1000) + chr((1 << 2) | 2) + "x"
+        self.assertRaises(ValueError, Decoder().feed, frame(payload))
+
+    def test_huge_value_count(self):
+        payload = "\x01" + "\x10" + "\x00" + chr((1 << 2) | 1) + "a" + \
+                  "\x00" + _varint(2 ** 70)
+        self.assertRaises(ValueError, Decoder().feed, frame(payload))
+
+    def test_huge_string_reference(self):
+        payload = "\x01" + "\x00" + "\x00" + _varint(2 ** 70 << 2)
+        self.assertRaises(ValueError, Decoder().feed, frame(payload))
+
+    def test_huge_string_length(self):
+        payload = "\x01" + "\x00" + "\x00" + _varint((2 ** 70 << 2) | 2)
+        self.assertRaises(ValueError, Decoder().feed, frame(payload))
+
+class TestHello(unittest.TestCase):
+    def test_supported(self):
+        (reply, decoder) = accept_hello(seismometer.wire.HELLO.strip())
+        self.assertEqual(reply, seismometer.wire.HELLO)
+        self.assertTrue(decoder is not None)
+
+    def test_unsupported_version(self):
+        (reply, decoder) = accept_hello("#seismometer-wire 999")
+        self.assertEqual(reply, "#seismometer-wire none\n")
+        self.assertTrue(decoder is None)
+
+    def test_not_hello(self):
+        self.assertEqual(accept_hello("#seismometer-wirex 1"), (None, None))
+        self.assertEqual(accept_hello(""), (None, None))
+
+#-----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    unittest.main()
+
+#-----------------------------------------------------------------------------
+# vim:ft=python:foldmethod=marker